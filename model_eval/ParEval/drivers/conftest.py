@@ -0,0 +1,10 @@
+""" The driver modules import each other as top level modules (util, cpp, drivers), so tests need both this
+    directory and its parent on the path, like run-all.py has.
+"""
+import os
+import sys
+
+DRIVERS_ROOT = os.path.dirname(os.path.abspath(__file__))
+for path in (DRIVERS_ROOT, os.path.dirname(DRIVERS_ROOT)):
+    if path not in sys.path:
+        sys.path.append(path)
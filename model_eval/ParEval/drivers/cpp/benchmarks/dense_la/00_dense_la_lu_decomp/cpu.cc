@@ -22,13 +22,18 @@
 struct Context {
     std::vector<double> A;
     size_t N;
+    InputSnapshot snapshot;
 };
 
-void reset(Context *ctx) {
+void generateInputs(Context *ctx) {
     fillRand(ctx->A, -10.0, 10.0);
     BCAST(ctx->A, DOUBLE);
 }
 
+void reset(Context *ctx) {
+    ctx->snapshot.restore([&] { generateInputs(ctx); }, ctx->A);
+}
+
 Context *init() {
     Context *ctx = new Context();
 
@@ -22,6 +22,7 @@
 struct Context {
     std::vector<double> A, b, x;
     size_t N;
+    InputSnapshot snapshot;
 };
 
 void createRandomLinearSystem(std::vector<double> &A, std::vector<double> &b, std::vector<double> &x, size_t N) {
@@ -39,7 +40,7 @@ void createRandomLinearSystem(std::vector<double> &A, std::vector<double> &b, st
     std::fill(x.begin(), x.end(), 0.0);
 }
 
-void reset(Context *ctx) {
+void generateInputs(Context *ctx) {
     createRandomLinearSystem(ctx->A, ctx->b, ctx->x, ctx->N);
 
     BCAST(ctx->A, DOUBLE);
@@ -47,6 +48,10 @@ void reset(Context *ctx) {
     BCAST(ctx->x, DOUBLE);
 }
 
+void reset(Context *ctx) {
+    ctx->snapshot.restore([&] { generateInputs(ctx); }, ctx->A, ctx->b, ctx->x);
+}
+
 Context *init() {
     Context *ctx = new Context();
 
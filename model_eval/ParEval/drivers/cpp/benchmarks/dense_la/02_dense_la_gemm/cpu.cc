@@ -21,9 +21,10 @@
 struct Context {
     std::vector<double> A, B, C;
     size_t M, K, N;
+    InputSnapshot snapshot;
 };
 
-void reset(Context *ctx) {
+void generateInputs(Context *ctx) {
     fillRand(ctx->A, -1.0, 1.0);
     fillRand(ctx->B, -1.0, 1.0);
     std::fill(ctx->C.begin(), ctx->C.end(), 0.0);
@@ -33,6 +34,10 @@ void reset(Context *ctx) {
     BCAST(ctx->C, DOUBLE);
 }
 
+void reset(Context *ctx) {
+    ctx->snapshot.restore([&] { generateInputs(ctx); }, ctx->A, ctx->B, ctx->C);
+}
+
 Context *init() {
     Context *ctx = new Context();
 
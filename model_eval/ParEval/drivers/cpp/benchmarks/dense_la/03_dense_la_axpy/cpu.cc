@@ -20,9 +20,10 @@
 struct Context {
     double alpha;
     std::vector<double> x, y, z;
+    InputSnapshot snapshot;
 };
 
-void reset(Context *ctx) {
+void generateInputs(Context *ctx) {
     fillRand(ctx->x, -1.0, 1.0);
     fillRand(ctx->y, -1.0, 1.0);
 
@@ -30,6 +31,10 @@ void reset(Context *ctx) {
     BCAST(ctx->y, DOUBLE);
 }
 
+void reset(Context *ctx) {
+    ctx->snapshot.restore([&] { generateInputs(ctx); }, ctx->x, ctx->y);
+}
+
 Context *init() {
     Context *ctx = new Context();
 
@@ -21,9 +21,10 @@
 struct Context {
     std::vector<double> A, x, y;
     size_t M, N;
+    InputSnapshot snapshot;
 };
 
-void reset(Context *ctx) {
+void generateInputs(Context *ctx) {
     fillRand(ctx->A, -10.0, 10.0);
     fillRand(ctx->x, -10.0, 10.0);
 
@@ -31,6 +32,10 @@ void reset(Context *ctx) {
     BCAST(ctx->x, DOUBLE);
 }
 
+void reset(Context *ctx) {
+    ctx->snapshot.restore([&] { generateInputs(ctx); }, ctx->A, ctx->x);
+}
+
 Context *init() {
     Context *ctx = new Context();
 
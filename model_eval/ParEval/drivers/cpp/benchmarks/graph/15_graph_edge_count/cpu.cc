@@ -25,6 +25,7 @@
 struct Context {
     std::vector<int> A;
     size_t N;
+    InputSnapshot snapshot;
 };
 
 /*
@@ -44,11 +45,15 @@ void fillRandDirectedGraph(std::vector<int> &A, size_t N) {
     fillRandDirectedGraph_(A, N);
 }
 
-void reset(Context *ctx) {
+void generateInputs(Context *ctx) {
     fillRandDirectedGraph(ctx->A, ctx->N);
     BCAST(ctx->A, INT);
 }
 
+void reset(Context *ctx) {
+    ctx->snapshot.restore([&] { generateInputs(ctx); }, ctx->A);
+}
+
 Context *init() {
     Context *ctx = new Context();
 
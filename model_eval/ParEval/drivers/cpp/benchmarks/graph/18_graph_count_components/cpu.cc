@@ -21,6 +21,7 @@
 struct Context {
     std::vector<int> A;
     size_t N;
+    InputSnapshot snapshot;
 };
 
 /*
@@ -40,11 +41,15 @@ void fillRandomUndirectedGraph(std::vector<int> &A, size_t N) {
     fillRandomUndirectedGraph_(A, N);
 }
 
-void reset(Context *ctx) {
+void generateInputs(Context *ctx) {
     fillRandomUndirectedGraph(ctx->A, ctx->N);
     BCAST(ctx->A, INT);
 }
 
+void reset(Context *ctx) {
+    ctx->snapshot.restore([&] { generateInputs(ctx); }, ctx->A);
+}
+
 Context *init() {
     Context *ctx = new Context();
 
@@ -24,6 +24,7 @@ struct Context {
     std::vector<int> A;
     size_t N;
     int source, dest;
+    InputSnapshot snapshot;
 };
 
 /*
@@ -76,7 +77,7 @@ void randomConnectedUndirectedGraph(std::vector<int> &A, size_t N) {
     }
 }
 
-void reset(Context *ctx) {
+void generateInputs(Context *ctx) {
     randomConnectedUndirectedGraph(ctx->A, ctx->N);
     ctx->source = rand() % ctx->N;
     
@@ -89,6 +90,10 @@ void reset(Context *ctx) {
     BCAST_PTR(&ctx->dest, 1, INT);
 }
 
+void reset(Context *ctx) {
+    ctx->snapshot.restore([&] { generateInputs(ctx); }, ctx->A, ctx->source, ctx->dest);
+}
+
 Context *init() {
     Context *ctx = new Context();
 
@@ -4,6 +4,7 @@
 """
 # std imports
 import copy
+import hashlib
 import logging
 import os
 from os import PathLike, environ
@@ -11,11 +12,12 @@ import shlex
 import subprocess
 import sys
 import tempfile
-from typing import List
+import threading
+from typing import List, Optional
 
 # local imports
 sys.path.append("..")
-from drivers.driver_wrapper import DriverWrapper, BuildOutput, RunOutput, GeneratedTextResult
+from drivers.driver_wrapper import DriverWrapper, BuildOutput, BuiltOutput, RunOutput, GeneratedTextResult, BENCHMARK_MODES
 from util import run_command
 
 import time
@@ -32,6 +34,9 @@ DRIVER_MAP = {
     "hip": "hip-driver.o",
 }
 
+""" Directory containing the c++ drivers, used so that builds do not depend on the working directory """
+CPP_DRIVERS_ROOT = os.path.dirname(os.path.abspath(__file__))
+
 """ Compiler settings """
 COMPILER_SETTINGS = {
     # use c++20 as fast random number generation requires it
@@ -44,6 +49,138 @@ COMPILER_SETTINGS = {
     "hip": {"CXX": "hipcc", "CXXFLAGS": "-std=c++17 -O3 -Xcompiler \"-std=c++17\" -Xcompiler \"-O3\" -Wno-unused-result"}
 }
 
+""" Fixed prefix of every generated translation unit per parallelism model. It is compiled once per compiler and
+    flag set into a precompiled header. These headers are already included by every benchmark and by the model's
+    driver, so pre-including them is harmless. The keys are the parallelism models that support gcc precompiled
+    headers and separate compilation. """
+PCH_PREFIXES = {
+    "serial": "#include <bits/stdc++.h>\n#include <immintrin.h>\n#include <xoshiro.h>\n",
+    "omp": "#include <bits/stdc++.h>\n#include <immintrin.h>\n#include <omp.h>\n#include <xoshiro.h>\n",
+}
+BUILD_CACHE_MODELS = list(PCH_PREFIXES.keys())
+
+""" Matches the includes of a source file as (opening delimiter, name) """
+INCLUDE_RE = re.compile(r'^\s*#\s*include\s*([<"])([^>"]+)[>"]', re.MULTILINE)
+
+""" Default location of the build cache """
+DEFAULT_BUILD_CACHE_DIR = os.path.join(tempfile.gettempdir(), "pareval-build-cache")
+
+class BuildCache:
+    """ Precompiled headers and compiled objects shared between builds of generated code.
+        Objects are keyed on the source, the flags and the contents of the headers it includes from the include
+        directories, so identical translation units are only compiled once. System headers are covered by the
+        compiler version.
+    """
+
+    def __init__(self, cache_dir: PathLike = DEFAULT_BUILD_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.compiler_versions = {}
+        # precompiled headers that failed to build. Only kept for this process, so a fixed header or toolchain
+        # is picked up by the next run.
+        self.failed_pch_keys = set()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.join(self.cache_dir, "objects"), exist_ok=True)
+
+    def compiler_version(self, CXX: str) -> str:
+        """ Return the version string of the given compiler. """
+        with self.lock:
+            if CXX not in self.compiler_versions:
+                self.compiler_versions[CXX] = run_command(f"{CXX} --version").stdout
+            return self.compiler_versions[CXX]
+
+    def precompiled_header(self, CXX: str, CXXFLAGS: str, prefix: str, timeout: Optional[int] = None) -> Optional[str]:
+        """ Return the path of the prefix header to pass to -include, building its precompiled header
+            if necessary. Returns None if the precompiled header cannot be built.
+        """
+        key = hashlib.sha256("\n".join([self.compiler_version(CXX), CXX, CXXFLAGS, prefix]).encode()).hexdigest()
+        pch_dir = os.path.join(self.cache_dir, f"pch-{key[:16]}")
+        header_path = os.path.join(pch_dir, "pch-prefix.hpp")
+        with self.lock:
+            if os.path.exists(header_path + ".gch"):
+                return header_path
+            if key in self.failed_pch_keys:
+                return None
+
+            os.makedirs(pch_dir, exist_ok=True)
+            with open(header_path, "w") as fp:
+                fp.write(prefix)
+            # build next to the final location and rename, so other processes never see a partial file
+            tmp_gch = f"{header_path}.{os.getpid()}.tmp"
+            cmd = f"{CXX} {CXXFLAGS} -x c++-header {header_path} -o {tmp_gch}"
+            try:
+                pch_process = run_command(cmd, timeout=timeout)
+                if pch_process.returncode != 0:
+                    logging.warning(f"Could not build precompiled header, compiling without it:\n{pch_process.stderr}")
+                    self.failed_pch_keys.add(key)
+                    return None
+                os.replace(tmp_gch, header_path + ".gch")
+                return header_path
+            except subprocess.TimeoutExpired:
+                logging.warning("Timed out building precompiled header.")
+                return None
+            finally:
+                if os.path.exists(tmp_gch):
+                    os.remove(tmp_gch)
+
+    def object_path(self, CXX: str, flags: str, source: PathLike) -> str:
+        """ Return where the object for the given source compiled with the given flags is stored.
+            Include directories are left out of the key, only the headers found in them count. This way the
+            per-build scratch directory holding the generated code does not make every build a miss.
+        """
+        args = shlex.split(flags)
+        include_dirs = [a[2:] for a in args if a.startswith("-I") and len(a) > 2]
+        other_flags = [a for a in args if not a.startswith("-I")]
+        key = hashlib.sha256()
+        for part in [self.compiler_version(CXX), CXX, " ".join(other_flags)]:
+            key.update(part.encode() + b"\0")
+        for name, digest in self.local_includes(source, include_dirs):
+            key.update(f"{name}:{digest}".encode() + b"\0")
+        return os.path.join(self.cache_dir, "objects", f"{key.hexdigest()}.o")
+
+    @staticmethod
+    def local_includes(source: PathLike, include_dirs: List[str]) -> List[tuple]:
+        """ Return (name, content hash) of the source and of every header it includes from its own directory or
+            the include directories, recursively, in the order they are found. Includes are resolved like gcc
+            does: quoted includes are looked up in the including file's directory first. Headers that are not
+            found there are system headers or belong to another model (behind an #ifdef) and are skipped.
+            Hashing the few small headers is much cheaper than preprocessing the translation unit.
+        """
+        found = []
+        seen = set()
+        pending = [(os.path.basename(source), os.path.abspath(source))]
+        while len(pending) > 0:
+            name, path = pending.pop(0)
+            if path in seen:
+                continue
+            seen.add(path)
+            with open(path, "rb") as fp:
+                content = fp.read()
+            found.append((name, hashlib.sha256(content).hexdigest()))
+            for delimiter, include in INCLUDE_RE.findall(content.decode(errors="replace")):
+                search_dirs = [os.path.dirname(path)] + include_dirs if delimiter == '"' else include_dirs
+                for directory in search_dirs:
+                    candidate = os.path.abspath(os.path.join(directory, include))
+                    if os.path.isfile(candidate):
+                        pending.append((include, candidate))
+                        break
+        return found
+
+    def record(self, hit: bool):
+        """ Count a lookup, builds may run on several threads. """
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def store_object(self, object_path: PathLike, cached_path: PathLike):
+        """ Copy a freshly compiled object into the cache. """
+        tmp_path = f"{cached_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        run_command(f"cp {object_path} {tmp_path}")
+        os.replace(tmp_path, cached_path)
+
 # There are certain problems that don't play nice with code optimization.
 # baseline code sometimes defines helper functions that will conflict with a LLM's output.
 # This only affects a few problems below, so this is a quick and dirty hack to solve some compiler errors that arise for these problems.
@@ -84,9 +221,12 @@ def build_kokkos(driver_src: PathLike, output_root: PathLike, problem_size: str
 
 class CppDriverWrapper(DriverWrapper):
 
-    def __init__(self, **kwargs):
+    def __init__(self, build_cache_dir: Optional[PathLike] = DEFAULT_BUILD_CACHE_DIR, **kwargs):
+        """ build_cache_dir: where to keep precompiled headers and compiled objects. None disables the cache. """
         super().__init__(**kwargs)
-        self.model_driver_file = os.path.join("cpp", "models", DRIVER_MAP[self.parallelism_model])
+        self.model_driver_file = os.path.join(CPP_DRIVERS_ROOT, "models", DRIVER_MAP[self.parallelism_model])
+        use_build_cache = build_cache_dir is not None and self.parallelism_model in BUILD_CACHE_MODELS and not self.dry
+        self.build_cache = BuildCache(build_cache_dir) if use_build_cache else None
 
     def write_source(self, content: str, fpath: PathLike) -> bool:
         """ Write the given c++ source to the given file. """
@@ -109,26 +249,63 @@ class CppDriverWrapper(DriverWrapper):
         output_path: PathLike = "a.out", 
         CXX: str = "g++", 
         CXXFLAGS: str = "-std=c++17 -O3",
-        problem_size: str = "(1<<20)"
+        problem_size: str = "(1<<20)",
+        extra_flags: str = ""
     ) -> BuildOutput:
-        """ Compile the given binaries into a single executable. """
+        """ Compile the given binaries into a single executable.
+            CXXFLAGS are the flags shared by all builds of this model, extra_flags are specific to this build.
+        """
         if self.parallelism_model == "kokkos":
             driver_src = [b for b in binaries if b.endswith(".cc")][0]
             compile_process = build_kokkos(driver_src, os.path.dirname(output_path), problem_size=problem_size)
         else:
-            binaries_str = ' '.join(binaries)
             macro = f"-DUSE_{self.parallelism_model.upper()}"
-            cmd = f"{CXX} {CXXFLAGS} -Icpp -Icpp/models {macro} {binaries_str} -o {output_path}"
+            include_dirs = f"-I{CPP_DRIVERS_ROOT} -I{os.path.join(CPP_DRIVERS_ROOT, 'models')}"
             try:
+                if self.build_cache is not None:
+                    return self.compile_with_cache(*binaries, output_path=output_path, CXX=CXX,
+                        CXXFLAGS=f"{CXXFLAGS} {include_dirs} {macro}", extra_flags=extra_flags)
+                binaries_str = ' '.join(binaries)
+                cmd = f"{CXX} {CXXFLAGS} {extra_flags} {include_dirs} {macro} {binaries_str} -o {output_path}"
                 compile_process = run_command(cmd, timeout=self.build_timeout, dry=self.dry)
             except subprocess.TimeoutExpired as e:
                 return BuildOutput(-1, str(e.stdout), f"[Timeout] {str(e.stderr)}")
         return BuildOutput(compile_process.returncode, compile_process.stdout, compile_process.stderr)
 
-    def run(self, executable: PathLike, **run_config) -> RunOutput:
-        """ Run the given executable. """
+    def compile_with_cache(self, *binaries: PathLike, output_path: PathLike, CXX: str, CXXFLAGS: str, extra_flags: str) -> BuildOutput:
+        """ Compile each source separately against the precompiled prefix header, reusing cached objects
+            for translation units that were compiled before, then link.
+        """
+        pch_header = self.build_cache.precompiled_header(CXX, CXXFLAGS, PCH_PREFIXES[self.parallelism_model],
+                                                         timeout=self.build_timeout)
+        pch_flags = f"-include {pch_header}" if pch_header is not None else ""
+
+        objects = []
+        for binary in binaries:
+            if binary.endswith(".o"):
+                objects.append(binary)
+                continue
+
+            cached_object = self.build_cache.object_path(CXX, f"{CXXFLAGS} {extra_flags}", binary)
+            hit = os.path.exists(cached_object)
+            self.build_cache.record(hit)
+            if not hit:
+                object_path = os.path.join(os.path.dirname(output_path), os.path.basename(binary) + ".o")
+                compile_process = run_command(f"{CXX} {pch_flags} {CXXFLAGS} {extra_flags} -c {binary} -o {object_path}", timeout=self.build_timeout)
+                if compile_process.returncode != 0:
+                    return BuildOutput(compile_process.returncode, compile_process.stdout, compile_process.stderr)
+                self.build_cache.store_object(object_path, cached_object)
+            objects.append(cached_object)
+
+        link_process = run_command(f"{CXX} {CXXFLAGS} {' '.join(objects)} -o {output_path}", timeout=self.build_timeout)
+        return BuildOutput(link_process.returncode, link_process.stdout, link_process.stderr)
+
+    def run(self, executable: PathLike, benchmark_mode: Optional[str] = None, extra_args: str = "", **run_config) -> RunOutput:
+        """ Run the given executable. extra_args are passed to the model driver after the benchmark mode flags. """
+        benchmark_mode = benchmark_mode if benchmark_mode is not None else self.benchmark_mode
         launch_format = self.launch_configs["format"]
-        launch_cmd = launch_format.format(exec_path=executable, args="", **run_config).strip()
+        args = f"{BENCHMARK_MODES[benchmark_mode]} {extra_args}".strip()
+        launch_cmd = launch_format.format(exec_path=executable, args=args, **run_config).strip()
         try:
             run_process = run_command(launch_cmd, timeout=self.run_timeout, dry=self.dry)
         except subprocess.TimeoutExpired as e:
@@ -141,58 +318,98 @@ class CppDriverWrapper(DriverWrapper):
 
         return RunOutput(run_process.returncode, run_process.stdout, run_process.stderr, config=run_config)
 
-    def test_single_output(self, prompt: str, output: str, test_driver_file: PathLike, problem_size: str) -> GeneratedTextResult:
-        """ Test a single generated output. """
-        code_opt = True
-
+    def build_single_output(self, prompt: str, output: str, test_driver_file: PathLike, problem_size: str) -> BuiltOutput:
+        """ Write and compile a single generated output. The returned build owns a scratch directory
+            that is removed by run_built_output.
+        """
         logging.debug(f"Testing output:\n{output}")
-        with tempfile.TemporaryDirectory(dir=self.scratch_dir) as tmpdir:
-            # write out the prompt + output
-            src_ext = "cuh" if self.parallelism_model in ["cuda", "hip"] else "hpp"
-            src_path = os.path.join(tmpdir, f"generated-code.{src_ext}")
-
-            # include the entire C++ standard library as well as header for vectorization
-            include_header = "#include <bits/stdc++.h>\n#include <immintrin.h>\n"
-            if self.code_opt:
-                output = check_code_compile_errors(output)
-                output = check_duplicate_function_names(output)
-                write_success = self.write_source(include_header+"\n"+output, src_path)
-            else:
-                prompt = self.patch_prompt(prompt)
-                write_success = self.write_source(include_header+"\n"+prompt+"\n"+output, src_path)
-
-            logging.debug(f"Wrote source to {src_path}.")
-
-            # compile and run the output
-            exec_path = os.path.join(tmpdir, "a.out")
-            compiler_kwargs = copy.deepcopy(COMPILER_SETTINGS[self.parallelism_model])
-            compiler_kwargs["problem_size"] = problem_size  # for kokkos
-            compiler_kwargs["CXXFLAGS"] += f" -I{tmpdir} -DDRIVER_PROBLEM_SIZE=\"{problem_size}\""
-            build_result = self.compile(self.model_driver_file, test_driver_file, output_path=exec_path, **compiler_kwargs)
-            if build_result.exit_code != 0:
-                print(f"----- DID NOT BUILD ---- build result stderr: {build_result.stderr}")
-                print("--- CODE FILE ---")
-                print(output)
-
-                print("--- PROMPT ---")
-                print(prompt)
-
-            logging.debug(f"Build result: {build_result}")
-            if self.display_build_errors and build_result.stderr and not build_result.did_build:
-                logging.debug(build_result.stderr)
-
+        scratch = tempfile.TemporaryDirectory(dir=self.scratch_dir)
+        tmpdir = scratch.name
+
+        # write out the prompt + output
+        src_ext = "cuh" if self.parallelism_model in ["cuda", "hip"] else "hpp"
+        src_path = os.path.join(tmpdir, f"generated-code.{src_ext}")
+
+        # include the entire C++ standard library as well as header for vectorization
+        include_header = "#include <bits/stdc++.h>\n#include <immintrin.h>\n"
+        if self.code_opt:
+            output = check_code_compile_errors(output)
+            output = check_duplicate_function_names(output)
+            write_success = self.write_source(include_header+"\n"+output, src_path)
+        else:
+            prompt = self.patch_prompt(prompt)
+            write_success = self.write_source(include_header+"\n"+prompt+"\n"+output, src_path)
+
+        logging.debug(f"Wrote source to {src_path}.")
+
+        # compile the output
+        exec_path = os.path.join(tmpdir, "a.out")
+        compiler_kwargs = copy.deepcopy(COMPILER_SETTINGS[self.parallelism_model])
+        compiler_kwargs["problem_size"] = problem_size  # for kokkos
+        compiler_kwargs["extra_flags"] = f"-I{tmpdir} -DDRIVER_PROBLEM_SIZE=\"{problem_size}\""
+        build_result = self.compile(self.model_driver_file, test_driver_file, output_path=exec_path, **compiler_kwargs)
+        if build_result.exit_code != 0:
+            print(f"----- DID NOT BUILD ---- build result stderr: {build_result.stderr}")
+            print("--- CODE FILE ---")
+            print(output)
+
+            print("--- PROMPT ---")
+            print(prompt)
+
+        logging.debug(f"Build result: {build_result}")
+        if self.display_build_errors and build_result.stderr and not build_result.did_build:
+            logging.debug(build_result.stderr)
+
+        return BuiltOutput(scratch, prompt, output, write_success, build_result, exec_path)
+
+    def sweep_threads(self, benchmark_mode: str) -> Optional[List[int]]:
+        """ Return the thread counts to time in a single sweep run, or None if the launch configs have to be
+            run one process at a time. A sweep is only possible for omp configs that vary nothing but num_threads.
+        """
+        configs = self.launch_configs["params"]
+        if not self.thread_sweep or self.parallelism_model != "omp" or benchmark_mode == "best-only":
+            return None
+        if len(configs) < 2 or any(set(c.keys()) != {"num_threads"} for c in configs):
+            return None
+        return [c["num_threads"] for c in configs]
+
+    def run_built_output(self, built: BuiltOutput, benchmark_mode: Optional[str] = None) -> GeneratedTextResult:
+        """ Run a compiled output with every launch config and clean up its scratch directory. When thread_sweep
+            is set and possible, all thread counts are timed by one process and split back into per-config runs.
+        """
+        benchmark_mode = benchmark_mode if benchmark_mode is not None else self.benchmark_mode
+        prompt, output = built.prompt, built.output
+        try:
             # run the code
             configs = self.launch_configs["params"]
-            if build_result.did_build:
+            sweep = self.sweep_threads(benchmark_mode)
+            if built.build_output.did_build and sweep is not None:
+                start = time.time()
+                sweep_result = self.run(built.exec_path, benchmark_mode=benchmark_mode,
+                    extra_args=f"--sweep {','.join(str(n) for n in sweep)}", num_threads=max(sweep))
+                end = time.time()
+                print(f"sweep run time: {end - start}")
+                if self.display_runs:
+                    logging.debug(sweep_result.stderr)
+                    logging.debug(sweep_result.stdout)
+                if not sweep_result.is_valid:
+                    print("--- INCORRECT ---")
+                    print(sweep_result.stdout)
+                run_results = sweep_result.split_scaling()
+            elif built.build_output.did_build:
                 run_results = []
                 for c in configs:
                     start = time.time()
-                    run_result = self.run(exec_path, **c)
+                    run_result = self.run(built.exec_path, benchmark_mode=benchmark_mode, **c)
                     end = time.time()
                     print(f"one run time: {end - start}")
                     run_results.append(run_result)
 
-                    if run_result.is_valid:
+                    if benchmark_mode == "best-only":
+                        print(f"best sequential runtime: {run_result.best_sequential_runtime}")
+                    elif run_result.is_valid and run_result.best_sequential_runtime is None:
+                        print(f"valid run runtime: {run_result.runtime}")
+                    elif run_result.is_valid:
                         speedup = run_result.best_sequential_runtime / run_result.runtime
                         print(f"valid run runtime: {run_result.runtime}, best sequential runtime: {run_result.best_sequential_runtime}, speedup: {run_result.best_sequential_runtime / run_result.runtime}")
                         if speedup > 20:
@@ -210,7 +427,7 @@ class CppDriverWrapper(DriverWrapper):
                         logging.debug(run_result.stderr)
                         logging.debug(run_result.stdout)
 
-                    if self.early_exit_runs and (run_result.exit_code != 0 or not run_result.is_valid):
+                    if self.early_exit_runs and (run_result.exit_code != 0 or (benchmark_mode != "best-only" and not run_result.is_valid)):
                         break
             else:
                 run_results = None
@@ -219,8 +436,15 @@ class CppDriverWrapper(DriverWrapper):
                 for run_result in run_results:
                     if run_result.exit_code != 0:
                         logging.debug(f"Ouputs:\n\tstdout: {run_result.stdout}\n\tstderr: {run_result.stderr}")
-        
-        return GeneratedTextResult(write_success, build_result, run_results)
+        finally:
+            built.cleanup()
+
+        return GeneratedTextResult(built.source_write_success, built.build_output, run_results)
+
+    def test_single_output(self, prompt: str, output: str, test_driver_file: PathLike, problem_size: str, benchmark_mode: Optional[str] = None) -> GeneratedTextResult:
+        """ Test a single generated output. """
+        built = self.build_single_output(prompt, output, test_driver_file, problem_size)
+        return self.run_built_output(built, benchmark_mode=benchmark_mode)
 
 # ---- Helper functions for parsing ----
 def get_cpp_function_names(code: str):
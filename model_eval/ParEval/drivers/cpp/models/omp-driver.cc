@@ -10,14 +10,47 @@
 *
 * These functions are defined in the driver for the given benchmark and handle
 * the data and calling the generated code.
+*
+* Usage: driver [--skip-best | --best-only] [--sweep <n1,n2,...>] <?num_threads>
+*   --skip-best -- do not time best(), used when the sequential baseline is already known
+*   --best-only -- only time best(), used to record the sequential baseline
+*   --sweep     -- validate once, then time compute() with each of the given thread counts
+*                  and print one "Scaling: <threads> <mean> <median> <min> <stddev>" line per count
+*
+* Each benchmarked function is run once as a warm-up and then repeated until the
+* 95% confidence interval of the mean is within BENCHMARK_TARGET_CI of the mean,
+* BENCHMARK_MAX_ITER runs were made or BENCHMARK_TIME_BUDGET seconds have passed.
+* A warm-up that takes longer than the budget is used as the only sample.
 */
+#include <algorithm>
+#include <cmath>
 #include <cstdio>
+#include <cstring>
 #include <string>
 #include <cfloat>
+#include <vector>
 
 #include <omp.h>
 #include <chrono>
 
+#if !defined(BENCHMARK_MIN_ITER)
+#define BENCHMARK_MIN_ITER 3
+#endif
+
+#if !defined(BENCHMARK_MAX_ITER)
+#define BENCHMARK_MAX_ITER 50
+#endif
+
+#if !defined(BENCHMARK_TIME_BUDGET)
+// seconds spent on timing a single function, including the warm-up and resets
+#define BENCHMARK_TIME_BUDGET 10.0
+#endif
+
+#if !defined(BENCHMARK_TARGET_CI)
+// target half-width of the 95% confidence interval, relative to the mean
+#define BENCHMARK_TARGET_CI 0.02
+#endif
+
 class Context;
 extern "C++" {
     /* todo -- these could all be in a class, but I'm not sure if virtual 
@@ -30,54 +63,178 @@ extern "C++" {
     void destroy(Context *ctx);
 }
 
+struct TimingStats {
+    std::vector<double> samples;
+    double mean, median, min, stddev;
+};
+
+/* Time fn(ctx) adaptively. reset(ctx) is called after every run. */
+TimingStats benchmark(void (*fn)(Context *), Context *ctx) {
+    TimingStats stats;
+    const double budgetStart = omp_get_wtime();
+
+    /* warm-up */
+    double start = omp_get_wtime();
+    fn(ctx);
+    const double warmupTime = omp_get_wtime() - start;
+    reset(ctx);
+    if (warmupTime >= BENCHMARK_TIME_BUDGET) {
+        stats.samples.push_back(warmupTime);
+    }
+
+    while (stats.samples.size() < BENCHMARK_MAX_ITER) {
+        const size_t n = stats.samples.size();
+        if (n >= BENCHMARK_MIN_ITER) {
+            double mean = 0.0, var = 0.0;
+            for (double t : stats.samples) mean += t;
+            mean /= n;
+            for (double t : stats.samples) var += (t - mean) * (t - mean);
+            var /= (n - 1);
+            const bool ciReached = 1.96 * std::sqrt(var / n) <= BENCHMARK_TARGET_CI * mean;
+            const bool budgetSpent = omp_get_wtime() - budgetStart >= BENCHMARK_TIME_BUDGET;
+            if (ciReached || budgetSpent) {
+                break;
+            }
+        } else if (n > 0 && omp_get_wtime() - budgetStart >= BENCHMARK_TIME_BUDGET) {
+            break;
+        }
+
+        start = omp_get_wtime();
+        fn(ctx);
+        stats.samples.push_back(omp_get_wtime() - start);
+        reset(ctx);
+    }
+
+    const size_t n = stats.samples.size();
+    std::vector<double> sorted(stats.samples);
+    std::sort(sorted.begin(), sorted.end());
+    stats.mean = 0.0;
+    for (double t : sorted) stats.mean += t;
+    stats.mean /= n;
+    stats.median = (n % 2 == 1) ? sorted[n / 2] : 0.5 * (sorted[n / 2 - 1] + sorted[n / 2]);
+    stats.min = sorted[0];
+    stats.stddev = 0.0;
+    if (n > 1) {
+        for (double t : sorted) stats.stddev += (t - stats.mean) * (t - stats.mean);
+        stats.stddev = std::sqrt(stats.stddev / (n - 1));
+    }
+    return stats;
+}
+
+/* Print <prefix>Median, <prefix>Min, <prefix>Stddev and <prefix>Samples lines */
+void printStats(const char *prefix, TimingStats const& stats) {
+    printf("%sMedian: %.17g\n", prefix, stats.median);
+    printf("%sMin: %.17g\n", prefix, stats.min);
+    printf("%sStddev: %.17g\n", prefix, stats.stddev);
+    printf("%sSamples:", prefix);
+    for (size_t i = 0; i < stats.samples.size(); i += 1) {
+        printf("%s%.17g", i == 0 ? " " : ",", stats.samples[i]);
+    }
+    printf("\n");
+}
+
+/* Parse a non-negative integer argument into value. Returns false if str is not a number */
+bool parseCount(std::string const& str, int &value) {
+    if (str.empty() || str.size() > 9 || str.find_first_not_of("0123456789") != std::string::npos) {
+        return false;
+    }
+    value = std::stoi(str);
+    return true;
+}
+
+/* Parse a comma separated list of positive thread counts into counts. Returns false if the list is malformed */
+bool parseThreadCounts(const char *list, std::vector<int> &counts) {
+    std::string str(list);
+    size_t start = 0;
+    while (start <= str.size()) {
+        size_t end = str.find(',', start);
+        if (end == std::string::npos) end = str.size();
+        int count;
+        if (!parseCount(str.substr(start, end - start), count) || count == 0) {
+            return false;
+        }
+        counts.push_back(count);
+        start = end + 1;
+    }
+    return true;
+}
+
 int main(int argc, char **argv) {
 
     /* initialize settings from arguments */
-    if (argc > 2) {
-        printf("Usage: %s <?num_threads>\n", argv[0]);
+    int num_threads = 1;
+    bool skipBest = false, bestOnly = false;
+    bool hasNumThreads = false;
+    std::vector<int> sweepThreads;
+    bool badArgs = false;
+    for (int i = 1; i < argc; i += 1) {
+        if (strcmp(argv[i], "--skip-best") == 0) {
+            skipBest = true;
+        } else if (strcmp(argv[i], "--best-only") == 0) {
+            bestOnly = true;
+        } else if (strcmp(argv[i], "--sweep") == 0) {
+            if (i + 1 == argc || !parseThreadCounts(argv[++i], sweepThreads)) {
+                badArgs = true;
+            }
+        } else if (!hasNumThreads && parseCount(argv[i], num_threads)) {
+            hasNumThreads = true;
+        } else {
+            badArgs = true;
+        }
+    }
+    if (badArgs || (skipBest && bestOnly)) {
+        printf("Usage: %s [--skip-best | --best-only] [--sweep <n1,n2,...>] <?num_threads>\n", argv[0]);
         exit(1);
     }
 
-    const int NITER = 5;
-    int num_threads = 1;
-    if (argc > 1) {
-        num_threads = std::stoi(std::string(argv[1]));
-    }
-    omp_set_num_threads(num_threads);
+    /* validate with the most threads that will be used */
+    int validationThreads = num_threads;
+    for (int n : sweepThreads) validationThreads = std::max(validationThreads, n);
+    omp_set_num_threads(validationThreads);
 
     /* initialize */
     Context *ctx = init();
 
-    /* validate */
-    const bool isValid = validate(ctx);
-    printf("Validation: %s\n", isValid ? "PASS" : "FAIL");
-    if (!isValid) {
-        destroy(ctx);
-        return 0;
+    if (!bestOnly) {
+        /* validate */
+        const bool isValid = validate(ctx);
+        printf("Validation: %s\n", isValid ? "PASS" : "FAIL");
+        if (!isValid) {
+            destroy(ctx);
+            return 0;
+        }
+
+        if (sweepThreads.empty()) {
+            /* benchmark */
+            omp_set_num_threads(num_threads);
+            const TimingStats stats = benchmark(compute, ctx);
+            // printf("Time: %.*f\n", DBL_DIG-1, stats.mean);
+            printf("Time: %.17g\n", stats.mean);
+            printStats("Time", stats);
+        } else {
+            /* benchmark each thread count on the same inputs */
+            for (int n : sweepThreads) {
+                omp_set_num_threads(n);
+                const TimingStats stats = benchmark(compute, ctx);
+                printf("Scaling: %d %.17g %.17g %.17g %.17g\n", n, stats.mean, stats.median, stats.min, stats.stddev);
+                printf("ScalingSamples: %d", n);
+                for (size_t i = 0; i < stats.samples.size(); i += 1) {
+                    printf("%s%.17g", i == 0 ? " " : ",", stats.samples[i]);
+                }
+                printf("\n");
+            }
+        }
     }
 
-    /* benchmark */
-    double totalTime = 0.0;
-    for (int i = 0; i < NITER; i += 1) {
-        double start = omp_get_wtime();
-        compute(ctx);
-        totalTime += omp_get_wtime() - start;
-    
-        reset(ctx);
+    if (skipBest) {
+        destroy(ctx);
+        return 0;
     }
-    // printf("Time: %.*f\n", DBL_DIG-1, totalTime / NITER);
-    printf("Time: %.17g\n", totalTime / NITER);
 
     /* benchmark best */
-    totalTime = 0.0;
-    for (int i = 0; i < NITER; i += 1) {
-        double start = omp_get_wtime();
-        best(ctx);
-        totalTime += omp_get_wtime() - start;
-
-        reset(ctx);
-    }
-    printf("BestSequential: %.*f\n", DBL_DIG-1, totalTime / NITER);
+    const TimingStats bestStats = benchmark(best, ctx);
+    printf("BestSequential: %.*f\n", DBL_DIG-1, bestStats.mean);
+    printStats("BestSequential", bestStats);
 
     /* cleanup */
     destroy(ctx);
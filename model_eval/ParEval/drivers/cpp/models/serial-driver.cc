@@ -10,11 +10,43 @@
 *
 * These functions are defined in the driver for the given benchmark and handle
 * the data and calling the generated code.
+*
+* Usage: driver [--skip-best | --best-only] <?niter>
+*   --skip-best -- do not time best(), used when the sequential baseline is already known
+*   --best-only -- only time best(), used to record the sequential baseline
+*   niter       -- run exactly niter timed iterations instead of timing adaptively
+*
+* Each benchmarked function is run once as a warm-up and then repeated until the
+* 95% confidence interval of the mean is within BENCHMARK_TARGET_CI of the mean,
+* BENCHMARK_MAX_ITER runs were made or BENCHMARK_TIME_BUDGET seconds have passed.
+* A warm-up that takes longer than the budget is used as the only sample.
 */
+#include <algorithm>
 #include <chrono>
+#include <cmath>
 #include <cstdio>
+#include <cstring>
 #include <string>
 #include <cfloat>
+#include <vector>
+
+#if !defined(BENCHMARK_MIN_ITER)
+#define BENCHMARK_MIN_ITER 3
+#endif
+
+#if !defined(BENCHMARK_MAX_ITER)
+#define BENCHMARK_MAX_ITER 50
+#endif
+
+#if !defined(BENCHMARK_TIME_BUDGET)
+// seconds spent on timing a single function, including the warm-up and resets
+#define BENCHMARK_TIME_BUDGET 10.0
+#endif
+
+#if !defined(BENCHMARK_TARGET_CI)
+// target half-width of the 95% confidence interval, relative to the mean
+#define BENCHMARK_TARGET_CI 0.02
+#endif
 
 class Context;
 extern "C++" {
@@ -28,53 +60,142 @@ extern "C++" {
     void destroy(Context *ctx);
 }
 
+double wtime() {
+    return std::chrono::duration_cast<std::chrono::duration<double>>(std::chrono::steady_clock::now().time_since_epoch()).count();
+}
+
+struct TimingStats {
+    std::vector<double> samples;
+    double mean, median, min, stddev;
+};
+
+/* Time fn(ctx) adaptively, or exactly fixedIter times if fixedIter > 0. reset(ctx) is called after every run. */
+TimingStats benchmark(void (*fn)(Context *), Context *ctx, int fixedIter) {
+    TimingStats stats;
+    const size_t minIter = fixedIter > 0 ? fixedIter : BENCHMARK_MIN_ITER;
+    const size_t maxIter = fixedIter > 0 ? fixedIter : BENCHMARK_MAX_ITER;
+    const double budget = fixedIter > 0 ? DBL_MAX : BENCHMARK_TIME_BUDGET;
+    const double budgetStart = wtime();
+
+    /* warm-up */
+    double start = wtime();
+    fn(ctx);
+    const double warmupTime = wtime() - start;
+    reset(ctx);
+    if (warmupTime >= budget) {
+        stats.samples.push_back(warmupTime);
+    }
+
+    while (stats.samples.size() < maxIter) {
+        const size_t n = stats.samples.size();
+        if (n >= minIter) {
+            double mean = 0.0, var = 0.0;
+            for (double t : stats.samples) mean += t;
+            mean /= n;
+            for (double t : stats.samples) var += (t - mean) * (t - mean);
+            var /= (n - 1);
+            const bool ciReached = 1.96 * std::sqrt(var / n) <= BENCHMARK_TARGET_CI * mean;
+            const bool budgetSpent = wtime() - budgetStart >= budget;
+            if (ciReached || budgetSpent) {
+                break;
+            }
+        } else if (n > 0 && wtime() - budgetStart >= budget) {
+            break;
+        }
+
+        start = wtime();
+        fn(ctx);
+        stats.samples.push_back(wtime() - start);
+        reset(ctx);
+    }
+
+    const size_t n = stats.samples.size();
+    std::vector<double> sorted(stats.samples);
+    std::sort(sorted.begin(), sorted.end());
+    stats.mean = 0.0;
+    for (double t : sorted) stats.mean += t;
+    stats.mean /= n;
+    stats.median = (n % 2 == 1) ? sorted[n / 2] : 0.5 * (sorted[n / 2 - 1] + sorted[n / 2]);
+    stats.min = sorted[0];
+    stats.stddev = 0.0;
+    if (n > 1) {
+        for (double t : sorted) stats.stddev += (t - stats.mean) * (t - stats.mean);
+        stats.stddev = std::sqrt(stats.stddev / (n - 1));
+    }
+    return stats;
+}
+
+/* Print <prefix>Median, <prefix>Min, <prefix>Stddev and <prefix>Samples lines */
+void printStats(const char *prefix, TimingStats const& stats) {
+    printf("%sMedian: %.17g\n", prefix, stats.median);
+    printf("%sMin: %.17g\n", prefix, stats.min);
+    printf("%sStddev: %.17g\n", prefix, stats.stddev);
+    printf("%sSamples:", prefix);
+    for (size_t i = 0; i < stats.samples.size(); i += 1) {
+        printf("%s%.17g", i == 0 ? " " : ",", stats.samples[i]);
+    }
+    printf("\n");
+}
+
+/* Parse a non-negative integer argument into value. Returns false if str is not a number */
+bool parseCount(std::string const& str, int &value) {
+    if (str.empty() || str.size() > 9 || str.find_first_not_of("0123456789") != std::string::npos) {
+        return false;
+    }
+    value = std::stoi(str);
+    return true;
+}
+
 int main(int argc, char **argv) {
 
     /* initialize settings from arguments */
-    if (argc > 2) {
-        printf("Usage: %s <?niter>\n", argv[0]);
-        exit(1);
+    int NITER = 0;
+    bool skipBest = false, bestOnly = false;
+    bool hasNiter = false;
+    for (int i = 1; i < argc; i += 1) {
+        if (strcmp(argv[i], "--skip-best") == 0) {
+            skipBest = true;
+        } else if (strcmp(argv[i], "--best-only") == 0) {
+            bestOnly = true;
+        } else if (!hasNiter && parseCount(argv[i], NITER)) {
+            hasNiter = true;
+        } else {
+            printf("Usage: %s [--skip-best | --best-only] <?niter>\n", argv[0]);
+            exit(1);
+        }
     }
-
-    int NITER = 5;
-    if (argc > 1) {
-        NITER = std::stoi(std::string(argv[1]));
+    if (skipBest && bestOnly) {
+        printf("Usage: %s [--skip-best | --best-only] <?niter>\n", argv[0]);
+        exit(1);
     }
 
     /* initialize */
     Context *ctx = init();
 
-    /* validate */
-    const bool isValid = validate(ctx);
-    printf("Validation: %s\n", isValid ? "PASS" : "FAIL");
-    if (!isValid) {
-        destroy(ctx);
-        return 0;
+    if (!bestOnly) {
+        /* validate */
+        const bool isValid = validate(ctx);
+        printf("Validation: %s\n", isValid ? "PASS" : "FAIL");
+        if (!isValid) {
+            destroy(ctx);
+            return 0;
+        }
+
+        /* benchmark */
+        const TimingStats stats = benchmark(compute, ctx, NITER);
+        printf("Time: %.*f\n", DBL_DIG-1, stats.mean);
+        printStats("Time", stats);
     }
 
-    /* benchmark */
-    double totalTime = 0.0;
-    for (int i = 0; i < NITER; i += 1) {
-        auto start = std::chrono::high_resolution_clock::now();
-        compute(ctx);
-        auto end = std::chrono::high_resolution_clock::now();
-        totalTime += std::chrono::duration_cast<std::chrono::duration<double>>(end - start).count();
-    
-        reset(ctx);
+    if (skipBest) {
+        destroy(ctx);
+        return 0;
     }
-    printf("Time: %.*f\n", DBL_DIG-1, totalTime / NITER);
 
     /* benchmark best */
-    totalTime = 0.0;
-    for (int i = 0; i < NITER; i += 1) {
-        auto start = std::chrono::high_resolution_clock::now();
-        best(ctx);
-        auto end = std::chrono::high_resolution_clock::now();
-        totalTime += std::chrono::duration_cast<std::chrono::duration<double>>(end - start).count();
-
-        reset(ctx);
-    }
-    printf("BestSequential: %.*f\n", DBL_DIG-1, totalTime / NITER);
+    const TimingStats bestStats = benchmark(best, ctx, NITER);
+    printf("BestSequential: %.*f\n", DBL_DIG-1, bestStats.mean);
+    printStats("BestSequential", bestStats);
 
     /* cleanup */
     destroy(ctx);
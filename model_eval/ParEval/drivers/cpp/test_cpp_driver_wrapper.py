@@ -0,0 +1,98 @@
+""" Tests for the build cache of cpp_driver_wrapper.py. Run with `python -m pytest` from the drivers directory.
+"""
+# std imports
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+
+# tpl imports
+import pytest
+
+# local imports
+from cpp.cpp_driver_wrapper import BuildCache, CppDriverWrapper, PCH_PREFIXES
+
+FLAGS = "-std=c++17 -O2"
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return BuildCache(str(tmp_path / "cache"))
+
+
+def write_tu(directory, generated_code: str, helper: str = "inline int helper() { return 1; }\n"):
+    ''' A benchmark-like translation unit: a driver that includes a shared header and the generated code. '''
+    os.makedirs(directory / "include", exist_ok=True)
+    os.makedirs(directory / "scratch", exist_ok=True)
+    (directory / "include" / "helper.hpp").write_text(helper)
+    (directory / "scratch" / "generated-code.hpp").write_text(generated_code)
+    (directory / "driver.cc").write_text('#include <vector>\n#include <helper.hpp>\n#include "generated-code.hpp"\n'
+                                         'int main() { return helper() + f() - 2; }\n')
+    return f"{FLAGS} -I{directory / 'include'} -I{directory / 'scratch'}", str(directory / "driver.cc")
+
+
+def test_object_key_ignores_scratch_directory(cache, tmp_path):
+    first = write_tu(tmp_path / "a", "int f() { return 1; }\n")
+    second = write_tu(tmp_path / "b", "int f() { return 1; }\n")
+    assert cache.object_path("g++", *first) == cache.object_path("g++", *second)
+
+
+def test_object_key_covers_sources_headers_and_flags(cache, tmp_path):
+    flags, source = write_tu(tmp_path / "a", "int f() { return 1; }\n")
+    key = cache.object_path("g++", flags, source)
+    assert cache.object_path("g++", flags + " -DNDEBUG", source) != key
+    assert cache.object_path("g++", *write_tu(tmp_path / "b", "int f() { return 2; }\n")) != key
+    assert cache.object_path("g++", *write_tu(tmp_path / "c", "int f() { return 1; }\n", helper="inline int helper() { return 2; }\n")) != key
+
+
+def test_local_includes_skips_system_headers(tmp_path):
+    flags, source = write_tu(tmp_path, "int f() { return 1; }\n")
+    names = [name for name, _ in BuildCache.local_includes(source, [str(tmp_path / "include"), str(tmp_path / "scratch")])]
+    assert names == ["driver.cc", "helper.hpp", "generated-code.hpp"]
+
+
+def test_lookups_are_counted_across_threads(cache):
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(cache.record, [i % 2 == 0 for i in range(4000)]))
+    assert (cache.hits, cache.misses) == (2000, 2000)
+
+
+def test_serial_prefix_does_not_include_openmp():
+    assert "omp.h" not in PCH_PREFIXES["serial"]
+    assert "omp.h" in PCH_PREFIXES["omp"]
+
+
+@pytest.mark.skipif(shutil.which("g++") is None, reason="needs g++")
+def test_compile_reuses_cached_objects(tmp_path):
+    launch_configs = {"serial": {"format": "{exec_path} {args}", "params": [{}]}}
+    driver = CppDriverWrapper(build_cache_dir=str(tmp_path / "cache"), launch_configs=launch_configs, code_opt=False)
+    for name in ["a", "b"]:
+        flags, source = write_tu(tmp_path / name, "int f() { return 1; }\n")
+        include_flags = flags[len(FLAGS):]
+        build = driver.compile_with_cache(source, output_path=str(tmp_path / name / "a.out"), CXX="g++",
+                                          CXXFLAGS=FLAGS, extra_flags=include_flags)
+        assert build.did_build, build.stderr
+    assert (driver.build_cache.hits, driver.build_cache.misses) == (1, 1)
+
+
+@pytest.mark.skipif(shutil.which("g++") is None, reason="needs g++")
+def test_pch_failures_are_only_remembered_by_this_process(tmp_path):
+    header = tmp_path / "prefix.hpp"
+    header.write_text("#error broken\n")
+    prefix = f'#include "{header}"\n'
+    first = BuildCache(str(tmp_path / "cache"))
+    assert first.precompiled_header("g++", FLAGS, prefix) is None
+    header.write_text("#include <vector>\n")
+    assert first.precompiled_header("g++", FLAGS, prefix) is None
+    # a later run tries again
+    assert BuildCache(str(tmp_path / "cache")).precompiled_header("g++", FLAGS, prefix) is not None
+    assert not any(name.endswith(".tmp") for _, _, names in os.walk(tmp_path / "cache") for name in names)
+
+
+def test_pch_timeout_removes_the_partial_header(cache, tmp_path):
+    # writes its output file, then hangs
+    compiler = tmp_path / "slow-cxx"
+    compiler.write_text('#!/bin/sh\nif [ "$1" = --version ]; then echo slow; exit 0; fi\n'
+                        'for arg; do out=$arg; done\necho partial > "$out"\nexec sleep 10\n')
+    compiler.chmod(0o755)
+    assert cache.precompiled_header(str(compiler), FLAGS, "#include <vector>\n", timeout=1) is None
+    assert not any(name.endswith((".tmp", ".gch")) for _, _, names in os.walk(cache.cache_dir) for name in names)
@@ -7,6 +7,18 @@
 #include <complex>
 #include <queue>
 #include <type_traits>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <cstdint>
+#include <functional>
+#include <utility>
+#include <vector>
+
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
 
 #include <xoshiro.h>
 #include <omp.h>
@@ -256,6 +268,185 @@ void fillRandomUndirectedGraph_(std::vector<int> &A, size_t N) {
     }
 }
 
+#define SNAPSHOT_STR_(x) #x
+#define SNAPSHOT_STR(x) SNAPSHOT_STR_(x)
+
+/* Part of every seed file key. Bump it when the random generators change in a way the modification times of the
+   benchmark and this file do not show, e.g. an edit to xoshiro.h or a new seed file layout. */
+#define SNAPSHOT_VERSION 1
+
+/* Snapshot of the inputs of a benchmark.
+   reset() used to regenerate random inputs between every timed iteration. Instead, the first call to restore()
+   runs the generator and keeps a copy of the given objects; later calls memcpy the copy back. If the
+   PAREVAL_SNAPSHOT_DIR environment variable is set, the first generated inputs are also written to a seed file
+   in that directory and later processes benchmarking the same problem mmap the file instead of generating.
+   Objects can be std::vectors of trivially copyable types or trivially copyable values. Vectors must already
+   have their final size.
+
+   Usage:
+     void reset(Context *ctx) {
+         ctx->snapshot.restore([&] { generate(ctx); }, ctx->A, ctx->x);
+     }
+*/
+class InputSnapshot {
+public:
+    InputSnapshot() = default;
+    InputSnapshot(InputSnapshot const&) = delete;
+    InputSnapshot &operator=(InputSnapshot const&) = delete;
+
+    ~InputSnapshot() {
+        if (mapped_ != nullptr) {
+            munmap(mapped_, mappedSize_);
+        }
+    }
+
+    template <typename Generator, typename... Objects>
+    void restore(Generator &&generate, Objects&... objects) {
+        std::vector<std::pair<void*, size_t>> regions = {snapshotRegion(objects)...};
+
+        if (data_ == nullptr) {
+            const std::string seedPath = seedFilePath(regions);
+            if (seedPath.empty() || !load(seedPath, regions)) {
+                generate();
+                capture(regions);
+                if (!seedPath.empty()) {
+                    save(seedPath);
+                }
+                return;
+            }
+        }
+
+        assert(regions.size() == sizes_.size());
+        const char *src = data_;
+        for (size_t i = 0; i < regions.size(); i += 1) {
+            assert(regions[i].second == sizes_[i]);
+            std::memcpy(regions[i].first, src, regions[i].second);
+            src += regions[i].second;
+        }
+    }
+
+private:
+    static constexpr uint64_t MAGIC = 0x70617265766c736eULL;
+
+    std::vector<char> buffer_;
+    std::vector<size_t> sizes_;
+    const char *data_ = nullptr;
+    void *mapped_ = nullptr;
+    size_t mappedSize_ = 0;
+
+    template <typename T>
+    static std::pair<void*, size_t> snapshotRegion(std::vector<T> &vec) {
+        static_assert(std::is_trivially_copyable_v<T>, "InputSnapshot can only copy vectors of trivially copyable types");
+        return {vec.data(), vec.size() * sizeof(T)};
+    }
+
+    template <typename T>
+    static std::pair<void*, size_t> snapshotRegion(T &val) {
+        static_assert(std::is_trivially_copyable_v<T>, "InputSnapshot can only copy trivially copyable types");
+        return {&val, sizeof(T)};
+    }
+
+    /* Seed files are keyed on SNAPSHOT_VERSION, the benchmark source and the modification times of it and of this
+       file, the problem size and the input sizes, so editing a benchmark or the shared generators in this file
+       invalidates the seeds. Returns "" if seeds should not be used.
+       Seeds are not used with MPI: generators broadcast from rank 0, so every rank has to generate if any does. */
+    static std::string seedFilePath(std::vector<std::pair<void*, size_t>> const& regions) {
+#if defined(USE_MPI) || defined(USE_MPI_OMP)
+        const char *dir = nullptr;
+#else
+        const char *dir = std::getenv("PAREVAL_SNAPSHOT_DIR");
+#endif
+        struct stat sourceStat, utilitiesStat;
+        if (dir == nullptr || *dir == '\0' || stat(__BASE_FILE__, &sourceStat) != 0 || stat(__FILE__, &utilitiesStat) != 0) {
+            return "";
+        }
+
+        std::string key = std::to_string(SNAPSHOT_VERSION) + "|" + std::string(__BASE_FILE__) + "|" + std::to_string(sourceStat.st_mtime) + "|" +
+            std::to_string(utilitiesStat.st_mtime) + "|" + SNAPSHOT_STR(DRIVER_PROBLEM_SIZE);
+        for (auto const& region : regions) {
+            key += "|" + std::to_string(region.second);
+        }
+        return std::string(dir) + "/" + std::to_string(std::hash<std::string>{}(key)) + ".seed";
+    }
+
+    void capture(std::vector<std::pair<void*, size_t>> const& regions) {
+        size_t total = 0;
+        for (auto const& region : regions) {
+            sizes_.push_back(region.second);
+            total += region.second;
+        }
+
+        buffer_.resize(total);
+        char *dst = buffer_.data();
+        for (auto const& region : regions) {
+            std::memcpy(dst, region.first, region.second);
+            dst += region.second;
+        }
+        data_ = buffer_.data();
+    }
+
+    /* Map an existing seed file. The header is the magic number, the number of regions and their sizes. */
+    bool load(std::string const& path, std::vector<std::pair<void*, size_t>> const& regions) {
+        const int fd = open(path.c_str(), O_RDONLY);
+        if (fd < 0) {
+            return false;
+        }
+
+        struct stat fileStat;
+        void *mapped = MAP_FAILED;
+        if (fstat(fd, &fileStat) == 0 && fileStat.st_size > 0) {
+            mapped = mmap(nullptr, fileStat.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+        }
+        close(fd);
+        if (mapped == MAP_FAILED) {
+            return false;
+        }
+
+        const size_t headerSize = (2 + regions.size()) * sizeof(uint64_t);
+        size_t total = 0;
+        for (auto const& region : regions) {
+            total += region.second;
+        }
+
+        const uint64_t *header = static_cast<const uint64_t*>(mapped);
+        bool matches = (size_t)fileStat.st_size == headerSize + total && header[0] == MAGIC && header[1] == regions.size();
+        for (size_t i = 0; matches && i < regions.size(); i += 1) {
+            matches = header[2 + i] == regions[i].second;
+        }
+        if (!matches) {
+            munmap(mapped, fileStat.st_size);
+            return false;
+        }
+
+        for (auto const& region : regions) {
+            sizes_.push_back(region.second);
+        }
+        mapped_ = mapped;
+        mappedSize_ = fileStat.st_size;
+        data_ = static_cast<const char*>(mapped) + headerSize;
+        return true;
+    }
+
+    /* Write the captured inputs to a seed file. Written to a temporary file first so concurrent benchmarks
+       never map a partial seed. Failures are ignored since the seed file is only an optimization. */
+    void save(std::string const& path) const {
+        const std::string tmpPath = path + ".tmp." + std::to_string(getpid());
+        FILE *fp = std::fopen(tmpPath.c_str(), "wb");
+        if (fp == nullptr) {
+            return;
+        }
+
+        std::vector<uint64_t> header = {MAGIC, sizes_.size()};
+        header.insert(header.end(), sizes_.begin(), sizes_.end());
+        bool ok = std::fwrite(header.data(), sizeof(uint64_t), header.size(), fp) == header.size();
+        ok = ok && std::fwrite(buffer_.data(), 1, buffer_.size(), fp) == buffer_.size();
+        ok = (std::fclose(fp) == 0) && ok;
+        if (!ok || std::rename(tmpPath.c_str(), path.c_str()) != 0) {
+            std::remove(tmpPath.c_str());
+        }
+    }
+};
+
 void fillRandDirectedGraph_(std::vector<int> &A, size_t N) {
     #pragma omp parallel for num_threads(NUM_THREADS_SETUP)
     for (int i = 0; i < N; i += 1) {
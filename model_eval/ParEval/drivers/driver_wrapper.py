@@ -41,7 +41,9 @@ class RunOutput:
         self.stdout = stdout
         self.stderr = stderr
         self.config = config
-        self.is_valid, self.runtime, self.best_sequential_runtime = self._parse_output(stdout)
+        (self.is_valid, self.runtime, self.best_sequential_runtime, self.runtime_median, self.runtime_min,
+            self.runtime_stddev, self.runtime_samples) = self._parse_output(stdout)
+        self.scaling = self._parse_scaling(stdout)
         if self.is_valid and self.runtime == 0:
             logging.warning(f"Runtime is 0 for run with config {self.config}. Try increasing the problem size.")
         if self.is_valid and self.best_sequential_runtime == 0:
@@ -52,25 +54,108 @@ class RunOutput:
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}(exit_code={self.exit_code}, is_valid={self.is_valid}, runtime={self.runtime}, best_sequential_runtime={self.best_sequential_runtime}, config={self.config})"
 
-    def _parse_output(self, output: str) -> Tuple[Optional[bool], Optional[float], Optional[float]]:
+    def _parse_output(self, output: str) -> Tuple[Optional[bool], Optional[float], Optional[float], Optional[float], Optional[float], Optional[float], Optional[List[float]]]:
         """ Parse the output of a single run. 
-            Output should have two lines:
-                Time: <runtime>
+            Output should have the lines:
+                Time: <mean runtime>
+                TimeMedian: <runtime>
+                TimeMin: <runtime>
+                TimeStddev: <runtime>
+                TimeSamples: <runtime>,<runtime>,...
                 BestSequential: <runtime>
                 Validation: <PASS|FAIL>
-            This returns a tuple of (validation, runtime, best_sequential_runtime)
+            This returns a tuple of (validation, runtime, best_sequential_runtime, runtime_median, runtime_min,
+            runtime_stddev, runtime_samples)
         """
         validation, runtime, best_sequential_runtime = None, None, None
+        runtime_median, runtime_min, runtime_stddev, runtime_samples = None, None, None, None
         lines = output.split("\n")
         for line in lines:
             if line.startswith("Time:"):
                 runtime = float(line.split(":")[1].strip())
+            elif line.startswith("TimeMedian:"):
+                runtime_median = float(line.split(":")[1].strip())
+            elif line.startswith("TimeMin:"):
+                runtime_min = float(line.split(":")[1].strip())
+            elif line.startswith("TimeStddev:"):
+                runtime_stddev = float(line.split(":")[1].strip())
+            elif line.startswith("TimeSamples:"):
+                runtime_samples = [float(t) for t in line.split(":")[1].strip().split(",") if t.strip()]
             elif line.startswith("Validation:"):
                 validation = line.split(":")[1].strip() == "PASS"
             elif line.startswith("BestSequential:"):
                 best_sequential_runtime = float(line.split(":")[1].strip())
 
-        return validation, runtime, best_sequential_runtime
+        return validation, runtime, best_sequential_runtime, runtime_median, runtime_min, runtime_stddev, runtime_samples
+
+    def _parse_scaling(self, output: str) -> List[dict]:
+        """ Parse the thread-scaling sweep lines of a single run.
+            Output should have a pair of lines per thread count:
+                Scaling: <num_threads> <mean> <median> <min> <stddev>
+                ScalingSamples: <num_threads> <runtime>,<runtime>,...
+            This returns one dict per thread count, in the order they were run. Empty if the run was not a sweep.
+        """
+        scaling, samples = [], {}
+        for line in output.split("\n"):
+            if line.startswith("Scaling:"):
+                num_threads, mean, median, min, stddev = line.split(":")[1].split()
+                scaling.append({
+                    "num_threads": int(num_threads),
+                    "runtime": float(mean),
+                    "runtime_median": float(median),
+                    "runtime_min": float(min),
+                    "runtime_stddev": float(stddev),
+                })
+            elif line.startswith("ScalingSamples:"):
+                num_threads, _, times = line.split(":")[1].strip().partition(" ")
+                samples[int(num_threads)] = [float(t) for t in times.split(",") if t.strip()]
+
+        for point in scaling:
+            point["runtime_samples"] = samples.get(point["num_threads"])
+        return scaling
+
+    def split_scaling(self) -> List["RunOutput"]:
+        """ Expand a thread-scaling sweep into one RunOutput per thread count, as if each count had been
+            launched separately. Returns [self] if this run was not a sweep.
+        """
+        if not self.scaling:
+            return [self]
+
+        runs = []
+        for point in self.scaling:
+            run = RunOutput(self.exit_code, self.stdout, self.stderr, config={**self.config, "num_threads": point["num_threads"]})
+            run.runtime = point["runtime"]
+            run.runtime_median = point["runtime_median"]
+            run.runtime_min = point["runtime_min"]
+            run.runtime_stddev = point["runtime_stddev"]
+            run.runtime_samples = point["runtime_samples"]
+            run.scaling = []
+            runs.append(run)
+        return runs
+
+
+class BuiltOutput:
+    """ A generated output that has been written and compiled, but not yet run. """
+    prompt: str
+    output: str
+    source_write_success: bool
+    build_output: BuildOutput
+    exec_path: PathLike
+
+    def __init__(self, scratch, prompt: str, output: str, source_write_success: bool, build_output: BuildOutput, exec_path: PathLike):
+        self.scratch = scratch
+        self.prompt = prompt
+        self.output = output
+        self.source_write_success = source_write_success
+        self.build_output = build_output
+        self.exec_path = exec_path
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(did_build={self.build_output.did_build}, exec_path={self.exec_path})"
+
+    def cleanup(self):
+        """ Remove the scratch directory holding the executable. """
+        self.scratch.cleanup()
 
 
 class GeneratedTextResult:
@@ -117,6 +202,29 @@ class GeneratedTextResult:
         else:
             return None
 
+    def scaling_curve(self) -> Optional[List[dict]]:
+        """ Return the strong-scaling curve as a list of points sorted by thread count. Each point has the
+            runtime statistics of that thread count and its speedup over the best sequential runtime.
+            Returns None if no valid run recorded a thread count.
+        """
+        if not self.did_any_run():
+            return None
+
+        baseline = self.best_sequential_runtime()
+        curve = []
+        for r in self.run_outputs:
+            if not r.is_valid or r.runtime is None or "num_threads" not in r.config:
+                continue
+            curve.append({
+                "num_threads": r.config["num_threads"],
+                "runtime": r.runtime,
+                "runtime_median": r.runtime_median,
+                "runtime_min": r.runtime_min,
+                "runtime_stddev": r.runtime_stddev,
+                "speedup": baseline / r.runtime if baseline is not None and r.runtime > 0 else None,
+            })
+        return sorted(curve, key=lambda p: p["num_threads"]) or None
+
 
 """ LANGUAGE EXTENSIONS """
 LANGUAGE_EXTENSIONS = {
@@ -137,6 +245,13 @@ DRIVER_MAP = {
     "hip": "gpu"
 }
 
+""" Benchmark modes, mapped to the arguments passed to the model driver """
+BENCHMARK_MODES = {
+    "all": "",                  # validate and time the generated code, then time best()
+    "skip-best": "--skip-best", # the sequential baseline is already known, do not time best()
+    "best-only": "--best-only", # only time best() to record the sequential baseline
+}
+
 """ Validators """
 VALIDATORS = {
     "serial": EmptyValidator(),
@@ -161,6 +276,8 @@ class DriverWrapper(ABC):
     display_build_errors: bool
     display_runs: bool
     early_exit_runs: bool
+    benchmark_mode: str
+    thread_sweep: bool
     dry: bool
 
     def __init__(
@@ -174,6 +291,8 @@ class DriverWrapper(ABC):
         display_build_errors: bool = False,
         display_runs: bool = False,
         early_exit_runs: bool = False,
+        benchmark_mode: str = "all",
+        thread_sweep: bool = False,
         dry: bool = False,
         code_opt: bool = True
     ):
@@ -194,6 +313,9 @@ class DriverWrapper(ABC):
         self.display_build_errors = display_build_errors
         self.display_runs = display_runs
         self.early_exit_runs = early_exit_runs
+        assert benchmark_mode in BENCHMARK_MODES, f"Unknown benchmark mode {benchmark_mode}"
+        self.benchmark_mode = benchmark_mode
+        self.thread_sweep = thread_sweep
         self.dry = dry
 
     def __repr__(self) -> str:
@@ -210,17 +332,54 @@ class DriverWrapper(ABC):
         pass
 
     @abstractmethod
-    def run(self, executable: PathLike) -> RunOutput:
+    def run(self, executable: PathLike, benchmark_mode: Optional[str] = None) -> RunOutput:
         """ Run the given executable. """
         pass
 
     @abstractmethod
-    def test_single_output(self, prompt: str, output: str, test_driver_file: PathLike) -> GeneratedTextResult:
-        """ Run a single generated output. """
+    def build_single_output(self, prompt: str, output: str, test_driver_file: PathLike, problem_size: str) -> BuiltOutput:
+        """ Write and compile a single generated output without running it. """
         pass
 
-    def test_all_outputs_in_prompt(self, prompt: dict) -> dict:
-        """ Run all the generated outputs in the given prompt. """
+    @abstractmethod
+    def run_built_output(self, built: BuiltOutput, benchmark_mode: Optional[str] = None) -> GeneratedTextResult:
+        """ Run an output compiled by build_single_output. """
+        pass
+
+    @abstractmethod
+    def test_single_output(self, prompt: str, output: str, test_driver_file: PathLike, problem_size: str, benchmark_mode: Optional[str] = None) -> GeneratedTextResult:
+        """ Run a single generated output. benchmark_mode defaults to self.benchmark_mode. """
+        pass
+
+    def summarize_output(self, generated_output: str, results: GeneratedTextResult) -> dict:
+        """ Convert the result of a single output into the dict stored in the results json. """
+        return {
+            "generated_output": generated_output,
+            "source_write_success": results.source_write_success,
+            "did_build": results.did_build(),
+            "is_source_valid": self.validator.validate(generated_output),
+            "did_any_run": results.did_any_run(),
+            "did_all_run": results.did_all_run(),
+            "are_any_valid": results.are_any_valid(),
+            "are_all_valid": results.are_all_valid(),
+            "best_sequential_runtime": results.best_sequential_runtime(),
+            "scaling": results.scaling_curve(),
+            "runs": [
+                {
+                    "did_run": r.exit_code == 0,
+                    "is_valid": r.is_valid,
+                    "runtime": r.runtime,
+                    "runtime_median": r.runtime_median,
+                    "runtime_min": r.runtime_min,
+                    "runtime_stddev": r.runtime_stddev,
+                    "runtime_samples": r.runtime_samples,
+                    **r.config
+                } for r in results.run_outputs
+            ] if results.run_outputs is not None else None
+        }
+
+    def get_test_driver_file(self, prompt: dict) -> str:
+        """ Return the benchmark driver source for the given prompt. """
         root = prompt["language"]
         type = prompt["problem_type"]
         name = prompt["name"]
@@ -229,34 +388,30 @@ class DriverWrapper(ABC):
             ext = ".cu"
         driver_root = f"{name}"
         driver_base = DRIVER_MAP[self.parallelism_model]
-        test_driver_file = os.path.join(root, "benchmarks", type, driver_root, driver_base + ext)
-        problem_size = self.problem_sizes.get(name, {}).get(self.parallelism_model, "(1<<18)")
+        return os.path.join(root, "benchmarks", type, driver_root, driver_base + ext)
+
+    def get_problem_size(self, prompt: dict) -> str:
+        """ Return the problem size used to benchmark the given prompt. """
+        return self.problem_sizes.get(prompt["name"], {}).get(self.parallelism_model, "(1<<18)")
+
+    def test_all_outputs_in_prompt(self, prompt: dict) -> dict:
+        """ Run all the generated outputs in the given prompt. """
+        test_driver_file = self.get_test_driver_file(prompt)
+        problem_size = self.get_problem_size(prompt)
 
         outputs = []
-        logging.info(f"Testing prompt {name} with {self}...")
+        logging.info(f"Testing prompt {prompt['name']} with {self}...")
         for generated_output in prompt["outputs"]:
             results = self.test_single_output(prompt["prompt"], generated_output, test_driver_file, problem_size)
-
-            outputs.append({
-                "generated_output": generated_output,
-                "source_write_success": results.source_write_success,
-                "did_build": results.did_build(),
-                "is_source_valid": self.validator.validate(generated_output),
-                "did_any_run": results.did_any_run(),
-                "did_all_run": results.did_all_run(),
-                "are_any_valid": results.are_any_valid(),
-                "are_all_valid": results.are_all_valid(),
-                "best_sequential_runtime": results.best_sequential_runtime(),
-                "runs": [
-                    {
-                        "did_run": r.exit_code == 0,
-                        "is_valid": r.is_valid,
-                        "runtime": r.runtime,
-                        **r.config
-                    } for r in results.run_outputs
-                ] if results.run_outputs is not None else None
-            })
+            outputs.append(self.summarize_output(generated_output, results))
         prompt["outputs"] = outputs
+        self.log_prompt_results(prompt)
+
+        return prompt
+
+    def log_prompt_results(self, prompt: dict):
+        """ Log summary statistics for a prompt whose outputs have been tested. """
+        outputs = prompt["outputs"]
 
         # log some stats
         num_outputs = len(outputs)
@@ -272,5 +427,3 @@ class DriverWrapper(ABC):
         logging.info(f"  {num_successful_runs} successful runs (all tests)")
         logging.info(f"  {num_valid_outputs} valid outputs (all tests)")
         #logging.info(f"  {mean_runtime} mean runtime")
-
-        return prompt
@@ -7,17 +7,19 @@
 from argparse import ArgumentParser
 import json
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import os
 import tempfile
-from typing import Optional
+from typing import List, Optional, Tuple
 
 # tpl imports
 from tqdm import tqdm
 
 # local imports
-from driver_wrapper import DriverWrapper
-from cpp.cpp_driver_wrapper import CppDriverWrapper
-from util import await_input, load_json
+from driver_wrapper import DriverWrapper, GeneratedTextResult
+from cpp.cpp_driver_wrapper import CppDriverWrapper, DEFAULT_BUILD_CACHE_DIR
+from util import await_input, load_json, parse_core_list, pin_to_cores, ResultJournal
 
 
 """ Map language names to driver wrappers """
@@ -38,6 +40,10 @@ def get_args():
     parser.add_argument("--dry", action="store_true", help="Dry run. Do not actually run the code snippets.")
     parser.add_argument("--overwrite", action="store_true", help="If ouputs are already in DB for a given prompt, \
         then overwrite them. Default behavior is to skip existing results.")
+    parser.add_argument("--journal", type=str, help="Append each result to this JSONL file as soon as it is known. " +
+        "Defaults to <output>.journal.jsonl.")
+    parser.add_argument("--no-journal", action="store_true", help="If provided, do not write a journal.")
+    parser.add_argument("--resume", action="store_true", help="Reuse the results in the journal and only test the remaining outputs.")
     parser.add_argument("--hide-progress", action="store_true", help="If provided, do not show progress bar.")
     model_group = parser.add_mutually_exclusive_group()
     model_group.add_argument("--exclude-models", nargs="+", type=str, choices=["serial", "omp", "mpi", "mpi+omp", "kokkos", "cuda", "hip"], 
@@ -48,6 +54,19 @@ def get_args():
     model_group.add_argument("--problem", type=str, help="Only test this probem if provided.")
     model_group.add_argument("--problem-type", type=str, help="Only test problems of this type if provided.")
     parser.add_argument("--early-exit-runs", action="store_true", help="If provided, stop evaluating a model output after the first run configuration fails.")
+    parser.add_argument("--benchmark-mode", choices=["all", "skip-best", "best-only"], default="all",
+        help="'skip-best' does not time the best sequential code, 'best-only' only times the best sequential code.")
+    parser.add_argument("--thread-sweep", action="store_true", help="If provided, time every omp thread count in the launch " +
+        "configs with a single process that initializes and validates once.")
+    parser.add_argument("--build-cache-dir", type=str, default=DEFAULT_BUILD_CACHE_DIR,
+        help="Where to keep precompiled headers and compiled objects shared between builds.")
+    parser.add_argument("--no-build-cache", action="store_true", help="If provided, compile every output from scratch.")
+    parser.add_argument("--snapshot-dir", type=str, help="If provided, benchmarks that snapshot their inputs write the generated " +
+        "inputs to seed files here and later runs of the same problem map them instead of regenerating.")
+    parser.add_argument("--build-jobs", type=int, help="Number of outputs to compile in parallel while earlier outputs are " +
+        "benchmarked. Defaults to the number of cores not used for benchmarking. 1 disables pipelining.")
+    parser.add_argument("--benchmark-cores", type=str, help="Cores to run benchmarks on, e.g. '0-7'. Compiles are pinned to " +
+        "the remaining cores. Defaults to the first N cores, where N is the largest thread count in the launch configs.")
     parser.add_argument("--build-timeout", type=int, default=30, help="Timeout in seconds for building a program.")
     parser.add_argument("--run-timeout", type=int, default=120, help="Timeout in seconds for running a program.")
     parser.add_argument("--log", choices=["INFO", "DEBUG", "WARNING", "ERROR", "CRITICAL"], default="INFO",
@@ -77,6 +96,115 @@ def already_has_results(prompt: dict) -> bool:
 
     raise ValueError(f"Prompt {prompt.get('name', 'unknown')} has invalid outputs.")
 
+def get_max_launch_threads(launch_configs: dict, models: List[str]) -> int:
+    """ Largest number of threads/ranks any launch config will use. """
+    counts = [1]
+    for model in models:
+        for params in launch_configs.get(model, {}).get("params", []):
+            counts.append(params.get("num_threads", 1) * params.get("num_procs", 1))
+    return max(counts)
+
+def get_core_sets(args, launch_configs: dict, models: List[str]) -> Tuple[Optional[set], Optional[set]]:
+    """ Split the available cores into (benchmark cores, compile cores). Returns (None, None) if the cores
+        cannot be split, in which case building and benchmarking are not overlapped.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return None, None
+    available = sorted(os.sched_getaffinity(0))
+    if args.benchmark_cores:
+        benchmark_cores = parse_core_list(args.benchmark_cores) & set(available)
+    else:
+        benchmark_cores = set(available[:get_max_launch_threads(launch_configs, models)])
+    compile_cores = set(available) - benchmark_cores
+    if len(benchmark_cores) == 0 or len(compile_cores) == 0:
+        return None, None
+    return benchmark_cores, compile_cores
+
+def write_results(data: list, output: Optional[str]):
+    """ Write the final results to the output file. """
+    if output and output != '-':
+        with open(output, "w") as fp:
+            json.dump(data, fp, indent=4)
+        logging.info(f"Wrote results to {output}.")
+    else:
+        print(json.dumps(data, indent=4))
+
+def test_prompts(prompts_to_test: List[Tuple[int, dict, DriverWrapper]], journal: ResultJournal, build_jobs: int = 1,
+                 benchmark_cores: Optional[set] = None, compile_cores: Optional[set] = None, progress: Optional[tqdm] = None):
+    """ Test every output of the given (index in data, prompt, driver) entries. Each result is appended to the
+        journal as soon as it is known, and outputs already in the journal are not tested again.
+        With build_jobs > 1, outputs are compiled on compile_cores by build_jobs workers while the main
+        thread benchmarks the compiled outputs one at a time, in order, on benchmark_cores.
+    """
+    # one job per generated output that still needs to be tested
+    jobs = []
+    remaining = []
+    tested_outputs = []
+    for idx, (prompt_idx, prompt, driver) in enumerate(prompts_to_test):
+        logging.info(f"Testing prompt {prompt['name']} with {driver}...")
+        tested_outputs.append([None] * len(prompt["outputs"]))
+        remaining.append(0)
+        for output_idx, generated_output in enumerate(prompt["outputs"]):
+            journaled = journal.get(prompt_idx, prompt["name"], output_idx, generated_output)
+            if journaled is not None:
+                tested_outputs[idx][output_idx] = journaled
+            else:
+                remaining[idx] += 1
+                jobs.append((idx, output_idx, generated_output))
+
+    def finish_prompt(idx: int):
+        _, prompt, driver = prompts_to_test[idx]
+        prompt["outputs"] = tested_outputs[idx]
+        driver.log_prompt_results(prompt)
+        if progress is not None:
+            progress.update(1)
+
+    def record_result(idx: int, output_idx: int, generated_output: str, results: GeneratedTextResult):
+        prompt_idx, prompt, driver = prompts_to_test[idx]
+        tested_outputs[idx][output_idx] = driver.summarize_output(generated_output, results)
+        journal.append(prompt_idx, prompt["name"], output_idx, generated_output, tested_outputs[idx][output_idx])
+        remaining[idx] -= 1
+        if remaining[idx] == 0:
+            finish_prompt(idx)
+
+    for idx, count in enumerate(remaining):
+        if count == 0:
+            finish_prompt(idx)
+
+    if build_jobs <= 1:
+        for idx, output_idx, generated_output in jobs:
+            _, prompt, driver = prompts_to_test[idx]
+            results = driver.test_single_output(prompt["prompt"], generated_output, driver.get_test_driver_file(prompt),
+                driver.get_problem_size(prompt))
+            record_result(idx, output_idx, generated_output, results)
+        return
+
+    # benchmarks are launched from this thread, so they inherit its affinity
+    pin_to_cores(benchmark_cores)
+    with ThreadPoolExecutor(max_workers=build_jobs, initializer=pin_to_cores, initargs=(compile_cores,)) as pool:
+        pending = deque()
+        job_iter = iter(jobs)
+
+        def fill_pipeline():
+            # only compile a bounded number of outputs ahead of the benchmarks
+            while len(pending) < 2 * build_jobs:
+                job = next(job_iter, None)
+                if job is None:
+                    return
+                idx, _, generated_output = job
+                _, prompt, driver = prompts_to_test[idx]
+                future = pool.submit(driver.build_single_output, prompt["prompt"], generated_output,
+                    driver.get_test_driver_file(prompt), driver.get_problem_size(prompt))
+                pending.append((job, future))
+
+        fill_pipeline()
+        while len(pending) > 0:
+            (idx, output_idx, generated_output), future = pending.popleft()
+            fill_pipeline()
+            _, prompt, driver = prompts_to_test[idx]
+            results = driver.run_built_output(future.result())
+            record_result(idx, output_idx, generated_output, results)
+
 def main():
     args = get_args()
 
@@ -95,6 +223,11 @@ def main():
             logging.info("Exiting.")
             return
 
+    # share generated benchmark inputs between executables
+    if args.snapshot_dir:
+        os.makedirs(args.snapshot_dir, exist_ok=True)
+        os.environ["PAREVAL_SNAPSHOT_DIR"] = os.path.abspath(args.snapshot_dir)
+
     # load in the generated text
     data = load_json(args.input_json)
     logging.info(f"Loaded {len(data)} prompts from {args.input_json}.")
@@ -112,9 +245,9 @@ def main():
     if args.exclude_models:
         models_to_test = [m for m in models_to_test if m not in args.exclude_models]
 
-    # run each prompt
-    all_prompts = data if args.hide_progress else tqdm(data, desc="Testing prompts")
-    for prompt in all_prompts:
+    # gather the prompts to run
+    prompts_to_test = []
+    for prompt_idx, prompt in enumerate(data):
         if prompt["parallelism_model"] not in models_to_test:
             logging.debug(f"Skipping prompt {prompt['name']} because it uses {prompt['parallelism_model']}.")
             continue
@@ -145,25 +278,44 @@ def main():
             display_build_errors=args.log_build_errors,
             display_runs=args.log_runs,
             early_exit_runs=args.early_exit_runs,
+            benchmark_mode=args.benchmark_mode,
+            thread_sweep=args.thread_sweep,
+            build_cache_dir=None if args.no_build_cache else args.build_cache_dir,
             build_timeout=args.build_timeout,
             run_timeout=args.run_timeout,
             code_opt = args.code_opt
         )
-        driver.test_all_outputs_in_prompt(prompt)
+        prompts_to_test.append((prompt_idx, prompt, driver))
 
-        # go ahead and write out outputs now
-        if args.output and args.output != '-':
-            with open(args.output, "w") as fp:
-                json.dump(data, fp, indent=4)
-            logging.debug(f"Wrote intermediate results to {args.output}.")
+    # overlap compiling later outputs with benchmarking earlier ones if there are spare cores to compile on
+    benchmark_cores, compile_cores = get_core_sets(args, launch_configs, models_to_test)
+    build_jobs = args.build_jobs if args.build_jobs is not None else (len(compile_cores) if compile_cores else 1)
+    if build_jobs > 1 and compile_cores is None:
+        logging.warning("No spare cores to compile on, building and benchmarking will not be overlapped.")
+        build_jobs = 1
+
+    # results are streamed to the journal as they come in, the output file is only written at the end
+    journal_path = None if args.no_journal else args.journal
+    if journal_path is None and not args.no_journal and args.output and args.output != '-':
+        journal_path = f"{args.output}.journal.jsonl"
+    if args.resume and journal_path is None:
+        raise ValueError("--resume requires --journal or --output.")
+    journal = ResultJournal(journal_path, resume=args.resume)
+    if args.resume:
+        logging.info(f"Resuming with {len(journal)} results from {journal_path}.")
+
+    # run each prompt
+    if build_jobs > 1:
+        logging.info(f"Compiling with {build_jobs} jobs on cores {sorted(compile_cores)}, benchmarking on cores {sorted(benchmark_cores)}.")
+    progress = None if args.hide_progress else tqdm(total=len(prompts_to_test), desc="Testing prompts")
+    try:
+        test_prompts(prompts_to_test, journal, build_jobs=build_jobs, benchmark_cores=benchmark_cores,
+            compile_cores=compile_cores, progress=progress)
+    finally:
+        journal.close()
 
     # write out results
-    if args.output and args.output != '-':
-        with open(args.output, "w") as fp:
-            json.dump(data, fp, indent=4)
-        logging.info(f"Wrote results to {args.output}.")
-    else:
-        print(json.dumps(data, indent=4))
+    write_results(data, args.output)
 
 if __name__ == "__main__":
     main()
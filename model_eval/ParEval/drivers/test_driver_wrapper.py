@@ -0,0 +1,76 @@
+""" Tests for the run output parsing in driver_wrapper.py. Run with `python -m pytest` from the drivers directory.
+"""
+# local imports
+from drivers.driver_wrapper import RunOutput
+
+DRIVER_OUTPUT = """Time: 0.0125
+TimeMedian: 0.012
+TimeMin: 0.0115
+TimeStddev: 0.0008
+TimeSamples: 0.0115,0.012,0.014,
+BestSequential: 0.05
+BestSequentialMin: 0.049
+BestSequentialSamples: 0.049,0.05,0.051
+Validation: PASS
+"""
+
+
+def test_run_output_parses_timing_statistics():
+    run = RunOutput(0, DRIVER_OUTPUT, "", config={"num_threads": 8})
+    assert run.is_valid is True
+    assert run.runtime == 0.0125
+    assert (run.runtime_median, run.runtime_min, run.runtime_stddev) == (0.012, 0.0115, 0.0008)
+    assert run.runtime_samples == [0.0115, 0.012, 0.014]
+    # BestSequentialMin and BestSequentialSamples do not overwrite the mean
+    assert run.best_sequential_runtime == 0.05
+    assert run.config == {"num_threads": 8}
+
+
+def test_run_output_failed_validation():
+    run = RunOutput(0, "Time: 0.01\nValidation: FAIL\n", "")
+    assert run.is_valid is False
+    assert run.runtime == 0.01
+    assert run.runtime_samples is None
+
+
+def test_run_output_without_driver_lines():
+    run = RunOutput(-1, "", "[Timeout] ")
+    assert run.is_valid is None and run.runtime is None and run.best_sequential_runtime is None
+    assert (run.runtime_median, run.runtime_min, run.runtime_stddev, run.runtime_samples) == (None, None, None, None)
+
+
+def test_run_output_warns_about_zero_runtime(caplog):
+    RunOutput(0, "Time: 0\nBestSequential: 0.01\nValidation: PASS\n", "")
+    assert "Runtime is 0" in caplog.text
+
+
+SWEEP_OUTPUT = """Scaling: 1 0.08 0.079 0.078 0.001
+ScalingSamples: 1 0.078,0.079,0.083
+Scaling: 8 0.0125 0.012 0.0115 0.0008
+ScalingSamples: 8 0.0115,0.012,0.014
+Time: 0.0125
+BestSequential: 0.05
+Validation: PASS
+"""
+
+
+def test_run_output_parses_thread_sweep():
+    run = RunOutput(0, SWEEP_OUTPUT, "", config={"num_procs": 1})
+    assert [point["num_threads"] for point in run.scaling] == [1, 8]
+    assert run.scaling[0] == {"num_threads": 1, "runtime": 0.08, "runtime_median": 0.079, "runtime_min": 0.078,
+                              "runtime_stddev": 0.001, "runtime_samples": [0.078, 0.079, 0.083]}
+
+
+def test_split_scaling_gives_one_run_per_thread_count():
+    runs = RunOutput(0, SWEEP_OUTPUT, "", config={"num_procs": 1}).split_scaling()
+    assert [run.config for run in runs] == [{"num_procs": 1, "num_threads": 1}, {"num_procs": 1, "num_threads": 8}]
+    assert [run.runtime for run in runs] == [0.08, 0.0125]
+    assert runs[1].runtime_samples == [0.0115, 0.012, 0.014]
+    # validation and the baseline are shared by every thread count
+    assert all(run.is_valid and run.best_sequential_runtime == 0.05 and run.scaling == [] for run in runs)
+
+
+def test_split_scaling_without_sweep_returns_the_run():
+    run = RunOutput(0, DRIVER_OUTPUT, "")
+    assert run.scaling == []
+    assert run.split_scaling() == [run]
@@ -0,0 +1,81 @@
+""" Tests for util.py. Run with `python -m pytest` from the drivers directory.
+"""
+# std imports
+import json
+
+# tpl imports
+import pytest
+
+# local imports
+from util import ResultJournal, parse_core_list
+
+
+def test_parse_core_list_ranges_and_single_cores():
+    assert parse_core_list("0-3,8,10-11") == {0, 1, 2, 3, 8, 10, 11}
+
+
+def test_parse_core_list_ignores_whitespace_and_empty_parts():
+    assert parse_core_list(" 4 , 6-7 ,") == {4, 6, 7}
+    assert parse_core_list("") == set()
+
+
+def test_parse_core_list_merges_overlapping_ranges():
+    assert parse_core_list("0-2,1-3,2") == {0, 1, 2, 3}
+
+
+def test_parse_core_list_rejects_malformed_parts():
+    with pytest.raises(ValueError):
+        parse_core_list("0-")
+    with pytest.raises(ValueError):
+        parse_core_list("a")
+
+
+def test_journal_results_are_reused_after_resume(tmp_path):
+    path = tmp_path / "results.journal.jsonl"
+    journal = ResultJournal(path)
+    journal.append(0, "p0", 0, "int f() {}", {"did_build": True})
+    journal.append(0, "p0", 1, "int g() {}", {"did_build": False})
+    journal.close()
+
+    resumed = ResultJournal(path, resume=True)
+    assert len(resumed) == 2
+    assert resumed.get(0, "p0", 1, "int g() {}") == {"did_build": False}
+    # a different output text at the same position is tested again
+    assert resumed.get(0, "p0", 0, "int f() { return; }") is None
+    resumed.close()
+
+
+def test_journal_without_resume_starts_over(tmp_path):
+    path = tmp_path / "results.journal.jsonl"
+    journal = ResultJournal(path)
+    journal.append(0, "p0", 0, "code", {"did_build": True})
+    journal.close()
+    restarted = ResultJournal(path)
+    assert len(restarted) == 0
+    restarted.close()
+    assert path.read_text() == ""
+
+
+def test_journal_skips_a_record_cut_off_by_an_interrupt(tmp_path):
+    path = tmp_path / "results.journal.jsonl"
+    journal = ResultJournal(path)
+    journal.append(0, "p0", 0, "a", {"did_build": True})
+    journal.close()
+    with open(path, "a") as fp:
+        fp.write('{"key": "0:p0:1:')
+
+    resumed = ResultJournal(path, resume=True)
+    assert len(resumed) == 1
+    resumed.append(0, "p0", 1, "b", {"did_build": True})
+    resumed.close()
+    lines = path.read_text().splitlines()
+    assert json.loads(lines[-1])["output_index"] == 1
+    reloaded = ResultJournal(path, resume=True)
+    assert len(reloaded) == 2
+    reloaded.close()
+
+
+def test_journal_without_path_only_keeps_results_in_memory():
+    journal = ResultJournal(None)
+    journal.append(0, "p0", 0, "a", {"did_build": True})
+    assert journal.get(0, "p0", 0, "a") == {"did_build": True}
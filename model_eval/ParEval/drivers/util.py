@@ -1,10 +1,12 @@
+import hashlib
 import json
 import logging
 from os import PathLike
 import shlex
 import subprocess
 from subprocess import CompletedProcess
-from typing import Optional
+import os
+from typing import Optional, Set, TextIO
 
 
 def all_equal(iterable) -> bool:
@@ -29,6 +31,23 @@ def mean(iterable) -> float:
         iterable = list(iterable)
     return sum(iterable) / len(iterable) if len(iterable) > 0 else 0
 
+def parse_core_list(cores: str) -> Set[int]:
+    """ Parse a core list such as '0-3,8,10-11' into a set of core ids """
+    result = set()
+    for part in cores.split(","):
+        part = part.strip()
+        if "-" in part:
+            start, end = part.split("-")
+            result.update(range(int(start), int(end) + 1))
+        elif part:
+            result.add(int(part))
+    return result
+
+def pin_to_cores(cores: Optional[Set[int]]):
+    """ Restrict the calling thread, and any processes it launches, to the given cores """
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
 def run_command(cmd: str, timeout: Optional[int] = None, dry: bool = False) -> CompletedProcess:
     """ Run the given command on the system and return the result """
     logging.debug(f"Running command: {cmd}")
@@ -37,3 +56,59 @@ def run_command(cmd: str, timeout: Optional[int] = None, dry: bool = False) -> C
     else:
         cmd = shlex.split(cmd)
         return subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+
+class ResultJournal:
+    """ Append-only JSONL log with one record per tested output, used to resume interrupted runs. """
+    fpath: Optional[PathLike]
+    records: dict
+    fp: Optional[TextIO]
+
+    def __init__(self, fpath: Optional[PathLike], resume: bool = False):
+        self.fpath = fpath
+        self.records = {}
+        self.fp = None
+        if fpath is None:
+            return
+
+        ends_with_newline = True
+        if resume and os.path.exists(fpath):
+            with open(fpath, "r") as fp:
+                for line in fp:
+                    ends_with_newline = line.endswith("\n")
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        logging.warning(f"Skipping incomplete journal record in {fpath}.")
+                        continue
+                    self.records[record["key"]] = record["result"]
+
+        self.fp = open(fpath, "a" if resume else "w")
+        if not ends_with_newline:
+            # terminate a record that was cut off when the previous run was interrupted
+            self.fp.write("\n")
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @staticmethod
+    def key(prompt_idx: int, name: str, output_idx: int, generated_output: str) -> str:
+        """ Identify an output by its position in the input and its text """
+        digest = hashlib.sha1(generated_output.encode("utf-8")).hexdigest()
+        return f"{prompt_idx}:{name}:{output_idx}:{digest}"
+
+    def get(self, prompt_idx: int, name: str, output_idx: int, generated_output: str) -> Optional[dict]:
+        """ Return the stored result for the given output, if any """
+        return self.records.get(self.key(prompt_idx, name, output_idx, generated_output))
+
+    def append(self, prompt_idx: int, name: str, output_idx: int, generated_output: str, result: dict):
+        """ Store the result of a single output """
+        key = self.key(prompt_idx, name, output_idx, generated_output)
+        self.records[key] = result
+        if self.fp is not None:
+            self.fp.write(json.dumps({"key": key, "prompt_index": prompt_idx, "output_index": output_idx, "result": result}) + "\n")
+            self.fp.flush()
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
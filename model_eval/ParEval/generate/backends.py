@@ -0,0 +1,182 @@
+""" Inference backends for generate.py and translate.py.
+    Every backend takes prompts formatted with InferenceConfig.format_prompt and returns outputs that start with
+    the prompt, like the HuggingFace pipeline does, so InferenceConfig.clean_output works the same on all of them.
+"""
+# std imports
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from typing import Iterator, List, Tuple
+
+# tpl imports
+from transformers import LogitsProcessorList, pipeline
+
+# local imports
+from utils import BalancedBracketsLogitsProcessor, InferenceConfig, PromptDataset, generate_shared_prefill, \
+    length_sorted_order, padding_efficiency, tokenized_lengths
+
+
+class GenerationBackend(ABC):
+
+    def __init__(self):
+        # completion tokens generated so far, for reporting throughput
+        self.generated_tokens = 0
+
+    @abstractmethod
+    def generate(self, prompts : List[str], num_samples : int) -> Iterator[Tuple[int, List[str]]]:
+        """ Yield (prompt index, outputs) for each prompt as soon as its `num_samples` outputs are done.
+            Prompts may finish in any order.
+        """
+        pass
+
+
+class HFPipelineBackend(GenerationBackend):
+    """ HuggingFace text-generation pipeline. Prompts of similar length are batched together (unless
+        length_sort is False) and samples stop once their function is complete (if stop_at_function_end).
+        With shared_prefill the samples of a prompt are decoded from one prefilled KV cache.
+    """
+
+    def __init__(self, model : str, inference_config : InferenceConfig, torch_dtype, device = 0, batch_size : int = 16,
+                 max_new_tokens : int = 1024, do_sample : bool = False, temperature : float = 0.2, top_p : float = 0.95,
+                 stop_at_function_end : bool = True, length_sort : bool = True, shared_prefill : bool = False):
+        super().__init__()
+        self.inference_config = inference_config
+        self.batch_size = batch_size
+        self.length_sort = length_sort
+        self.shared_prefill = shared_prefill
+        self.generator = pipeline(task="text-generation", model=model, torch_dtype=torch_dtype, device=device,
+                                  trust_remote_code=inference_config.trust_remote_code(), model_kwargs={"use_cache" : True})
+        inference_config.init_padding(self.generator.tokenizer)
+
+        tokenizer = self.generator.tokenizer
+        logits_processor = None
+        if stop_at_function_end:
+            logits_processor = LogitsProcessorList([BalancedBracketsLogitsProcessor(tokenizer,
+                inference_config.get_eos_token_id(tokenizer))])
+        self.generate_kwargs = dict(
+            max_new_tokens=max_new_tokens,
+            do_sample=do_sample,
+            temperature=temperature,
+            top_p=top_p,
+            pad_token_id=inference_config.get_pad_token_id(tokenizer),
+            eos_token_id=inference_config.get_eos_token_id(tokenizer),
+            logits_processor=logits_processor,
+        )
+
+    def generate(self, prompts : List[str], num_samples : int) -> Iterator[Tuple[int, List[str]]]:
+        tokenizer = self.generator.tokenizer
+
+        # left padding fills each batch up to its longest prompt, so mixing short and long prompts wastes most of
+        # a batch on padding.
+        prompt_lengths = tokenized_lengths(prompts, tokenizer)
+        prompt_order = length_sorted_order(prompt_lengths) if self.length_sort else list(range(len(prompts)))
+        print(f"Padding efficiency: {padding_efficiency([prompt_lengths[i] for i in prompt_order for _ in range(num_samples)], self.batch_size):.2f}")
+
+        if self.shared_prefill:
+            prompt_outputs = generate_shared_prefill(self.generator.model, tokenizer, [prompts[i] for i in prompt_order],
+                num_samples, self.batch_size, **self.generate_kwargs)
+            generated_outputs = (output for outputs in prompt_outputs for output in outputs)
+        else:
+            # to use a torch.utils.data.DataSet with the HuggingFace pipeline, we need to flatten out the prompts
+            # and repeat them for however many samples we want to generate per prompt
+            prompt_dataset = PromptDataset([prompts[i] for i in prompt_order for _ in range(num_samples)])
+            generated_outputs = (output[0] for output in self.generator(prompt_dataset, batch_size=self.batch_size, **self.generate_kwargs))
+
+        outputs = []
+        for idx, output in enumerate(generated_outputs):
+            # outputs start with the prompt, only count the completion like the other backends
+            prompt = prompts[prompt_order[idx // num_samples]]
+            completion = output["generated_text"][len(prompt):]
+            self.generated_tokens += len(tokenizer.encode(completion, add_special_tokens=False))
+            outputs.append(output["generated_text"])
+            if len(outputs) == num_samples:
+                yield prompt_order[idx // num_samples], outputs
+                outputs = []
+
+
+class VLLMBackend(GenerationBackend):
+    """ In-process vllm engine. All prompts are added at once and continuous batching schedules them; the
+        samples of a prompt share its prefilled KV cache blocks.
+    """
+
+    def __init__(self, model : str, max_new_tokens : int = 1024, do_sample : bool = False, temperature : float = 0.2,
+                 top_p : float = 0.95, **llm_kwargs):
+        super().__init__()
+        from vllm import LLM
+        self.llm = LLM(model=model, **llm_kwargs)
+        self.max_new_tokens = max_new_tokens
+        # greedy decoding without do_sample, like the pipeline
+        self.temperature = temperature if do_sample else 0.0
+        self.top_p = top_p if do_sample else 1.0
+
+    def generate(self, prompts : List[str], num_samples : int) -> Iterator[Tuple[int, List[str]]]:
+        from vllm import SamplingParams
+        sampling_params = SamplingParams(n=num_samples, temperature=self.temperature, top_p=self.top_p,
+                                         max_tokens=self.max_new_tokens)
+        engine = self.llm.llm_engine
+        for i, prompt in enumerate(prompts):
+            engine.add_request(str(i), prompt, sampling_params)
+        while engine.has_unfinished_requests():
+            for output in engine.step():
+                if output.finished:
+                    self.generated_tokens += sum(len(o.token_ids) for o in output.outputs)
+                    yield int(output.request_id), [output.prompt + o.text for o in output.outputs]
+
+
+class OpenAIServerBackend(GenerationBackend):
+    """ OpenAI-compatible completions server, e.g. `vllm serve <model>` or text-generation-inference. Up to
+        max_concurrency prompts are in flight so the server can batch them.
+    """
+
+    def __init__(self, model : str, base_url : str, api_key : str = "0", max_concurrency : int = 32,
+                 max_new_tokens : int = 1024, do_sample : bool = False, temperature : float = 0.2, top_p : float = 0.95):
+        super().__init__()
+        from openai import OpenAI
+        self.client = OpenAI(base_url=base_url, api_key=api_key)
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature if do_sample else 0.0
+        self.top_p = top_p if do_sample else 1.0
+        self.lock = threading.Lock()
+
+    def complete(self, prompt : str, num_samples : int) -> List[str]:
+        completion = self.client.completions.create(model=self.model, prompt=prompt, n=num_samples,
+            max_tokens=self.max_new_tokens, temperature=self.temperature, top_p=self.top_p)
+        with self.lock:
+            self.generated_tokens += completion.usage.completion_tokens
+        return [prompt + c.text for c in sorted(completion.choices, key=lambda c: c.index)]
+
+    def generate(self, prompts : List[str], num_samples : int) -> Iterator[Tuple[int, List[str]]]:
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {executor.submit(self.complete, prompt, num_samples) : i for i, prompt in enumerate(prompts)}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+
+def add_backend_args(parser):
+    """ Add the command line arguments that select and configure the backend. """
+    parser.add_argument('--backend', choices=['hf', 'vllm', 'openai'], default='hf', help='Inference backend: HuggingFace ' +
+        'pipeline, in-process vllm or an OpenAI-compatible completions server (default: hf)')
+    parser.add_argument('--device', default='0', help='Device for the hf backend, a GPU index or cpu (default: 0)')
+    parser.add_argument('--server_url', default='http://localhost:8000/v1', help='Base URL of the server for the openai backend ' +
+        '(default: http://localhost:8000/v1)')
+    parser.add_argument('--api_key', default='0', help='API key for the openai backend (default: 0)')
+    parser.add_argument('--max_concurrency', type=int, default=32, help='Requests in flight for the openai backend (default: 32)')
+    parser.add_argument('--no_length_sort', action='store_true', help='Batch prompts in file order instead of grouping prompts of similar length (default: False)')
+    parser.add_argument('--shared_prefill', action='store_true', help='Run each prompt through the model once and sample all of its outputs from the shared KV cache (hf backend, default: False)')
+
+
+def get_backend(args, inference_config : InferenceConfig, torch_dtype, stop_at_function_end : bool = True) -> GenerationBackend:
+    sampling = dict(max_new_tokens=args.max_new_tokens, do_sample=args.do_sample, temperature=args.temperature, top_p=args.top_p)
+    if args.backend == 'hf':
+        device = int(args.device) if args.device.isdigit() else args.device
+        return HFPipelineBackend(args.model, inference_config, torch_dtype, device=device, batch_size=args.batch_size,
+                                 stop_at_function_end=stop_at_function_end, length_sort=not args.no_length_sort,
+                                 shared_prefill=args.shared_prefill, **sampling)
+    elif args.backend == 'vllm':
+        return VLLMBackend(args.model, trust_remote_code=inference_config.trust_remote_code(), **sampling)
+    elif args.backend == 'openai':
+        return OpenAIServerBackend(args.model, args.server_url, api_key=args.api_key, max_concurrency=args.max_concurrency, **sampling)
+    else:
+        raise ValueError(f"Unknown backend: {args.backend}")
@@ -14,6 +14,9 @@ from typing import Optional
 from alive_progress import alive_bar
 import google.generativeai as genai
 
+# local imports
+from generation_cache import GenerationCache
+
 """ Prompt template: """
 SYSTEM_TEMPLATE = """You are a helpful coding assistant.
 You are helping a programmer write a C++ function. Write the body of the function and put it in a markdown code block.
@@ -40,6 +43,8 @@ def get_args():
     parser.add_argument("--max-requests-per-second", help="Limit the rate of request generation.")
     parser.add_argument("--dry", action="store_true", help="If provided, then don't make any requests.")
     parser.add_argument("--overwrite", action="store_true", help="If provided, then overwrite outputs already in file.")
+    parser.add_argument("--cache", type=str, help="JSONL file outputs are appended to as they are generated and " +
+        "restored from. Defaults to the output path with a .cache.jsonl extension.")
     parser.add_argument("--temperature", type=float, default=0.2, help="The temperature to use for sampling.")
     parser.add_argument("--top-p", type=float, default=0.95, help="The top p to use for sampling.")
     parser.add_argument("--max-new-tokens", type=int, default=1024, help="The maximum number of tokens to generate.")
@@ -106,26 +111,23 @@ def main():
     with open(args.prompts, 'r') as prompts_json:
         prompts = json.load(prompts_json)
 
-    # read in outputs
-    if not args.overwrite and os.path.exists(args.output):
-        with open(args.output, 'r') as output_json:
-            outputs = json.load(output_json)
+    # read in outputs from the cache and from an earlier output file
+    cache_path = args.cache or os.path.splitext(args.output)[0] + ".cache.jsonl"
+    cache = GenerationCache(cache_path, temperature=args.temperature, top_p=args.top_p,
+                            num_samples=args.num_samples_per_prompt, prompt_fields=("prompt",))
+    if not args.overwrite:
+        cache.load()
+        if os.path.exists(args.output):
+            cache.migrate(args.output)
 
         # copy existing outputs into prompts
         copy_count = 0
         for prompt in prompts:
-            for o in outputs:
-                if o["prompt"] == prompt["prompt"] and \
-                   o["name"] == prompt["name"] and \
-                   o["parallelism_model"] == prompt["parallelism_model"] and \
-                   "outputs" in o and \
-                   len(o["outputs"]) == args.num_samples_per_prompt and \
-                   o["temperature"] == args.temperature and \
-                   o["top_p"] == args.top_p:
-                    for col in ["temperature", "top_p", "do_sample", "max_new_tokens", "outputs"]:
-                        prompt[col] = o[col]
-                    copy_count += 1
-                    break
+            o = cache.get(prompt)
+            if o is not None:
+                for col in ["temperature", "top_p", "do_sample", "max_new_tokens", "outputs"]:
+                    prompt[col] = o[col]
+                copy_count += 1
         print(f"Copied {copy_count} existing outputs.")
 
     # get the keys
@@ -210,6 +212,8 @@ def main():
             outputs = [c.text for c in completions]
             outputs = [postprocess(original_prompt, o) for o in outputs]
             prompt["outputs"] = outputs
+            # save intermediate outputs
+            cache.add(prompt)
             bar()
 
             # update counters
@@ -230,10 +234,6 @@ def main():
                 request_timer = time.time()
                 request_rate_counter = 0
 
-            # write intermediate outputs
-            with open(args.output, 'w') as output_json:
-                json.dump(prompts, output_json, indent=2)
-
     # summary stats
     print(f"Submitted {request_counter} requests.")
 
@@ -0,0 +1,126 @@
+# std imports
+import hashlib
+import json
+import os
+from typing import Iterable, List, Optional
+
+
+def cache_key(name : str, parallelism_model : str, prompt_text : str, temperature : float, top_p : float,
+              prompted : bool, num_samples : int) -> str:
+    """ Hash of everything that determines the outputs generated for a prompt. """
+    material = json.dumps([name, parallelism_model, prompt_text, temperature, top_p, prompted, num_samples])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    """ Outputs of the generate and translate scripts, indexed by `cache_key`.
+        Responses are appended to a JSONL file (the `--cache` format) as they are generated, so restarting
+        a job reads the file once and then looks prompts up in O(1) instead of comparing every prompt to
+        every response.
+
+        prompt_fields: fields of a prompt that hold its text, e.g. ("translation_prompt",). Several fields
+        are joined, e.g. the prompt and the source/destination models of a translation.
+        temperature, top_p, prompted, num_samples: settings of the current run. A response is only reused
+        if it was generated with the same settings.
+    """
+
+    def __init__(self, path : Optional[str], temperature : float, top_p : float, num_samples : int,
+                 prompted : bool = False, prompt_fields : Iterable[str] = ("prompt",)):
+        self.path = path
+        self.temperature = temperature
+        self.top_p = top_p
+        self.prompted = prompted
+        self.num_samples = num_samples
+        self.prompt_fields = tuple(prompt_fields)
+        self.responses = {}
+        self.checked_last_line = False
+
+    def __len__(self) -> int:
+        return len(self.responses)
+
+    def prompt_text(self, prompt : dict) -> str:
+        return "\n".join(str(prompt.get(field)) for field in self.prompt_fields)
+
+    def key(self, prompt : dict) -> str:
+        """ Key of a prompt generated with the settings of this run. """
+        return cache_key(prompt["name"], prompt["parallelism_model"], self.prompt_text(prompt), self.temperature,
+                         self.top_p, self.prompted, self.num_samples)
+
+    def response_key(self, response : dict) -> str:
+        """ Key of a response, from the settings it was generated with. """
+        # older outputs of the API scripts have no `prompted` field
+        return cache_key(response["name"], response["parallelism_model"], self.prompt_text(response),
+                         response.get("temperature"), response.get("top_p"), response.get("prompted", False),
+                         len(response.get("outputs", [])))
+
+    def load(self) -> int:
+        """ Index the responses in the JSONL file, if it exists. Returns the number of responses read. """
+        if self.path is None or not os.path.exists(self.path):
+            return 0
+        count = 0
+        with open(self.path, 'r') as jsonl_file:
+            for line in jsonl_file:
+                if line.strip() == "":
+                    continue
+                try:
+                    response = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line cut off by an interrupted run
+                    continue
+                self.responses[self.response_key(response)] = response
+                count += 1
+        return count
+
+    def migrate(self, json_path : str) -> int:
+        """ Import the responses of an output JSON file (e.g. `--restore_from` or the output of an earlier
+            run of the API scripts) that match this run's settings and are not cached yet. They are also
+            appended to the JSONL file. Returns the number of responses imported.
+        """
+        with open(json_path, 'r') as json_file:
+            restored_responses = json.load(json_file)
+        new_responses = []
+        for response in restored_responses:
+            if "outputs" not in response or len(response["outputs"]) != self.num_samples:
+                continue
+            key = self.response_key(response)
+            if key not in self.responses:
+                self.responses[key] = response
+                new_responses.append(response)
+        self.append(new_responses)
+        return len(new_responses)
+
+    def get(self, prompt : dict) -> Optional[dict]:
+        return self.responses.get(self.key(prompt))
+
+    def add(self, response : dict):
+        """ Store a newly generated response. """
+        self.responses[self.response_key(response)] = response
+        self.append([response])
+
+    def append(self, responses : List[dict]):
+        if self.path is None or len(responses) == 0:
+            return
+        partial_last_line = False
+        if not self.checked_last_line:
+            # an interrupted run may have left a partial last line, start on a new one
+            self.checked_last_line = True
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                with open(self.path, 'rb') as jsonl_file:
+                    jsonl_file.seek(-1, os.SEEK_END)
+                    partial_last_line = jsonl_file.read(1) != b"\n"
+        with open(self.path, 'a') as jsonl_file:
+            if partial_last_line:
+                jsonl_file.write("\n")
+            for response in responses:
+                jsonl_file.write(json.dumps(response) + "\n")
+
+    def split(self, prompts : List[dict]):
+        """ Returns the cached responses for `prompts` and the prompts that still need to be generated. """
+        cached, missing = [], []
+        for prompt in prompts:
+            response = self.get(prompt)
+            if response is not None:
+                cached.append(response)
+            else:
+                missing.append(prompt)
+        return cached, missing
@@ -0,0 +1,66 @@
+""" Tests for the hf backend in backends.py. Run with `python -m pytest` from this directory.
+"""
+# std imports
+import string
+
+# tpl imports
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+# local imports
+from backends import HFPipelineBackend
+from utils import TinyTestConfig, get_inference_config
+
+PROMPTS = ["int f(int x) {", "void g() {", "double h(std::vector<double> const& v) {"]
+
+
+@pytest.fixture(scope="module")
+def tiny_model_path(tmp_path_factory):
+    ''' A random-weight GPT-2 with one token per printable character, saved where get_inference_config picks
+        TinyTestConfig for it.
+    '''
+    vocab = {c: i for i, c in enumerate(["<eos>"] + list(string.printable))}
+    tok = Tokenizer(models.WordLevel(vocab, unk_token="<eos>"))
+    tok.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tok.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tok, eos_token="<eos>", unk_token="<eos>")
+
+    torch.manual_seed(0)
+    config = GPT2Config(vocab_size=len(tokenizer), n_positions=128, n_embd=32, n_layer=2, n_head=2, initializer_range=0.2,
+                        bos_token_id=tokenizer.eos_token_id, eos_token_id=tokenizer.eos_token_id)
+    path = tmp_path_factory.mktemp("models") / "tiny-gpt2"
+    GPT2LMHeadModel(config).save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    return str(path)
+
+
+def run_backend(model_path, num_samples, **kwargs):
+    inference_config = get_inference_config(model_path, prompted=True)
+    backend = HFPipelineBackend(model_path, inference_config, inference_config.get_dtype(), device="cpu", batch_size=4,
+                                max_new_tokens=6, stop_at_function_end=False, **kwargs)
+    results = dict(backend.generate(PROMPTS, num_samples))
+    return backend, [results[i] for i in range(len(PROMPTS))]
+
+
+def test_tiny_models_use_the_tiny_config(tiny_model_path):
+    assert isinstance(get_inference_config(tiny_model_path), TinyTestConfig)
+
+
+@pytest.mark.parametrize("shared_prefill", [False, True])
+def test_hf_backend_yields_every_prompt_and_counts_completion_tokens(tiny_model_path, shared_prefill):
+    backend, outputs = run_backend(tiny_model_path, 2, shared_prefill=shared_prefill)
+    for prompt, prompt_outputs in zip(PROMPTS, outputs):
+        assert len(prompt_outputs) == 2
+        assert all(output.startswith(prompt) for output in prompt_outputs)
+    # one token per character, so only the completions count
+    completion_chars = sum(len(output) - len(prompt) for prompt, prompt_outputs in zip(PROMPTS, outputs) for output in prompt_outputs)
+    assert completion_chars > 0
+    assert backend.generated_tokens == completion_chars
+
+
+def test_hf_backend_greedy_outputs_do_not_depend_on_shared_prefill(tiny_model_path):
+    _, pipeline_outputs = run_backend(tiny_model_path, 2, shared_prefill=False, length_sort=False)
+    _, shared_outputs = run_backend(tiny_model_path, 2, shared_prefill=True)
+    assert shared_outputs == pipeline_outputs
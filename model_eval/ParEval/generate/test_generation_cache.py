@@ -0,0 +1,100 @@
+""" Tests for generation_cache.py. Run with `python -m pytest` from this directory.
+"""
+# std imports
+import json
+
+# local imports
+from generation_cache import GenerationCache
+
+
+def make_prompt(name, text="void f() {", parallelism_model="omp"):
+    return {"name": name, "parallelism_model": parallelism_model, "prompt": text}
+
+
+def make_response(prompt, num_samples=2, temperature=0.2, top_p=0.95, **fields):
+    ''' A response like generate.py writes it for `prompt`. '''
+    response = dict(prompt, temperature=temperature, top_p=top_p, prompted=False,
+                    outputs=[f"{prompt['name']} output {i}" for i in range(num_samples)])
+    response.update(fields)
+    return response
+
+
+def new_cache(path, num_samples=2, temperature=0.2):
+    return GenerationCache(str(path), temperature=temperature, top_p=0.95, num_samples=num_samples)
+
+
+def test_split_returns_cached_responses_and_missing_prompts(tmp_path):
+    cache = new_cache(tmp_path / "cache.jsonl")
+    prompts = [make_prompt("a"), make_prompt("b"), make_prompt("c")]
+    cache.add(make_response(prompts[1]))
+    cached, missing = cache.split(prompts)
+    assert [r["name"] for r in cached] == ["b"]
+    assert missing == [prompts[0], prompts[2]]
+
+
+def test_split_only_reuses_responses_with_the_same_settings(tmp_path):
+    cache = new_cache(tmp_path / "cache.jsonl")
+    prompt = make_prompt("a")
+    cache.add(make_response(prompt, temperature=0.8))
+    cache.add(make_response(make_prompt("a", text="void g() {")))
+    cache.add(make_response(make_prompt("a", parallelism_model="serial")))
+    cache.add(make_response(prompt, num_samples=3))
+    assert cache.split([prompt]) == ([], [prompt])
+
+
+def test_responses_survive_a_restart(tmp_path):
+    path = tmp_path / "cache.jsonl"
+    prompts = [make_prompt("a"), make_prompt("b")]
+    first = new_cache(path)
+    for prompt in prompts:
+        first.add(make_response(prompt))
+
+    second = new_cache(path)
+    assert second.load() == 2
+    cached, missing = second.split(prompts)
+    assert len(cached) == 2 and missing == []
+
+
+def test_load_skips_a_partial_last_line_and_appends_after_it(tmp_path):
+    path = tmp_path / "cache.jsonl"
+    path.write_text(json.dumps(make_response(make_prompt("a"))) + "\n" + '{"name": "b", "outp')
+    cache = new_cache(path)
+    assert cache.load() == 1
+    cache.add(make_response(make_prompt("c")))
+
+    reloaded = new_cache(path)
+    assert reloaded.load() == 2
+    assert reloaded.get(make_prompt("c")) is not None
+
+
+def test_migrate_imports_matching_responses_once(tmp_path):
+    path = tmp_path / "cache.jsonl"
+    old_output = tmp_path / "old-output.json"
+    responses = [make_response(make_prompt("a")), make_response(make_prompt("b"), num_samples=1),
+                 {"name": "c", "parallelism_model": "omp", "prompt": "void f() {"}]
+    old_output.write_text(json.dumps(responses))
+
+    cache = new_cache(path)
+    cache.add(make_response(make_prompt("d")))
+    # only "a" has the right number of outputs
+    assert cache.migrate(str(old_output)) == 1
+    assert cache.migrate(str(old_output)) == 0
+    assert cache.get(make_prompt("a"))["outputs"] == ["a output 0", "a output 1"]
+
+    reloaded = new_cache(path)
+    assert reloaded.load() == 2
+
+
+def test_responses_without_prompted_field_match_unprompted_runs(tmp_path):
+    cache = new_cache(tmp_path / "cache.jsonl")
+    response = make_response(make_prompt("a"))
+    del response["prompted"]
+    cache.add(response)
+    assert cache.get(make_prompt("a")) is response
+
+
+def test_cache_without_path_keeps_responses_in_memory():
+    cache = GenerationCache(None, temperature=0.2, top_p=0.95, num_samples=2)
+    assert cache.load() == 0
+    cache.add(make_response(make_prompt("a")))
+    assert len(cache) == 1
@@ -0,0 +1,152 @@
+""" Tests for the generation helpers in utils.py. Run with `python -m pytest` from this directory.
+"""
+# std imports
+import string
+
+# tpl imports
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+# local imports
+from utils import BalancedBracketsCriteria, BalancedBracketsLogitsProcessor, BracketDepthTracker, generate_shared_prefill, \
+    length_sorted_order, padding_efficiency, tokenized_lengths
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    ''' One token per printable character, plus an EOS token with id 0. '''
+    vocab = {c: i for i, c in enumerate(["<eos>"] + list(string.printable))}
+    tok = Tokenizer(models.WordLevel(vocab, unk_token="<eos>"))
+    tok.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tok.decoder = decoders.Fuse()
+    return PreTrainedTokenizerFast(tokenizer_object=tok, eos_token="<eos>", unk_token="<eos>")
+
+
+def encode(tokenizer, texts):
+    ''' Left padded batch of token ids, like the pipeline builds. '''
+    ids = [tokenizer.encode(text) for text in texts]
+    width = max(len(row) for row in ids)
+    return torch.tensor([[tokenizer.eos_token_id] * (width - len(row)) + row for row in ids])
+
+
+def feed(tracker, tokenizer, prompts, completions):
+    ''' Run the tracker like a logits processor: the prompt first, then one generated character per step.
+        Returns the step at which each row was first done (None if never).
+    '''
+    input_ids = encode(tokenizer, prompts)
+    done_at = [None] * len(prompts)
+    if tracker.update(input_ids).any():
+        return [0 if d else None for d in tracker.done.tolist()]
+    for step in range(max(len(c) for c in completions)):
+        next_tokens = [tokenizer.encode(c[step]) if step < len(c) else [tokenizer.eos_token_id] for c in completions]
+        input_ids = torch.cat([input_ids, torch.tensor(next_tokens)], dim=1)
+        for row, done in enumerate(tracker.update(input_ids).tolist()):
+            if done and done_at[row] is None:
+                done_at[row] = step + 1
+    return done_at
+
+
+def test_tracker_done_when_function_body_closes(tokenizer):
+    tracker = BracketDepthTracker(tokenizer)
+    done_at = feed(tracker, tokenizer, ["int f(int x) {"], ["\n  if (x) { return 1; }\n  return 0;\n}\nint g"])
+    completion = "\n  if (x) { return 1; }\n  return 0;\n}"
+    assert done_at == [len(completion)]
+
+
+def test_tracker_ignores_balanced_blocks_in_prompt(tokenizer):
+    prompt = "struct Point {\n  double x, y;\n};\n\ndouble f(Point p) {"
+    tracker = BracketDepthTracker(tokenizer)
+    assert not tracker.update(encode(tokenizer, [prompt])).any()
+    assert feed(BracketDepthTracker(tokenizer), tokenizer, [prompt], ["\n  return p.x;\n}"]) == [len("\n  return p.x;\n}")]
+
+
+def test_tracker_rows_finish_independently(tokenizer):
+    prompts = ["void a() {", "struct S { int v; };\nvoid b(S s) {"]
+    completions = [" }", " s.v = 1; { } }"]
+    assert feed(BracketDepthTracker(tokenizer), tokenizer, prompts, completions) == [2, len(completions[1])]
+
+
+def test_tracker_needs_open_signature(tokenizer):
+    # without an open block at the end of the prompt, complete blocks in the output do not end it
+    assert feed(BracketDepthTracker(tokenizer), tokenizer, ["// just a comment\n"], ["int f() { return 1; }\n"]) == [None]
+
+
+def test_tracker_starts_over_for_new_batch(tokenizer):
+    tracker = BracketDepthTracker(tokenizer)
+    assert feed(tracker, tokenizer, ["void a() {"], ["}"]) == [1]
+    assert feed(tracker, tokenizer, ["void b() {"], ["x;"]) == [None]
+
+
+def test_criteria_counts_first_token_as_generated(tokenizer):
+    criteria = BalancedBracketsCriteria(max_length=100, tokenizer=tokenizer)
+    prompt = "struct S {};\nvoid f() {"
+    assert not criteria(encode(tokenizer, [prompt + " "]), None)
+    assert criteria(encode(tokenizer, [prompt + " }"]), None)
+
+
+def test_logits_processor_forces_eos_on_done_rows(tokenizer):
+    processor = BalancedBracketsLogitsProcessor(tokenizer, tokenizer.eos_token_id)
+    input_ids = encode(tokenizer, ["struct S {};\nvoid f() {", "void g() {"])
+    scores = processor(input_ids, torch.zeros(2, len(tokenizer)))
+    assert (scores == 0).all()
+
+    input_ids = torch.cat([input_ids, torch.tensor([tokenizer.encode("}"), tokenizer.encode(" ")])], dim=1)
+    scores = processor(input_ids, torch.zeros(2, len(tokenizer)))
+    assert scores[0].argmax().item() == tokenizer.eos_token_id and torch.isinf(scores[0, 1:]).all()
+    assert (scores[1] == 0).all()
+
+
+def test_length_sorted_order_is_longest_first_and_stable():
+    lengths = [3, 9, 3, 9, 1, 5]
+    assert length_sorted_order(lengths) == [1, 3, 5, 0, 2, 4]
+    assert length_sorted_order([]) == []
+
+
+def test_padding_efficiency():
+    assert padding_efficiency([4, 4, 4, 4], batch_size=2) == 1.0
+    # batches [8, 2] and [8, 2] are padded to 8 tokens per row
+    assert padding_efficiency([8, 2, 8, 2], batch_size=2) == pytest.approx(20 / 32)
+    # a partial last batch is only padded to its own rows
+    assert padding_efficiency([8, 8, 2], batch_size=2) == pytest.approx(18 / 18)
+    assert padding_efficiency([], batch_size=4) == 1.0
+
+
+def test_sorting_by_length_improves_padding_efficiency(tokenizer):
+    prompts = ["void a() {", "x" * 80 + "{", "int b() {", "y" * 75 + "{"]
+    lengths = tokenized_lengths(prompts, tokenizer)
+    assert lengths == [len(p) for p in prompts]
+    order = length_sorted_order(lengths)
+    assert padding_efficiency([lengths[i] for i in order], 2) > 0.95 > padding_efficiency(lengths, 2)
+
+
+@pytest.fixture(scope="module")
+def tiny_model(tokenizer):
+    ''' A random-weight two layer GPT-2 over the character tokenizer, small enough to run on CPU. The weights are
+        large enough that greedy decoding continues every prompt differently.
+    '''
+    torch.manual_seed(0)
+    config = GPT2Config(vocab_size=len(tokenizer), n_positions=128, n_embd=32, n_layer=2, n_head=2, initializer_range=0.2,
+                        bos_token_id=tokenizer.eos_token_id, eos_token_id=tokenizer.eos_token_id)
+    return GPT2LMHeadModel(config).eval()
+
+
+def greedy_completion(model, tokenizer, prompt, max_new_tokens):
+    ids = torch.tensor([tokenizer.encode(prompt)])
+    sequences = model.generate(input_ids=ids, attention_mask=torch.ones_like(ids), do_sample=False,
+                               max_new_tokens=max_new_tokens, pad_token_id=tokenizer.eos_token_id)
+    return tokenizer.decode(sequences[0, ids.shape[1]:], skip_special_tokens=True)
+
+
+@pytest.mark.parametrize("batch_size", [6, 2])
+def test_shared_prefill_matches_generating_each_sample(tokenizer, tiny_model, batch_size):
+    tokenizer.pad_token_id = tokenizer.eos_token_id
+    tokenizer.padding_side = "left"
+    # prompts of different lengths, so the batched ones are left padded
+    prompts = ["int f(int x) {", "void g() {", "double h(std::vector<double> const& v) {"]
+    outputs = list(generate_shared_prefill(tiny_model, tokenizer, prompts, num_samples=3, batch_size=batch_size,
+                                           do_sample=False, max_new_tokens=8, pad_token_id=tokenizer.eos_token_id))
+    expected = [prompt + greedy_completion(tiny_model, tokenizer, prompt, 8) for prompt in prompts]
+    assert len(set(expected)) == len(prompts)
+    assert [[o["generated_text"] for o in prompt_outputs] for prompt_outputs in outputs] == [[e] * 3 for e in expected]
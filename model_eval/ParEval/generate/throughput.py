@@ -4,75 +4,226 @@
 """
 # std imports
 import argparse
+import contextlib
+import csv
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import json
 import os
 import sys
+import threading
 import time
 from tqdm import tqdm
 
 # tpl imports
 import torch
-from transformers import pipeline
+from transformers import AutoTokenizer
+from transformers.generation.streamers import BaseStreamer
 
 # local imports
-from utils import BalancedBracketsCriteria, PromptDataset, clean_output, get_inference_config
+from backends import HFPipelineBackend, OpenAIServerBackend, VLLMBackend
+from utils import get_inference_config, length_sorted_order, padding_efficiency
 
 
 """ Parse command line arguments """
-parser = argparse.ArgumentParser(description='Generate code')
+parser = argparse.ArgumentParser(description='Benchmark generation throughput over a sweep of batch sizes, ' +
+    'output lengths and prompt lengths')
 parser.add_argument('--prompts', required=True, help='Path to the prompt JSON file')
 parser.add_argument('--model', required=True, help='Path to the language model')
-parser.add_argument('--max_new_tokens', type=int, default=1024, help='Maximum number of new tokens to generate (default: 1024)')
-parser.add_argument('--num_samples_per_prompt', type=int, default=50, help='Number of code samples to generate (default: 50)')
+parser.add_argument('--output', default='throughput.csv', help='CSV file to append the results to (default: throughput.csv)')
+parser.add_argument('--backend', choices=['hf', 'vllm', 'openai'], default='hf', help='Inference backend, see backends.py (default: hf)')
+parser.add_argument('--device', default='0', help='Device for the hf backend, a GPU index or cpu (default: 0)')
+parser.add_argument('--server_url', default='http://localhost:8000/v1', help='Base URL of the server for the openai backend ' +
+    '(default: http://localhost:8000/v1)')
+parser.add_argument('--api_key', default='0', help='API key for the openai backend (default: 0)')
+parser.add_argument('--tokenizer', help='Tokenizer of the served model for the openai backend (default: --model)')
+parser.add_argument('--batch_size', type=int, nargs='+', default=[16], help='Batch sizes to sweep (default: 16)')
+parser.add_argument('--max_new_tokens', type=int, nargs='+', default=[1024], help='Maximum numbers of new tokens to sweep (default: 1024)')
+parser.add_argument('--prompt_length', type=int, nargs='+', default=[0], help='Prompt lengths in tokens to sweep. Every ' +
+    'prompt is cut or extended to exactly this many tokens, 0 uses the prompts as they are (default: 0)')
+parser.add_argument('--num_samples_per_prompt', type=int, default=1, help='Number of times each prompt is repeated (default: 1)')
 parser.add_argument('--temperature', type=float, default=0.2, help='Temperature for controlling randomness (default: 0.2)')
 parser.add_argument('--top_p', type=float, default=0.95, help='Top p value for nucleus sampling (default: 0.95)')
 parser.add_argument('--do_sample', action='store_true', help='Enable sampling (default: False)')
-parser.add_argument('--batch_size', type=int, default=16, help='Batch size for generation (default: 8)')
-parser.add_argument('--num_batches', type=int, default=10, help='How many batches to run (default: 10)')
-parser.add_argument('--warmup', type=int , default=5, help='How many batches to run before timing (default: 5)')
+parser.add_argument('--ignore_eos', action='store_true', help='Always generate max_new_tokens tokens instead of stopping at ' +
+    'EOS or the end of the function (default: False)')
+parser.add_argument('--no_length_sort', action='store_true', help='Batch prompts in file order instead of grouping prompts of similar length (default: False)')
+parser.add_argument('--num_batches', type=int, default=5, help='How many batches to time per configuration (default: 5)')
+parser.add_argument('--warmup', type=int , default=1, help='How many batches to run before timing each configuration (default: 1)')
 args = parser.parse_args()
 
+
+class TimingStreamer(BaseStreamer):
+    ''' Records when generate hands out each new token of a batch. The first `put` is the prompt. '''
+
+    def __init__(self):
+        self.prompt_seen = False
+        self.token_times = []
+
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        self.token_times.append(time.perf_counter())
+
+    def end(self):
+        pass
+
+
+def generated_token_counts(generated_ids, eos_token_id):
+    ''' Number of tokens each row generated, up to and including its first EOS. Rows that finished early are
+        padded afterwards, and the padding is often the EOS token as well.
+    '''
+    if eos_token_id is None:
+        return [generated_ids.shape[1]] * generated_ids.shape[0]
+    is_eos = generated_ids == eos_token_id
+    first_eos = is_eos.int().argmax(dim=1)
+    return torch.where(is_eos.any(dim=1), first_eos + 1, generated_ids.shape[1]).tolist()
+
+
+def fixed_length_prompts(prompt_ids, length : int):
+    ''' Each prompt cut to its last `length` tokens. Prompts shorter than that are extended at the front with the
+        tokens of the prompts before them, so that every prompt ends where it did and has exactly `length` tokens.
+    '''
+    stream = [token for ids in prompt_ids for token in ids]
+    copies = length // len(stream) + 2
+    repeated_stream = stream * copies
+    ends = list(itertools.accumulate(len(ids) for ids in prompt_ids))
+    return [repeated_stream[end + (copies - 1) * len(stream) - length : end + (copies - 1) * len(stream)] for end in ends]
+
+
+class PeakRSSSampler:
+    ''' Peak resident set size of the process while a configuration runs, sampled on a background thread.
+        ru_maxrss is the peak over the lifetime of the process, so it can not be reset between configurations.
+    '''
+
+    def __init__(self, interval : float = 0.01):
+        self.interval = interval
+        self.peak_mb = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    @staticmethod
+    def rss_mb():
+        ''' Current resident set size in MB, or None where /proc is not available. '''
+        try:
+            with open('/proc/self/statm', 'r') as statm:
+                return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+        except (OSError, ValueError):
+            return None
+
+    def _sample(self):
+        while True:
+            rss = self.rss_mb()
+            if rss is not None:
+                self.peak_mb = max(self.peak_mb, rss)
+            if self.stopped.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        # one last sample in case the peak fell between two samples at the end
+        rss = self.rss_mb()
+        if rss is not None:
+            self.peak_mb = max(self.peak_mb, rss)
+
+
+def peak_memory_mb(device, rss_sampler):
+    ''' Peak memory of the last configuration: allocated GPU memory, or the sampled peak resident set size on CPU. '''
+    if device == 'cpu':
+        return rss_sampler.peak_mb if PeakRSSSampler.rss_mb() is not None else ""
+    return torch.cuda.max_memory_allocated() / 2**20
+
+
 """ Load prompts """
 with open(args.prompts, 'r') as json_file:
     prompts = json.load(json_file)
 
-""" Initialize inference config """
+""" Initialize inference config and backend """
 inference_config = get_inference_config(args.model, prompted=True)
+if args.backend == 'hf':
+    backend = HFPipelineBackend(args.model, inference_config, inference_config.get_dtype(),
+                                device=int(args.device) if args.device.isdigit() else args.device,
+                                do_sample=args.do_sample, temperature=args.temperature, top_p=args.top_p,
+                                stop_at_function_end=not args.ignore_eos)
+    tokenizer = backend.generator.tokenizer
+    device = 'cpu' if backend.generator.model.device.type == 'cpu' else 'cuda'
+    run_batch = run_hf_batch
+elif args.backend == 'vllm':
+    backend = VLLMBackend(args.model, do_sample=args.do_sample, temperature=args.temperature, top_p=args.top_p,
+                          trust_remote_code=inference_config.trust_remote_code())
+    tokenizer = backend.llm.get_tokenizer()
+    # vllm preallocates the KV cache up front, so the allocator peak says nothing about the configuration
+    device = None
+    run_batch = run_vllm_batch
+else:
+    backend = OpenAIServerBackend(args.model, args.server_url, api_key=args.api_key, do_sample=args.do_sample,
+                                  temperature=args.temperature, top_p=args.top_p)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer or args.model)
+    # the server's memory is not visible from here
+    device = None
+    run_batch = run_openai_batch
+
+# the prompts are tokenized once, every backend is given token ids so all of them run the same prompts
+prompt_ids = [tokenizer.encode(inference_config.format_prompt(p["prompt"])) for p in prompts]
+
+""" Run the sweep """
+results = []
+for prompt_length, batch_size, max_new_tokens in itertools.product(args.prompt_length, args.batch_size, args.max_new_tokens):
+    sweep_ids = fixed_length_prompts(prompt_ids, prompt_length) if prompt_length > 0 else prompt_ids
+    repeated_ids = [ids for ids in sweep_ids for _ in range(args.num_samples_per_prompt)]
+    num_rows = batch_size * (args.warmup + args.num_batches)
+    rows = [repeated_ids[i % len(repeated_ids)] for i in range(num_rows)]
+    if not args.no_length_sort:
+        rows = [rows[i] for i in length_sorted_order([len(ids) for ids in rows])]
+    batches = [rows[i:i+batch_size] for i in range(0, num_rows, batch_size)]
+
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    timings = []
+    desc = f"prompt_length={prompt_length} batch_size={batch_size} max_new_tokens={max_new_tokens}"
+    rss_sampler = PeakRSSSampler() if device == 'cpu' else contextlib.nullcontext()
+    with rss_sampler:
+        for idx, batch in tqdm(enumerate(batches), total=len(batches), desc=desc, file=sys.stdout):
+            timing = run_batch(backend, batch, max_new_tokens)
+            if idx >= args.warmup:
+                timings.append(timing)
+
+    timed_rows = rows[args.warmup * batch_size:]
+    total_time = sum(t["total_time"] for t in timings)
+    prefill_time = sum(t["prefill_time"] for t in timings)
+    generated_tokens = sum(t["generated_tokens"] for t in timings)
+    # the first token of every row comes out of the prefill
+    decode_tokens = generated_tokens - sum(t["rows"] for t in timings)
+    result = {
+        "backend": args.backend,
+        "model": args.model,
+        "batch_size": batch_size,
+        "max_new_tokens": max_new_tokens,
+        "prompt_length": prompt_length,
+        "mean_prompt_tokens": sum(t["prompt_tokens"] for t in timings) / len(timed_rows),
+        # paged attention engines do not pad prompts
+        "padding_efficiency": padding_efficiency([len(ids) for ids in timed_rows], batch_size) if args.backend == 'hf' else 1.0,
+        "ttft_s": sum(t["ttft"] for t in timings) / len(timings),
+        "prefill_tokens_per_s": sum(t["prompt_tokens"] for t in timings) / prefill_time,
+        "decode_tokens_per_s": decode_tokens / (total_time - prefill_time) if total_time > prefill_time else 0.0,
+        "generated_tokens_per_s": generated_tokens / total_time,
+        "mean_generated_tokens": generated_tokens / len(timed_rows),
+        "peak_memory_mb": peak_memory_mb(device, rss_sampler) if device is not None else "",
+    }
+    results.append(result)
+    print(", ".join(f"{k}: {v:.2f}" if isinstance(v, float) else f"{k}: {v}" for k, v in result.items()))
 
-# to use a torch.utils.data.DataSet with the HuggingFace pipeline, we need to flatten out the prompts
-# and repeat them for however many samples we want to generate per prompt
-prompts_repeated = [p for p in prompts for _ in range(args.num_samples_per_prompt)]
-sample_cutoff = args.batch_size * (args.num_batches + args.warmup)
-prompts_repeated = prompts_repeated[:sample_cutoff]
-
-""" Initialize HuggingFace pipeline for generation """
-generator = pipeline(model=args.model, torch_dtype=inference_config.get_dtype(), device=0, trust_remote_code=inference_config.trust_remote_code())
-inference_config.init_padding(generator.tokenizer)
-
-""" Create a prompt data set to pass to generate method """
-prompt_dataset = PromptDataset([inference_config.format_prompt(p["prompt"]) for p in prompts_repeated])
-generated_outputs = generator(
-    prompt_dataset,
-    max_new_tokens=args.max_new_tokens,
-    do_sample=args.do_sample,
-    temperature=args.temperature,
-    top_p=args.top_p,
-    pad_token_id=inference_config.get_pad_token_id(generator.tokenizer),
-    eos_token_id=inference_config.get_eos_token_id(generator.tokenizer),
-    batch_size=args.batch_size,
-)
-
-outputs = []
-past_warmup = False
-for idx, output in tqdm(enumerate(generated_outputs), total=len(prompts_repeated), desc="Generating code", file=sys.stdout):
-    if idx == args.warmup * args.batch_size:
-        past_warmup = True
-        start_time = time.time()
-
-    if past_warmup:
-        outputs.append(output[0]["generated_text"])
-    
-
-duration = time.time() - start_time
-total_tokens = sum(len(generator.tokenizer.encode(o)) for o in outputs)
-print(f"Throughput: {total_tokens / duration} tokens/sec")
+""" Append results to the CSV file """
+write_header = not os.path.exists(args.output) or os.path.getsize(args.output) == 0
+with open(args.output, 'a', newline='') as csv_file:
+    writer = csv.DictWriter(csv_file, fieldnames=list(results[0].keys()))
+    if write_header:
+        writer.writeheader()
+    writer.writerows(results)
+print(f"Wrote {len(results)} results to {args.output}")
@@ -6,12 +6,10 @@ import sys
 import time
 from tqdm import tqdm
 
-# tpl imports
-import torch
-from transformers import pipeline
-
 # local imports
-from utils import BalancedBracketsCriteria, PromptDataset, clean_output, get_inference_config
+from backends import add_backend_args, get_backend
+from generation_cache import GenerationCache
+from utils import clean_output, get_inference_config
 
 
 """ Parse command line arguments """
@@ -33,6 +31,7 @@ parser.add_argument('--top_p', type=float, default=0.95, help='Top p value for n
 parser.add_argument('--do_sample', action='store_true', help='Enable sampling (default: False)')
 parser.add_argument('--batch_size', type=int, default=16, help='Batch size for generation (default: 8)')
 parser.add_argument('--prompted', action='store_true', help='Use prompted generation. See StarCoder paper (default: False)')
+add_backend_args(parser)
 args = parser.parse_args()
 
 """ Load prompts """
@@ -40,114 +39,45 @@ with open(args.prompts, 'r') as json_file:
     prompts = json.load(json_file)
 
 """ Load existing responses if they exist """
-if not args.restart and os.path.exists(args.cache):
-    with open(args.cache, 'r') as jsonl_file:
-        responses = [json.loads(line) for line in jsonl_file]
-    
-    # remove prompt from prompts if it is in responses and has an 'output' value with at least 1 entry
-    original_len = len(prompts)
-    prompts = [p for p in prompts if 
-                not any(p["name"] == r["name"] and 
-                        p["parallelism_model"] == r["parallelism_model"] and
-                        p["translation_prompt"] == r["translation_prompt"] and 
-                        args.temperature == r["temperature"] and 
-                        args.prompted == r["prompted"] and
-                        args.num_samples_per_prompt == len(r["outputs"])
-                        for r in responses)]
-    print(f"[cache] Skipping {original_len - len(prompts)} prompts that already have responses")
-
-""" Load existing responses if they exist """
+# with --restart nothing is restored or cached
+cache = GenerationCache(None if args.restart else args.cache, temperature=args.temperature, top_p=args.top_p,
+                        num_samples=args.num_samples_per_prompt, prompted=args.prompted, prompt_fields=("translation_prompt",))
+print(f"[cache] Read {cache.load()} cached responses")
 if not args.restart and args.restore_from and os.path.exists(args.restore_from):
-    with open(args.restore_from, 'r') as json_file:
-        restored_responses = json.load(json_file)
-    
-    # remove prompt from prompts if it is in responses and has an 'output' value with at least 1 entry
-    original_len = len(prompts)
-    responses_to_keep = []
-    prompts_without_existing_responses = []
-    for p in prompts:
-        for r in restored_responses:
-            if p["name"] == r["name"] and \
-                p["parallelism_model"] == r["parallelism_model"] and \
-                p["translation_prompt"] == r["translation_prompt"] and \
-                args.temperature == r["temperature"] and \
-                args.prompted == r["prompted"] and \
-                args.num_samples_per_prompt == len(r["outputs"]):
-                responses_to_keep.append(r)
-                break
-        else:
-            prompts_without_existing_responses.append(p)
-    prompts = prompts_without_existing_responses
-    print(f"[restore_from] Skipping {original_len - len(prompts)} prompts that already have responses. " +
-        f"{len(prompts)} prompts left.")
+    print(f"[restore_from] Restored {cache.migrate(args.restore_from)} responses")
 
-    # write restored responses to cache
-    if args.cache is not None:
-        with open(args.cache, 'a') as jsonl_file:
-            for response in responses_to_keep:
-                jsonl_file.write(json.dumps(response) + "\n")
-            print(f"[restore_from] Wrote {len(responses_to_keep)} restored responses to cache")
+original_len = len(prompts)
+responses, prompts = cache.split(prompts)
+print(f"[cache] Skipping {original_len - len(prompts)} prompts that already have responses. {len(prompts)} prompts left.")
 
 
 """ Initialize inference config """
 inference_config = get_inference_config(args.model, prompted=args.prompted)
 
-# to use a torch.utils.data.DataSet with the HuggingFace pipeline, we need to flatten out the prompts
-# and repeat them for however many samples we want to generate per prompt
-prompts_repeated = [p for p in prompts for _ in range(args.num_samples_per_prompt)]
-
-""" Initialize HuggingFace pipeline for generation """
-generator = pipeline(model=args.model, torch_dtype=inference_config.get_dtype(), device=0)
-inference_config.init_padding(generator.tokenizer)
-
-""" Create a prompt data set to pass to generate method """
-prompt_dataset = PromptDataset([inference_config.format_prompt(p["translation_prompt"]) for p in prompts_repeated])
-generated_outputs = generator(
-    prompt_dataset,
-    max_new_tokens=args.max_new_tokens,
-    do_sample=args.do_sample,
-    temperature=args.temperature,
-    top_p=args.top_p,
-    pad_token_id=inference_config.get_pad_token_id(generator.tokenizer),
-    eos_token_id=inference_config.get_eos_token_id(generator.tokenizer),
-    batch_size=args.batch_size,
-)
+""" Initialize the inference backend """
+backend = get_backend(args, inference_config, torch_dtype=inference_config.get_dtype())
 
 """ Iterate over prompts and generate code """
-if not args.restart and args.cache is not None and os.path.exists(args.cache):
-    with open(args.cache, 'r') as jsonl_file:
-        responses = [json.loads(line) for line in jsonl_file]
-        responses = [r for r in responses if r["temperature"] == args.temperature and r["prompted"] == args.prompted
-                        and args.num_samples_per_prompt == len(r["outputs"])
-                        and any(p["name"] == r["name"] and p["translation_prompt"] == r["translation_prompt"] and p["parallelism_model"] == r["parallelism_model"] for p in prompts)]
-else:
-    responses = []
-cur_prompt = None
+# prompts finish in any order. Each response is cached as soon as its prompt finishes and the responses are put
+# back in prompt order before they are saved.
+new_responses = []
 start_time = time.time()
-total_tokens = 0
-for idx, (prompt, output) in tqdm(enumerate(zip(prompts_repeated, generated_outputs)), total=len(prompts_repeated), desc="Generating code", file=sys.stdout):
-    if idx % args.num_samples_per_prompt == 0:
-        cur_prompt = prompt.copy()
-        cur_prompt.update({"temperature": args.temperature, "top_p": args.top_p, "do_sample": args.do_sample, "max_new_tokens": args.max_new_tokens, "prompted": args.prompted})
-        cur_prompt["outputs"] = []
-        prompt_str = cur_prompt["translation_prompt"]
-
-    total_tokens += len(generator.tokenizer.encode(output[0]["generated_text"]))
-    cleaned_output = clean_output(output[0]["generated_text"], prompt_str)
-    cur_prompt["outputs"].append(cleaned_output)
-
-    if idx % args.num_samples_per_prompt == args.num_samples_per_prompt - 1:
-        responses.append(cur_prompt)
-
-        if not args.restart and args.cache is not None:
-            with open(args.cache, 'a') as jsonl_file:
-                jsonl_file.write(json.dumps(cur_prompt) + "\n")
-
-    if idx != 0 and idx % args.num_samples_per_prompt == 0:
-        print(f"Tokens per second: {total_tokens / (time.time() - start_time):.2f}")
-
+prompt_texts = [inference_config.format_prompt(p["translation_prompt"]) for p in prompts]
+generated_outputs = backend.generate(prompt_texts, args.num_samples_per_prompt)
+for idx, (prompt_idx, raw_outputs) in tqdm(enumerate(generated_outputs), total=len(prompts), desc="Generating code", file=sys.stdout):
+    cur_prompt = prompts[prompt_idx].copy()
+    cur_prompt.update({"temperature": args.temperature, "top_p": args.top_p, "do_sample": args.do_sample, "max_new_tokens": args.max_new_tokens, "prompted": args.prompted})
+    prompt_str = cur_prompt["translation_prompt"]
+    cur_prompt["outputs"] = [clean_output(output, prompt_str) for output in raw_outputs]
+    new_responses.append((prompt_idx, cur_prompt))
+    cache.add(cur_prompt)
+
+    if idx != 0:
+        print(f"Tokens per second: {backend.generated_tokens / (time.time() - start_time):.2f}")
+
+responses += [response for _, response in sorted(new_responses, key=lambda x: x[0])]
 end_time = time.time()
-tokens_per_second = total_tokens / (end_time - start_time)
+tokens_per_second = backend.generated_tokens / (end_time - start_time)
 print(f"Generated {len(responses)} code samples in {end_time - start_time:.2f} seconds ({tokens_per_second:.2f} tokens per second)")
 
 """ Save responses to JSON file """
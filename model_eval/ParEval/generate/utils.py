@@ -1,11 +1,12 @@
 # std imports
 from abc import ABC, abstractmethod
+import copy
 import re
 
 # tpl imports
 import torch
 from torch.utils.data import Dataset
-from transformers import StoppingCriteria
+from transformers import LogitsProcessor, StoppingCriteria
 
 def clean_output(output : str, prompt : str) -> str:
     """ Remove `prompt` from the begging of `output`.
@@ -538,6 +539,36 @@ class InstructConfig(InferenceConfig):
             code_blocks = re.findall(pattern, output, re.DOTALL)
             return code_blocks[0]
 
+class TinyTestConfig(InferenceConfig):
+    # small models (e.g. a random-weight GPT-2 whose path contains "tiny") for testing the generation scripts on CPU
+
+    def __init__(self, prompted : bool = False, code_opt : bool = False):
+        super().__init__(prompted=prompted)
+        self.code_opt = code_opt
+
+    def get_dtype(self):
+        return torch.float32
+
+    def init_padding(self, tokenizer):
+        tokenizer.pad_token_id = tokenizer.eos_token_id  # for batching
+        tokenizer.padding_side = "left"   # for decoder-only models
+
+    def get_pad_token_id(self, tokenizer) -> int:
+        return tokenizer.pad_token_id
+
+    def get_eos_token_id(self, tokenizer) -> int:
+        return tokenizer.eos_token_id
+
+    def trust_remote_code(self) -> bool:
+        return False
+
+    def format_prompt(self, prompt : str) -> str:
+        # code optimization prompts are passed through as well, the outputs of a tiny model are not code anyway
+        return prompt.strip()
+
+    def clean_output(self, output: str, prompt: str) -> str:
+        return clean_output(output, prompt)
+
 def get_inference_config(model_name : str, **kwargs) -> InferenceConfig:
     if model_name == "bigcode/starcoderbase":
         return StarCoderConfig(**kwargs)
@@ -563,6 +594,8 @@ def get_inference_config(model_name : str, **kwargs) -> InferenceConfig:
         return InstructConfig(instruction_tag='### Instruction', response_tag='### Response', **kwargs)
     elif "speedcode" in model_name:
         return SpeedcodeConfig(**kwargs)
+    elif "tiny" in model_name.lower():
+        return TinyTestConfig(**kwargs)
     else:
         raise ValueError(f"Unknown model name: {model_name}")
 
@@ -582,6 +615,77 @@ class PromptDataset(Dataset):
         return self.prompts_[idx]
 
 
+def expand_cache(past_key_values, repeats : int):
+    ''' Copy of a KV cache with every row repeated `repeats` times, for `Cache` objects and legacy tuples. '''
+    if hasattr(past_key_values, "batch_repeat_interleave"):
+        past_key_values = copy.deepcopy(past_key_values)
+        past_key_values.batch_repeat_interleave(repeats)
+        return past_key_values
+    return tuple(tuple(t.repeat_interleave(repeats, dim=0) for t in layer) for layer in past_key_values)
+
+
+def generate_shared_prefill(model, tokenizer, prompts, num_samples : int, batch_size : int, **generate_kwargs):
+    ''' Sample `num_samples` outputs per prompt, computing each prompt's KV cache only once.
+        `num_return_sequences` in transformers copies the prompt before the forward pass, so every sample
+        prefills the prompt again. Here the prompts are run through the model once and the resulting cache is
+        repeated for the samples, so only decoding is done per sample. Batches hold batch_size // num_samples
+        prompts, or a single prompt whose samples are generated in chunks of batch_size.
+
+        Yields the generated texts of each prompt, in order, as a list in the pipeline's output format:
+        [{"generated_text": prompt + completion}, ...].
+    '''
+    prompts_per_batch = max(1, batch_size // num_samples)
+    samples_per_chunk = num_samples if prompts_per_batch > 1 else batch_size
+    for start in range(0, len(prompts), prompts_per_batch):
+        batch_prompts = prompts[start:start+prompts_per_batch]
+        inputs = tokenizer(batch_prompts, return_tensors="pt", padding=True).to(model.device)
+        input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+
+        # prefill all but the last prompt token, generate then starts from the cache. Positions skip left padding.
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+        past_key_values = None
+        if input_ids.shape[1] > 1:
+            with torch.no_grad():
+                past_key_values = model(input_ids=input_ids[:, :-1], attention_mask=attention_mask[:, :-1],
+                                        position_ids=position_ids[:, :-1], use_cache=True).past_key_values
+
+        outputs = [[] for _ in batch_prompts]
+        for sample_start in range(0, num_samples, samples_per_chunk):
+            repeats = min(samples_per_chunk, num_samples - sample_start)
+            sequences = model.generate(
+                input_ids=input_ids.repeat_interleave(repeats, dim=0),
+                attention_mask=attention_mask.repeat_interleave(repeats, dim=0),
+                past_key_values=expand_cache(past_key_values, repeats) if past_key_values is not None else None,
+                **generate_kwargs
+            )
+            completions = tokenizer.batch_decode(sequences[:, input_ids.shape[1]:], skip_special_tokens=True)
+            for row, completion in enumerate(completions):
+                outputs[row // repeats].append({"generated_text": batch_prompts[row // repeats] + completion})
+
+        for prompt_outputs in outputs:
+            yield prompt_outputs
+
+
+def tokenized_lengths(texts, tokenizer):
+    ''' Number of tokens in each text. '''
+    return [len(ids) for ids in tokenizer(list(texts))["input_ids"]]
+
+
+def length_sorted_order(lengths):
+    ''' Indices ordered from the longest to the shortest length. Batches taken in this order hold prompts of
+        similar length, so padding each batch to its longest prompt wastes few tokens. The longest batch goes
+        first so that running out of memory shows up right away. The sort is stable, so repeated prompts stay
+        next to each other.
+    '''
+    return sorted(range(len(lengths)), key=lambda i: -lengths[i])
+
+
+def padding_efficiency(lengths, batch_size : int) -> float:
+    ''' Fraction of the tokens in padded batches of `batch_size` consecutive prompts that are not padding. '''
+    padded_tokens = sum(max(lengths[i:i+batch_size]) * len(lengths[i:i+batch_size]) for i in range(0, len(lengths), batch_size))
+    return sum(lengths) / padded_tokens if padded_tokens > 0 else 1.0
+
+
 def has_balanced_brackets(text : str, left_bracket : str = '{', right_bracket : str = '}') -> bool:
     ''' Check if string has balanced brackets.
         modified from: https://stackoverflow.com/a/38834249/3769237
@@ -612,20 +716,91 @@ def has_balanced_brackets(text : str, left_bracket : str = '{', right_bracket :
     return balanced and len(stack) == 0
 
 
-class BalancedBracketsCriteria(StoppingCriteria):
-    ''' extension of transformers' text-generation stopping criteria.
-        Stops either when function is complete (i.e. { and } are balanced) or when max_length is surpassed, whichever
-        happens first. 
+class BracketDepthTracker:
+    ''' Keeps the bracket depth of every row of a batch that is being generated, so that checking whether a
+        function is complete costs O(new tokens) per step instead of decoding and re-scanning the whole text.
+        Each token's effect on the depth is looked up in a table built once from the vocabulary.
 
-        _Note:_ This is a slow stopping criteria, but it's much faster than continually running model inference when 
-        it does not need to be run anymore.
+        The depth at the end of the prompt is the row's baseline, usually 1 for a prompt that ends with the opening
+        brace of the function signature. A row is done once the generated tokens bring the depth below its
+        baseline, i.e. the function body is closed. Complete blocks inside the prompt (structs, helper functions,
+        the source function of a translation) do not count.
     '''
 
-    def __init__(self, max_length : int, tokenizer, left_bracket : str = '{', right_bracket : str = '}'):
-        self.max_length = max_length
+    def __init__(self, tokenizer, left_bracket : str = '{', right_bracket : str = '}'):
         self.tokenizer = tokenizer
         self.left_bracket = left_bracket
         self.right_bracket = right_bracket
+        self.delta, self.min_prefix = None, None
+        self.reset_state()
+
+    def build_tables(self, device):
+        # delta: change in depth over the token. min_prefix: lowest depth reached within the token, relative to its
+        # start, so that e.g. "}{" still closes the body.
+        delta, min_prefix = [], []
+        for text in self.tokenizer.batch_decode([[i] for i in range(len(self.tokenizer))]):
+            depth, lowest = 0, 0
+            for c in text:
+                if c == self.left_bracket:
+                    depth += 1
+                elif c == self.right_bracket:
+                    depth -= 1
+                    lowest = min(lowest, depth)
+            delta.append(depth)
+            min_prefix.append(lowest)
+        self.delta = torch.tensor(delta, dtype=torch.long, device=device)
+        self.min_prefix = torch.tensor(min_prefix, dtype=torch.long, device=device)
+
+    def reset_state(self):
+        self.processed = 0
+        self.depth, self.baseline, self.done = None, None, None
+        self.last_tokens = None
+
+    def update(self, input_ids : torch.LongTensor, num_generated : int = 0) -> torch.BoolTensor:
+        ''' Update the depths with the tokens added since the last call and return which rows are done.
+            num_generated: how many of the trailing tokens are already generated on the first call of a batch. Logits
+            processors first see the bare prompt (0), stopping criteria see the prompt and the first new token (1).
+        '''
+        if self.delta is None or self.delta.device != input_ids.device:
+            self.build_tables(input_ids.device)
+
+        # a new call to generate (i.e. a new batch) starts over from the prompt
+        is_continuation = self.done is not None and input_ids.shape[0] == self.done.shape[0] and \
+            input_ids.shape[-1] > self.processed and torch.equal(input_ids[:, self.processed - 1], self.last_tokens)
+        if not is_continuation:
+            self.reset_state()
+            prompt_length = input_ids.shape[-1] - num_generated
+            prompt_ids = input_ids[:, :prompt_length].clamp(max=self.delta.shape[0] - 1)
+            self.baseline = self.delta[prompt_ids].sum(dim=1)
+            self.depth = self.baseline.clone()
+            self.done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+            self.processed = prompt_length
+
+        # usually a single new token per row
+        token_ids = input_ids[:, self.processed:].clamp(max=self.delta.shape[0] - 1)
+        if token_ids.shape[-1] > 0:
+            deltas = self.delta[token_ids]
+            depth_after = self.depth.unsqueeze(1) + deltas.cumsum(dim=1)
+            depth_before = depth_after - deltas
+            closes = depth_before + self.min_prefix[token_ids] < self.baseline.unsqueeze(1)
+            self.done |= closes.any(dim=1)
+            self.depth = depth_after[:, -1]
+
+        self.processed = input_ids.shape[-1]
+        self.last_tokens = input_ids[:, -1].clone()
+        return self.done
+
+
+class BalancedBracketsCriteria(StoppingCriteria):
+    ''' extension of transformers' text-generation stopping criteria.
+        Stops either when function is complete (i.e. { and } are balanced) in every row of the batch or when
+        max_length is surpassed, whichever happens first. The bracket depth is updated incrementally from the new
+        tokens, see `BracketDepthTracker`. Use `BalancedBracketsLogitsProcessor` to stop each row on its own.
+    '''
+
+    def __init__(self, max_length : int, tokenizer, left_bracket : str = '{', right_bracket : str = '}'):
+        self.max_length = max_length
+        self.tracker = BracketDepthTracker(tokenizer, left_bracket=left_bracket, right_bracket=right_bracket)
     
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
         if input_ids.shape[-1] > self.max_length:
@@ -633,9 +808,24 @@ class BalancedBracketsCriteria(StoppingCriteria):
             return True
 
         # return true if {} are balanced i.e. the function is complete
-        return all(
-            has_balanced_brackets(
-                self.tokenizer.decode(t), 
-                left_bracket=self.left_bracket, 
-                right_bracket=self.right_bracket
-            ) for t in input_ids)
+        return bool(self.tracker.update(input_ids, num_generated=1).all())
+
+
+class BalancedBracketsLogitsProcessor(LogitsProcessor):
+    ''' Ends each row of a batch as soon as its function is complete, by forcing the EOS token as the next token.
+        Stopping criteria in transformers stop the whole batch at once, while a row that generated EOS is finished
+        on its own and only receives padding from then on. Generation ends when every row is finished, so a batch
+        takes as long as its longest function rather than always running to max_new_tokens.
+    '''
+
+    def __init__(self, tokenizer, eos_token_id : int, left_bracket : str = '{', right_bracket : str = '}'):
+        self.tracker = BracketDepthTracker(tokenizer, left_bracket=left_bracket, right_bracket=right_bracket)
+        # some inference configs leave the EOS token to the model's default
+        self.eos_token_id = eos_token_id if eos_token_id is not None else tokenizer.eos_token_id
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        done = self.tracker.update(input_ids)
+        if done.any():
+            scores[done] = -float("inf")
+            scores[done, self.eos_token_id] = 0
+        return scores
@@ -1,11 +1,74 @@
 from client.models import *
 from dataclasses import dataclass
-from typing import List, Iterator, Set
+from typing import List, Iterator, Set, Iterable, Optional
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from collections import deque
+from contextlib import contextmanager
 import copy
+import logging
+import os
+import threading
 import random
 import math
 from prettytable import PrettyTable
 
+# normalizes line endings and strips trailing whitespace so that these differences between LLM samples map
+# to the same cache entry. Indentation and blank lines are kept since they can be significant, e.g. in raw
+# string literals, after `\` line continuations and in preprocessor directives.
+def normalize_code(code : str) -> str:
+    lines = [line.rstrip() for line in code.replace("\r\n", "\n").split("\n")]
+    return "\n".join(lines).rstrip("\n")
+
+# orders responses from best to worst: correct before incorrect, then by runtime, then compiled before not compiled.
+def response_rank(response : LLM4PP_SubmissionResponse):
+    if response.correct and response.runtime is not None:
+        return (0, response.runtime)
+    return (1 if response.compiled else 2, 0.0)
+
+# restricts the calling thread, and any processes it launches, to the given cores. Same as pin_to_cores in
+# ParEval/drivers/util.py, used as the initializer of the driver's executors.
+def pin_to_cores(cores : Optional[Set[int]]) -> None:
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+# keeps compiles from running while a submission is benchmarked when they cannot be pinned to separate cores.
+# Any number of compiles may run at once. A benchmark waits for the compiles in flight to finish and new
+# compiles wait until it is done, so waiting benchmarks are not starved by a steady stream of compiles.
+class BuildGate:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.building = 0
+        self.benchmarking = False
+        self.benchmarks_waiting = 0
+
+    @contextmanager
+    def build(self):
+        with self.condition:
+            while self.benchmarking or self.benchmarks_waiting > 0:
+                self.condition.wait()
+            self.building += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.building -= 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def benchmark(self):
+        with self.condition:
+            self.benchmarks_waiting += 1
+            while self.building > 0 or self.benchmarking:
+                self.condition.wait()
+            self.benchmarks_waiting -= 1
+            self.benchmarking = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.benchmarking = False
+                self.condition.notify_all()
+
 class ProblemIterator:
     problem_list : List[LLM4PP_Problem]
     #iterator_index : int = 0
@@ -60,24 +123,58 @@ class SubmissionRunner:
                                          correct=True,\
                                          runtime=random.uniform(0,1),\
                                          reference_runtime=random.uniform(0,1),\
+                                         did_run=True,\
                                         )
 
+    # two-phase interface used by LLM4PP_Driver: build() may run on several worker threads at once, run() is
+    # only ever called by one thread at a time so that timings do not compete for cores. Runners that cannot
+    # compile separately do everything in run().
+    def build(self, submission : LLM4PP_Submission):
+        return submission
+
+    def run(self, built) -> LLM4PP_SubmissionResponse:
+        return self.submit(built)
+
+    # everything besides the submitted code that determines the result of a submission.
+    # used by CachedSubmissionRunner to build cache keys.
+    def cache_key_fields(self, submission : LLM4PP_Submission) -> dict:
+        return {"problem_id" : submission.problem.problem_id}
+
 class LLM4PP_Driver:
     problem_loader : ProblemLoader
     #problem_loader_iterator : Iterator[ProblemLoader]
     problems : List[LLM4PP_Problem]
     responses : List[LLM4PP_SubmissionResponse]
     runner : SubmissionRunner
-
-    def __init__(self, problem_loader : ProblemLoader, runner : SubmissionRunner):
+    # number of submissions that may be compiled concurrently. Submissions are benchmarked one at a time.
+    max_workers : int
+
+    # benchmark_cores/compile_cores: disjoint sets of cores to pin benchmarks and compiles to, so that compiles
+    # can overlap with benchmarks without disturbing their timings. Without them, no compile runs while a
+    # submission is benchmarked.
+    def __init__(self, problem_loader : ProblemLoader, runner : SubmissionRunner, max_workers : int = 1,
+                 benchmark_cores : Optional[Set[int]] = None, compile_cores : Optional[Set[int]] = None):
         assert isinstance(problem_loader, ProblemLoader)
         assert isinstance(runner, SubmissionRunner)
+        assert max_workers >= 1
+        assert (benchmark_cores is None) == (compile_cores is None)
+        assert benchmark_cores is None or len(set(benchmark_cores) & set(compile_cores)) == 0
 
         self.problem_loader = problem_loader
         self.runner = runner
         self.problem_loader_iterator = iter(self.problem_loader)
         self.problems = []
         self.responses = []
+        self.max_workers = max_workers
+        self.executor : Optional[ThreadPoolExecutor] = None
+        # a single thread that benchmarks compiled submissions one at a time, in the order they finished compiling.
+        self.benchmark_executor : Optional[ThreadPoolExecutor] = None
+        # futures in submission order that have not yet been moved into self.responses.
+        self.pending_submissions = deque()
+        self.responses_lock = threading.Lock()
+        self.benchmark_cores = benchmark_cores
+        self.compile_cores = compile_cores
+        self.build_gate = BuildGate() if benchmark_cores is None else None
 
     def __iter__(self) -> Iterator[LLM4PP_Problem]:
         return self
@@ -90,13 +187,144 @@ class LLM4PP_Driver:
         self.problems.append(copy.deepcopy(n))
         return n
     
-    def submit(self, submission : LLM4PP_Submission) -> None:
+    def submit(self, submission : LLM4PP_Submission) -> LLM4PP_SubmissionResponse:
+        response = self.submit_async(submission).result()
+        self._collect_completed_submissions()
+        return response
+
+    # must be called with responses_lock held.
+    def _start_executors(self) -> None:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, initializer=pin_to_cores,
+                                               initargs=(self.compile_cores,))
+        if self.benchmark_executor is None:
+            self.benchmark_executor = ThreadPoolExecutor(max_workers=1, initializer=pin_to_cores,
+                                                         initargs=(self.benchmark_cores,))
+
+    def _build(self, submission : LLM4PP_Submission):
+        if self.build_gate is None:
+            return self.runner.build(submission)
+        with self.build_gate.build():
+            return self.runner.build(submission)
+
+    def _benchmark(self, fn, *args):
+        if self.build_gate is None:
+            return fn(*args)
+        with self.build_gate.benchmark():
+            return fn(*args)
+
+    # compiles the submission on the worker pool, then queues it on the benchmark thread. With separate compile
+    # cores the worker is free to compile the next submission while earlier ones are timed, otherwise compiles
+    # pause during each benchmark. Must be called with responses_lock held.
+    def _build_and_run(self, submission : LLM4PP_Submission) -> 'Future[LLM4PP_SubmissionResponse]':
+        self._start_executors()
+        response = Future()
+        def copy_result(future : Future) -> None:
+            if future.exception() is not None:
+                response.set_exception(future.exception())
+            else:
+                response.set_result(future.result())
+        def built(build_future : Future) -> None:
+            if build_future.exception() is not None:
+                response.set_exception(build_future.exception())
+                return
+            self.benchmark_executor.submit(self._benchmark, self.runner.run, build_future.result()).add_done_callback(copy_result)
+        self.executor.submit(self._build, submission).add_done_callback(built)
+        return response
+
+    # benchmarks outside of a submission (e.g. baselines) run on the benchmark thread as well.
+    def run_benchmark(self, fn, *args):
+        with self.responses_lock:
+            self._start_executors()
+            future = self.benchmark_executor.submit(self._benchmark, fn, *args)
+        return future.result()
+
+    # queues the submission on the worker pool and returns a future for its response.
+    # responses are appended to self.responses in submission order, not completion order.
+    def submit_async(self, submission : LLM4PP_Submission) -> 'Future[LLM4PP_SubmissionResponse]':
         submission = LLM4PP_Submission.parse_obj(submission) # validate
-        response = self.runner.submit(submission)
-        self.responses.append(response)
+        with self.responses_lock:
+            future = self._build_and_run(submission)
+            self.pending_submissions.append(future)
+        future.add_done_callback(self._collect_completed_submissions)
+        return future
+
+    def submit_many(self, submissions : Iterable[LLM4PP_Submission]) -> List['Future[LLM4PP_SubmissionResponse]']:
+        return [self.submit_async(x) for x in submissions]
+
+    # compiles every candidate solution of the problem on the worker pool, benchmarks them one at a time and records only the best
+    # response: the fastest correct one, or else the first one that compiled. Candidates that only differ
+    # in line endings or trailing whitespace are run once. The other responses are available from the future's .candidate_responses.
+    def submit_best_of_async(self, problem : LLM4PP_Problem, candidates : Iterable[str]) -> 'Future[LLM4PP_SubmissionResponse]':
+        unique_candidates = dict()
+        for code in candidates:
+            unique_candidates.setdefault(normalize_code(code), code)
+        assert len(unique_candidates) > 0, "submit_best_of needs at least one candidate"
+        submissions = [LLM4PP_Submission(problem=problem, submitted_code=code) for code in unique_candidates.values()]
+
+        best = Future()
+        with self.responses_lock:
+            candidate_futures = [self._build_and_run(x) for x in submissions]
+            self.pending_submissions.append(best)
+
+        remaining = [len(candidate_futures)]
+        remaining_lock = threading.Lock()
+        def candidate_done(_future : Future) -> None:
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            responses = [f.result() for f in candidate_futures if f.exception() is None]
+            if len(responses) == 0:
+                best.set_exception(candidate_futures[0].exception())
+                return
+            # sorted() is stable, so ties go to the earlier candidate
+            responses = sorted(responses, key=response_rank)
+            best.candidate_responses = responses
+            best.set_result(responses[0])
+
+        for f in candidate_futures:
+            f.add_done_callback(candidate_done)
+        best.add_done_callback(self._collect_completed_submissions)
+        return best
+
+    def submit_best_of(self, problem : LLM4PP_Problem, candidates : Iterable[str]) -> LLM4PP_SubmissionResponse:
+        response = self.submit_best_of_async(problem, candidates).result()
+        self._collect_completed_submissions()
         return response
 
+    # moves the longest completed prefix of pending submissions into self.responses.
+    # failed submissions have no response; they are logged here and their exception is raised by future.result().
+    def _collect_completed_submissions(self, _future : Optional[Future] = None) -> None:
+        with self.responses_lock:
+            while len(self.pending_submissions) > 0 and self.pending_submissions[0].done():
+                future = self.pending_submissions.popleft()
+                if future.cancelled():
+                    logging.warning("submission was cancelled, no response recorded")
+                elif future.exception() is not None:
+                    logging.warning("submission failed, no response recorded: %r", future.exception())
+                else:
+                    self.responses.append(future.result())
+
+    # blocks until every in-flight submission has finished.
+    def wait_for_submissions(self) -> None:
+        with self.responses_lock:
+            in_flight = list(self.pending_submissions)
+        wait(in_flight)
+        self._collect_completed_submissions()
+
+    def shutdown(self) -> None:
+        self.wait_for_submissions()
+        with self.responses_lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+            if self.benchmark_executor is not None:
+                self.benchmark_executor.shutdown()
+                self.benchmark_executor = None
+
     def save_all_responses(self, filename):
+        self.wait_for_submissions()
         open(filename, 'w+').write(LLM4PP_SubmissionResponseList(responses=self.responses).json())
 
     def sanity_check(self) -> bool:
@@ -113,6 +341,7 @@ class LLM4PP_Driver:
             response_problem_ids.add(x.submission.problem.problem_id)
 
     def evaluate(self):
+        self.wait_for_submissions()
         sanity_check_passed = False
         #try:
         sanity_check_passed = self.sanity_check()
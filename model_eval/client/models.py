@@ -46,6 +46,13 @@ class LLM4PP_SubmissionResponse(BaseModel):
     correct : bool
     runtime : float
     reference_runtime : Optional[float] = None
+    # statistics over the timed iterations of the submitted code. runtime is their mean.
+    runtime_median : Optional[float] = None
+    runtime_min : Optional[float] = None
+    runtime_stddev : Optional[float] = None
+    runtime_samples : Optional[List[float]] = None
+    # every benchmark run finished, i.e. nothing crashed or timed out. Only such responses are cached.
+    did_run : Optional[bool] = None
     # used for debugging
     stdout : Optional[str] = None
     stderr : Optional[str] = None
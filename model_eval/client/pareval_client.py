@@ -1,11 +1,15 @@
+import hashlib
 import json
 import os
 import subprocess
 import shlex
+import sys
 import tempfile
+from typing import Optional, Tuple
 
 from client.driver import LLM4PP_Driver, ProblemIterator, ProblemLoader, SubmissionRunner
 from client.models import BenchmarkDescription, LLM4PP_Problem, LLM4PP_Submission, LLM4PP_SubmissionResponse
+from client.submission_cache import BaselineCache, CachedSubmissionRunner, SubmissionCache, machine_fingerprint
 
 def create_generation_dict(problem_category: str, problem_unique_id: str, optimized_code: str, prompt: str = ""):
     d = {}
@@ -20,10 +24,10 @@ def create_generation_dict(problem_category: str, problem_unique_id: str, optimi
 
     return [d]
 
-def run_driver(gen_file: str, problem_sizes_file: str = "problem-sizes.json", run_timeout: int = 300, launch_configs: str = "launch-configs-speedcode.json") -> str:
+def run_driver(gen_file: str, problem_sizes_file: str = "problem-sizes.json", run_timeout: int = 300, launch_configs: str = "launch-configs-speedcode.json", benchmark_mode: str = "all") -> str:
     # delete set to False as need this file in another function
     with tempfile.NamedTemporaryFile(suffix=".json") as output_f:
-        args = f"python run-all.py {gen_file} -o {output_f.name} --yes-to-all --problem-sizes {problem_sizes_file} --run-timeout {run_timeout} --launch-configs {launch_configs} --code_opt True"
+        args = f"python run-all.py {gen_file} -o {output_f.name} --yes-to-all --problem-sizes {problem_sizes_file} --run-timeout {run_timeout} --launch-configs {launch_configs} --benchmark-mode {benchmark_mode} --no-journal --code_opt True"
 
         subprocess_args = shlex.split(args)
         proc = subprocess.run(subprocess_args, cwd="ParEval/drivers", capture_output=True, text=True)
@@ -37,39 +41,108 @@ def run_driver(gen_file: str, problem_sizes_file: str = "problem-sizes.json", ru
 
         return driver_info_dict, output, error
 
-def pareval_submit(problem_category: str, problem_unique_id: str, optimized_code: str):
+def summarize_run_info(run_info: dict, stdout: str, stderr: str, reference_runtime: Optional[float] = None) -> dict:
+    """ Convert the results json entry of one output into the fields used for LLM4PP_SubmissionResponse.
+        If reference_runtime is given it is used as the baseline instead of the measured best sequential runtime.
+    """
+    output_dict = {}
+
+    output_dict["did_build"] = bool(run_info["did_build"])
+    output_dict["did_run"] = bool(run_info["did_all_run"])
+    output_dict["is_valid"] = bool(run_info["are_all_valid"])
+
+    baseline_runtime = reference_runtime if reference_runtime is not None else run_info["best_sequential_runtime"]
+    if baseline_runtime is None:
+        baseline_runtime = 0.0
+
+    output_dict["baseline_runtime"] = baseline_runtime
+    # code did not compile or code did not run without errors
+    if run_info["runs"] is None or run_info["runs"][0]["runtime"] is None:
+        output_dict["optimized_runtime"] = baseline_runtime
+    else:
+        output_dict["optimized_runtime"] = float(run_info["runs"][0]["runtime"])
+
+    for stat in ["runtime_median", "runtime_min", "runtime_stddev", "runtime_samples"]:
+        output_dict[stat] = run_info["runs"][0].get(stat) if run_info["runs"] else None
+
+    output_dict["stdout"] = stdout
+    output_dict["stderr"] = stderr
+
+    return output_dict
+
+def get_benchmark_mode(reference_runtime: Optional[float], benchmark_mode: Optional[str]) -> str:
+    """ Skip timing the best sequential code when the reference runtime is already known. """
+    if benchmark_mode is not None:
+        return benchmark_mode
+    return "skip-best" if reference_runtime is not None else "all"
+
+def pareval_submit(problem_category: str, problem_unique_id: str, optimized_code: str, reference_runtime: Optional[float] = None, benchmark_mode: Optional[str] = None):
     gen_dict = create_generation_dict(problem_category, problem_unique_id, optimized_code)
 
     with tempfile.NamedTemporaryFile(suffix=".json") as gen_f:
         with open(gen_f.name, "w") as f:
             json.dump(gen_dict, f, indent=4)
 
-        driver_info_dict, driver_stdout, driver_stderr = run_driver(gen_f.name)
-
-        output_dict = {}
+        driver_info_dict, driver_stdout, driver_stderr = run_driver(gen_f.name, benchmark_mode=get_benchmark_mode(reference_runtime, benchmark_mode))
 
         # assume length of outputs is 1 as only test 1 output at a time
         run_info = driver_info_dict[0]["outputs"][0]
 
-        output_dict["did_build"] = bool(run_info["did_build"])
-        output_dict["did_run"] = bool(run_info["did_all_run"])
-        output_dict["is_valid"] = bool(run_info["are_all_valid"])
+        return summarize_run_info(run_info, driver_stdout, driver_stderr, reference_runtime=reference_runtime)
+
+def load_cpp_driver_wrapper_module(drivers_root: str = "ParEval/drivers"):
+    """ Import the cpp_driver_wrapper module from the ParEval drivers directory.
+        The driver modules import each other as top level modules (util, cpp, drivers), so both
+        the drivers directory and its parent need to be importable.
+    """
+    drivers_root = os.path.abspath(drivers_root)
+    for path in (drivers_root, os.path.dirname(drivers_root)):
+        if path not in sys.path:
+            sys.path.append(path)
+    import cpp.cpp_driver_wrapper
+    return cpp.cpp_driver_wrapper
+
+class ParEvalInProcessRunner:
+    """ Runs submissions through CppDriverWrapper in the current process.
+        Equivalent to pareval_submit, but the driver wrapper, launch configs and problem sizes are
+        loaded once instead of spawning run-all.py for every candidate.
+    """
+    def __init__(self, drivers_root: str = "ParEval/drivers", problem_sizes_file: str = "problem-sizes.json",
+                 run_timeout: int = 300, build_timeout: int = 30, launch_configs: str = "launch-configs-speedcode.json",
+                 scratch_dir: Optional[str] = None):
+        self.drivers_root = os.path.abspath(drivers_root)
+        with open(os.path.join(self.drivers_root, launch_configs)) as f:
+            launch_configs_dict = json.load(f)
+        with open(os.path.join(self.drivers_root, problem_sizes_file)) as f:
+            self.problem_sizes = json.load(f)
+
+        cpp_driver_wrapper = load_cpp_driver_wrapper_module(self.drivers_root)
+        self.driver = cpp_driver_wrapper.CppDriverWrapper(parallelism_model="omp", launch_configs=launch_configs_dict,
+            problem_sizes=self.problem_sizes, scratch_dir=scratch_dir, build_timeout=build_timeout,
+            run_timeout=run_timeout, code_opt=True)
 
-        baseline_runtime = run_info["best_sequential_runtime"]
-        if baseline_runtime is None:
-            baseline_runtime = 0.0
+    def test_driver_file(self, problem_category: str, problem_unique_id: str) -> str:
+        return os.path.join(self.drivers_root, "cpp", "benchmarks", problem_category, problem_unique_id, "cpu.cc")
 
-        output_dict["baseline_runtime"] = baseline_runtime
-        # code did not compile or code did not run without errors
-        if run_info["runs"] is None or run_info["runs"][0]["runtime"] is None:
-            output_dict["optimized_runtime"] = baseline_runtime
-        else:
-            output_dict["optimized_runtime"] = float(run_info["runs"][0]["runtime"])
+    # compiles a submission. May be called from several threads at once.
+    def build(self, problem_category: str, problem_unique_id: str, optimized_code: str):
+        problem_size = self.problem_sizes.get(problem_unique_id, {}).get(self.driver.parallelism_model, "(1<<18)")
+        return self.driver.build_single_output("", optimized_code, self.test_driver_file(problem_category, problem_unique_id), problem_size)
 
-        output_dict["stdout"] = driver_stdout
-        output_dict["stderr"] = driver_stderr
+    # benchmarks a submission compiled by build() and removes its build directory.
+    def run(self, optimized_code: str, built, reference_runtime: Optional[float] = None, benchmark_mode: Optional[str] = None) -> dict:
+        results = self.driver.run_built_output(built, benchmark_mode=get_benchmark_mode(reference_runtime, benchmark_mode))
+        run_info = self.driver.summarize_output(optimized_code, results)
 
-        return output_dict
+        # there is no run-all.py process to capture output from, so report the build and run output instead.
+        run_outputs = results.run_outputs if results.run_outputs is not None else []
+        stdout = "\n".join([results.build_output.stdout] + [r.stdout for r in run_outputs])
+        stderr = "\n".join([results.build_output.stderr] + [r.stderr for r in run_outputs])
+        return summarize_run_info(run_info, stdout, stderr, reference_runtime=reference_runtime)
+
+    def submit(self, problem_category: str, problem_unique_id: str, optimized_code: str, reference_runtime: Optional[float] = None, benchmark_mode: Optional[str] = None) -> dict:
+        built = self.build(problem_category, problem_unique_id, optimized_code)
+        return self.run(optimized_code, built, reference_runtime=reference_runtime, benchmark_mode=benchmark_mode)
 
 class ParEvalProblemLoader(ProblemLoader):
     def __init__(self, data_path : str):
@@ -86,27 +159,148 @@ class ParEvalProblemLoader(ProblemLoader):
         self.problem_iterator = ProblemIterator(self.problem_list)
 
 class ParEvalSubmissionRunner(SubmissionRunner):
-    def __init__(self):
-        pass
+    # in_process: test submissions with ParEvalInProcessRunner instead of spawning run-all.py for each one.
+    # baseline_cache: reuse best sequential runtimes measured by earlier submissions of the same problem.
+    def __init__(self, in_process : bool = True, drivers_root : str = "ParEval/drivers",
+                 problem_sizes_file : str = "problem-sizes.json", launch_configs : str = "launch-configs-speedcode.json",
+                 baseline_cache : Optional[BaselineCache] = None):
+        self.in_process_runner = ParEvalInProcessRunner(drivers_root=drivers_root, problem_sizes_file=problem_sizes_file,
+                                                        launch_configs=launch_configs) if in_process else None
+        with open(os.path.join(drivers_root, launch_configs)) as f:
+            self.launch_configs = json.load(f)["omp"]
+        with open(os.path.join(drivers_root, problem_sizes_file)) as f:
+            self.problem_sizes = json.load(f)
+        self.compiler_settings = load_cpp_driver_wrapper_module(drivers_root).COMPILER_SETTINGS["omp"]
+        self.baseline_cache = baseline_cache
+        self.drivers_root = drivers_root
+        # the mode submissions are timed in once the baseline of their problem is known.
+        self.benchmark_mode = "skip-best" if baseline_cache is not None else "all"
+
+    def problem_size(self, problem_id : str) -> str:
+        return self.problem_sizes.get(problem_id, {}).get("omp", "(1<<18)")
+
+    # hash of the sources that build and time a submission of the problem: the omp model driver, the shared
+    # utilities and the problem's benchmark. Editing any of them invalidates cached results.
+    def harness_hash(self, problem : LLM4PP_Problem) -> str:
+        cpp_root = os.path.join(self.drivers_root, "cpp")
+        benchmark_dir = os.path.join(cpp_root, "benchmarks", problem.category, problem.problem_id)
+        paths = [os.path.join(cpp_root, "models", "omp-driver.cc"),
+                 os.path.join(cpp_root, "utilities.hpp"),
+                 os.path.join(cpp_root, "xoshiro.h"),
+                 os.path.join(benchmark_dir, "cpu.cc"),
+                 os.path.join(benchmark_dir, "baseline.hpp")]
+        digest = hashlib.sha256()
+        for path in paths:
+            digest.update(path.encode("utf-8"))
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+        return digest.hexdigest()
+
+    def cache_key_fields(self, submission : LLM4PP_Submission) -> dict:
+        problem_id = submission.problem.problem_id
+        return {"problem_id" : problem_id,
+                "compiler_settings" : self.compiler_settings,
+                "problem_size" : self.problem_size(problem_id),
+                "launch_configs" : self.launch_configs,
+                "machine" : machine_fingerprint(),
+                "benchmark_mode" : self.benchmark_mode,
+                "harness" : self.harness_hash(submission.problem)}
+
+    # built: the output of ParEvalInProcessRunner.build, if the code was already compiled.
+    def _run(self, problem : LLM4PP_Problem, code : str, built = None, reference_runtime : Optional[float] = None, benchmark_mode : Optional[str] = None) -> dict:
+        if built is not None:
+            return self.in_process_runner.run(code, built, reference_runtime=reference_runtime, benchmark_mode=benchmark_mode)
+        if self.in_process_runner is not None:
+            return self.in_process_runner.submit(problem.category, problem.problem_id, code, reference_runtime=reference_runtime, benchmark_mode=benchmark_mode)
+        return pareval_submit(problem.category, problem.problem_id, code, reference_runtime=reference_runtime, benchmark_mode=benchmark_mode)
+
+    # baseline-only mode: time the best sequential code for the problem and store it in the baseline cache.
+    def record_baseline(self, problem : LLM4PP_Problem) -> Optional[float]:
+        assert self.baseline_cache is not None
+        result = self._run(problem, problem.source_code, benchmark_mode="best-only")
+        if result["did_run"] and result["baseline_runtime"] > 0:
+            self.baseline_cache.record(problem.problem_id, self.problem_size(problem.problem_id), result["baseline_runtime"])
+            return result["baseline_runtime"]
+        return None
+
+    # run-all.py compiles and runs in one process, so out-of-process submissions are only compiled in run().
+    def build(self, submission : LLM4PP_Submission):
+        built = None
+        if self.in_process_runner is not None:
+            problem = submission.problem
+            built = self.in_process_runner.build(problem.category, problem.problem_id, submission.submitted_code)
+        return submission, built
 
     def submit(self, submission : LLM4PP_Submission):
-        # generate fake results.
+        return self.run(self.build(submission))
+
+    def run(self, built) -> LLM4PP_SubmissionResponse:
+        submission, built_output = built
         problem = submission.problem
-        result = pareval_submit(problem.category, problem.problem_id, submission.submitted_code)
+        reference_runtime = None
+        if self.baseline_cache is not None:
+            reference_runtime = self.baseline_cache.get(problem.problem_id, self.problem_size(problem.problem_id))
+
+        result = self._run(problem, submission.submitted_code, built=built_output, reference_runtime=reference_runtime)
+
+        # the baseline was measured as part of this run, keep it for later submissions.
+        if self.baseline_cache is not None and reference_runtime is None and result["did_run"] and result["baseline_runtime"] > 0:
+            self.baseline_cache.record(problem.problem_id, self.problem_size(problem.problem_id), result["baseline_runtime"])
         return LLM4PP_SubmissionResponse(submission=submission,\
                                          compiled=result["did_build"],\
                                          correct=result["is_valid"],\
                                          runtime=result["optimized_runtime"],\
                                          reference_runtime=result["baseline_runtime"],\
+                                         runtime_median=result["runtime_median"],\
+                                         runtime_min=result["runtime_min"],\
+                                         runtime_stddev=result["runtime_stddev"],\
+                                         runtime_samples=result["runtime_samples"],\
+                                         did_run=result["did_build"] and result["did_run"],\
                                          stdout=result["stdout"],\
                                          stderr=result["stderr"],\
                                         )
 
+def get_core_sets(launch_configs : dict, benchmark_cores : Optional[str] = None) -> Tuple[Optional[set], Optional[set]]:
+    """ Split the available cores into (benchmark cores, compile cores) like run-all.py does. benchmark_cores is a
+        core list such as '0-7' and defaults to the first N cores, where N is the largest thread count in the omp
+        launch configs. Returns (None, None) if the cores cannot be split.
+    """
+    from util import parse_core_list
+    if not hasattr(os, "sched_getaffinity"):
+        return None, None
+    available = sorted(os.sched_getaffinity(0))
+    if benchmark_cores:
+        benchmark_core_set = parse_core_list(benchmark_cores) & set(available)
+    else:
+        num_threads = max((params.get("num_threads", 1) for params in launch_configs["params"]), default=1)
+        benchmark_core_set = set(available[:num_threads])
+    compile_core_set = set(available) - benchmark_core_set
+    if len(benchmark_core_set) == 0 or len(compile_core_set) == 0:
+        return None, None
+    return benchmark_core_set, compile_core_set
+
 class ParEvalDriver(LLM4PP_Driver):
-    def __init__(self, data_path="ParEval/prompts/code_opt.json"):
-        self.problem_loader = ParEvalProblemLoader(data_path)
-        self.runner = ParEvalSubmissionRunner()
-        self.problems = []
-        self.responses = []
-        self.problem_loader_iterator = iter(self.problem_loader)
+    # use_cache: reuse results of identical earlier submissions. Off by default so that scoring runs measure every submission.
+    # use_baseline_cache: measure the best sequential runtime once per problem instead of for every submission.
+    # benchmark_cores: cores to benchmark on, e.g. '0-7'. Compiles are pinned to the remaining cores; if there are
+    # none, compiles wait while a submission is benchmarked.
+    def __init__(self, data_path="ParEval/prompts/code_opt.json", max_workers : int = 1, in_process : bool = True,
+                 use_cache : bool = False, cache_path : Optional[str] = None, use_baseline_cache : bool = True,
+                 baseline_cache_path : Optional[str] = None, benchmark_cores : Optional[str] = None):
+        baseline_cache = None
+        if use_baseline_cache:
+            baseline_cache = BaselineCache(baseline_cache_path) if baseline_cache_path is not None else BaselineCache()
+        self.pareval_runner = ParEvalSubmissionRunner(in_process=in_process, baseline_cache=baseline_cache)
+        runner = self.pareval_runner
+        if use_cache:
+            cache = SubmissionCache(cache_path) if cache_path is not None else SubmissionCache()
+            runner = CachedSubmissionRunner(runner, cache)
+        benchmark_core_set, compile_core_set = get_core_sets(self.pareval_runner.launch_configs, benchmark_cores)
+        super().__init__(ParEvalProblemLoader(data_path), runner, max_workers=max_workers,
+                         benchmark_cores=benchmark_core_set, compile_cores=compile_core_set)
 
+    # measures and caches the best sequential runtime of every problem without submitting anything.
+    def record_baselines(self) -> None:
+        for problem in self.problem_loader:
+            self.run_benchmark(self.pareval_runner.record_baseline, problem)
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import logging
+import os
+import platform
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from client.driver import SubmissionRunner, normalize_code
+from client.models import LLM4PP_Submission, LLM4PP_SubmissionResponse
+
+DEFAULT_CACHE_DIR = ".llm4pp-cache"
+
+def _cpu_model_name() -> str:
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+# identifies the machine results were measured on. Runtimes are not comparable across machines.
+def machine_fingerprint() -> dict:
+    return {"node" : platform.node(),
+            "machine" : platform.machine(),
+            "cpu" : _cpu_model_name(),
+            "cpu_count" : os.cpu_count()}
+
+class SubmissionCache:
+    """ Content-addressed on-disk store of submission responses, backed by sqlite.
+        Entries are evicted least-recently-used first once the total stored size exceeds max_size_bytes.
+    """
+    def __init__(self, path : str = os.path.join(DEFAULT_CACHE_DIR, "submissions.sqlite"), max_size_bytes : int = 256 * 1024 * 1024):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                                    "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                                    "size INTEGER NOT NULL, last_access REAL NOT NULL)")
+
+    @staticmethod
+    def key(submission : LLM4PP_Submission, key_fields : dict) -> str:
+        material = {"code" : normalize_code(submission.submitted_code),
+                    "fields" : key_fields}
+        return hashlib.sha256(json.dumps(material, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key : str, submission : LLM4PP_Submission) -> Optional[LLM4PP_SubmissionResponse]:
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.connection:
+                self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        # the stored response does not include the submission, reattach the one that was just made.
+        return LLM4PP_SubmissionResponse(submission=submission, **json.loads(row[0]))
+
+    def put(self, key : str, response : LLM4PP_SubmissionResponse) -> None:
+        data = json.dumps(response.dict(exclude={"submission"}))
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                                    (key, data, len(data), time.time()))
+            self._evict()
+
+    def _evict(self) -> None:
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total_size <= self.max_size_bytes:
+                break
+            evicted.append((key,))
+            total_size -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def clear(self) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM responses")
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+class CachedSubmissionRunner(SubmissionRunner):
+    """ Wraps a SubmissionRunner so that identical resubmissions skip compiling and running.
+        Only responses whose benchmark runs all finished are stored.
+    """
+    def __init__(self, runner : SubmissionRunner, cache : Optional[SubmissionCache] = None):
+        assert isinstance(runner, SubmissionRunner)
+        self.runner = runner
+        self.cache = cache if cache is not None else SubmissionCache()
+
+    def cache_key_fields(self, submission : LLM4PP_Submission) -> dict:
+        return self.runner.cache_key_fields(submission)
+
+    # cached submissions are neither compiled nor benchmarked.
+    def build(self, submission : LLM4PP_Submission):
+        key = self.cache.key(submission, self.runner.cache_key_fields(submission))
+        response = self.cache.get(key, submission)
+        if response is not None:
+            return key, response, None
+        return key, None, self.runner.build(submission)
+
+    def run(self, built) -> LLM4PP_SubmissionResponse:
+        key, response, runner_built = built
+        if response is None:
+            response = self.runner.run(runner_built)
+            # build failures, crashes and timeouts may be transient (e.g. a loaded machine), so they are
+            # measured again the next time instead of being replayed.
+            if response.compiled and response.did_run:
+                self.cache.put(key, response)
+        return response
+
+    def submit(self, submission : LLM4PP_Submission):
+        return self.run(self.build(submission))
+
+class BaselineCache:
+    """ On-disk store of best sequential runtimes per (problem, problem size, machine), backed by sqlite.
+        A cached runtime is handed out revalidate_every times before get() returns None again, so that the
+        next submission re-measures the baseline. Drift beyond drift_tolerance between measurements is logged.
+    """
+    def __init__(self, path : str = os.path.join(DEFAULT_CACHE_DIR, "baselines.sqlite"), revalidate_every : int = 25,
+                 drift_tolerance : float = 0.1):
+        self.path = path
+        self.revalidate_every = revalidate_every
+        self.drift_tolerance = drift_tolerance
+        self.machine = json.dumps(machine_fingerprint(), sort_keys=True)
+        self.lock = threading.Lock()
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS baselines ("
+                                    "problem_id TEXT NOT NULL, problem_size TEXT NOT NULL, machine TEXT NOT NULL, "
+                                    "runtime REAL NOT NULL, uses INTEGER NOT NULL, measured_at REAL NOT NULL, "
+                                    "PRIMARY KEY (problem_id, problem_size, machine))")
+
+    def get(self, problem_id : str, problem_size : str) -> Optional[float]:
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT runtime, uses FROM baselines WHERE problem_id = ? AND problem_size = ? AND machine = ?",
+                                          (problem_id, problem_size, self.machine)).fetchone()
+            if row is None or row[1] >= self.revalidate_every:
+                return None
+            self.connection.execute("UPDATE baselines SET uses = uses + 1 WHERE problem_id = ? AND problem_size = ? AND machine = ?",
+                                    (problem_id, problem_size, self.machine))
+            return row[0]
+
+    def record(self, problem_id : str, problem_size : str, runtime : float) -> None:
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT runtime FROM baselines WHERE problem_id = ? AND problem_size = ? AND machine = ?",
+                                          (problem_id, problem_size, self.machine)).fetchone()
+            if row is not None and row[0] > 0 and abs(runtime - row[0]) / row[0] > self.drift_tolerance:
+                logging.warning(f"Best sequential runtime of {problem_id} drifted from {row[0]} to {runtime}.")
+            self.connection.execute("INSERT OR REPLACE INTO baselines (problem_id, problem_size, machine, runtime, uses, measured_at) "
+                                    "VALUES (?, ?, ?, ?, 0, ?)", (problem_id, problem_size, self.machine, runtime, time.time()))
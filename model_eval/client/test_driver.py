@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+
+import pytest
+
+import client.driver
+from client.driver import LLM4PP_Driver, ProblemLoader, SubmissionRunner, normalize_code, response_rank
+from client.models import LLM4PP_Submission, LLM4PP_SubmissionResponse
+
+# records how many submissions are compiled and benchmarked at the same time.
+class RecordingRunner(SubmissionRunner):
+    def __init__(self, build_time : float = 0.05, run_time : float = 0.02):
+        self.build_time = build_time
+        self.run_time = run_time
+        self.lock = threading.Lock()
+        self.building = 0
+        self.running = 0
+        self.max_building = 0
+        self.max_running = 0
+        self.max_building_while_running = 0
+        self.runtimes = {}
+
+    def build(self, submission : LLM4PP_Submission):
+        with self.lock:
+            self.building += 1
+            self.max_building = max(self.max_building, self.building)
+            if self.running > 0:
+                self.max_building_while_running = max(self.max_building_while_running, self.building)
+        time.sleep(self.build_time)
+        with self.lock:
+            self.building -= 1
+        return submission
+
+    def run(self, built : LLM4PP_Submission) -> LLM4PP_SubmissionResponse:
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.run_time)
+        with self.lock:
+            self.running -= 1
+        runtime = self.runtimes.get(built.submitted_code, 1.0)
+        return LLM4PP_SubmissionResponse(submission=built, compiled=True, correct=runtime is not None,
+                                         runtime=runtime if runtime is not None else 0.0, reference_runtime=1.0)
+
+def make_driver(runner : SubmissionRunner, max_workers : int = 4, **kwargs) -> LLM4PP_Driver:
+    return LLM4PP_Driver(ProblemLoader(""), runner, max_workers=max_workers, **kwargs)
+
+def submit_all(driver : LLM4PP_Driver, count : int = 8) -> None:
+    problems = [next(driver) for _ in range(count)]
+    futures = driver.submit_many(LLM4PP_Submission(problem=p, submitted_code=f"code {i}") for i, p in enumerate(problems))
+    for future in futures:
+        future.result()
+    driver.shutdown()
+
+def test_submissions_compile_concurrently_and_benchmark_one_at_a_time():
+    runner = RecordingRunner()
+    submit_all(make_driver(runner))
+    assert runner.max_running == 1
+    assert runner.max_building > 1
+    # without separate compile cores, nothing is compiled while a submission is timed
+    assert runner.max_building_while_running == 0
+
+def test_compiles_overlap_benchmarks_on_separate_cores(monkeypatch):
+    pinned = []
+    monkeypatch.setattr(client.driver, "pin_to_cores", pinned.append)
+    runner = RecordingRunner()
+    submit_all(make_driver(runner, benchmark_cores={0}, compile_cores={1, 2}))
+    assert runner.max_running == 1
+    # later submissions keep compiling while an earlier one is timed
+    assert runner.max_building_while_running >= 1
+    # one benchmark thread on core 0, every compile worker on cores 1 and 2
+    assert [cores for cores in pinned if cores == {0}] == [{0}]
+    assert all(cores in ({0}, {1, 2}) for cores in pinned)
+
+def test_overlapping_core_sets_are_rejected():
+    with pytest.raises(AssertionError):
+        make_driver(RecordingRunner(), benchmark_cores={0, 1}, compile_cores={1, 2})
+
+class FailingRunner(RecordingRunner):
+    def build(self, submission : LLM4PP_Submission):
+        if submission.submitted_code == "bad":
+            raise RuntimeError("compiler crashed")
+        return submission
+
+def test_failed_submissions_are_logged(caplog):
+    driver = make_driver(FailingRunner())
+    problems = [next(driver) for _ in range(3)]
+    with caplog.at_level(logging.WARNING):
+        futures = driver.submit_many(LLM4PP_Submission(problem=p, submitted_code=code) for p, code in zip(problems, ["a", "bad", "c"]))
+        driver.wait_for_submissions()
+    driver.shutdown()
+    with pytest.raises(RuntimeError):
+        futures[1].result()
+    assert [r.submission.submitted_code for r in driver.responses] == ["a", "c"]
+    assert "compiler crashed" in caplog.text
+
+def test_responses_are_kept_in_submission_order():
+    runner = RecordingRunner()
+    driver = make_driver(runner)
+    problems = [next(driver) for _ in range(6)]
+    driver.submit_many(LLM4PP_Submission(problem=p, submitted_code=f"code {i}") for i, p in enumerate(problems))
+    driver.wait_for_submissions()
+    driver.shutdown()
+    assert [r.submission.problem.problem_id for r in driver.responses] == [p.problem_id for p in problems]
+
+def test_submit_best_of_benchmarks_candidates_one_at_a_time():
+    runner = RecordingRunner()
+    runner.runtimes = {"slow" : 2.0, "fast" : 0.5, "wrong" : None}
+    driver = make_driver(runner)
+    problem = next(driver)
+    future = driver.submit_best_of_async(problem, ["slow", "wrong", "fast", "fast  \n"])
+    best = future.result()
+    driver.shutdown()
+
+    assert runner.max_running == 1
+    assert best.submission.submitted_code == "fast"
+    assert [r.submission.submitted_code for r in future.candidate_responses] == ["fast", "slow", "wrong"]
+    assert driver.responses == [best]
+
+def test_default_runner_does_everything_in_run():
+    driver = make_driver(SubmissionRunner(), max_workers=2)
+    problem = next(driver)
+    response = driver.submit(LLM4PP_Submission(problem=problem, submitted_code="x"))
+    driver.shutdown()
+    assert response.compiled and response.correct
+
+def test_normalize_code_ignores_line_endings_and_trailing_whitespace():
+    a = "int f() {\n    return 1;\n}\n"
+    b = "int f() {  \r\n    return 1;\t\r\n}\r\n\r\n"
+    assert normalize_code(a) == normalize_code(b) == "int f() {\n    return 1;\n}"
+
+def test_normalize_code_keeps_indentation_and_blank_lines():
+    # both are part of the raw string literal
+    a = 'const char *s = R"(\n  x\n\ny)";'
+    assert normalize_code(a) == a
+    assert normalize_code(a) != normalize_code(a.replace("  x", "x"))
+    assert normalize_code(a) != normalize_code(a.replace("\n\n", "\n"))
+
+def test_normalize_code_keeps_line_breaks():
+    # a line break ends a // comment, so joining lines would change the program
+    assert normalize_code("// x\nreturn 1;") != normalize_code("// x return 1;")
+
+def test_response_rank_orders_best_first():
+    problem = next(make_driver(SubmissionRunner()))
+    def response(code, compiled, correct, runtime):
+        return LLM4PP_SubmissionResponse(submission=LLM4PP_Submission(problem=problem, submitted_code=code),
+                                         compiled=compiled, correct=correct, runtime=runtime, reference_runtime=1.0)
+    responses = [response("no-build", False, False, 0.0), response("wrong", True, False, 0.1),
+                 response("slow", True, True, 2.0), response("fast", True, True, 0.5)]
+    ranked = sorted(responses, key=response_rank)
+    assert [r.submission.submitted_code for r in ranked] == ["fast", "slow", "wrong", "no-build"]
@@ -0,0 +1,33 @@
+import os
+import shutil
+
+import pytest
+
+from client.pareval_client import ParEvalInProcessRunner, summarize_run_info
+
+DRIVERS_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ParEval", "drivers")
+
+def run_info(did_build = True, runs = None, best_sequential_runtime = 2.0):
+    return {"did_build" : did_build, "did_all_run" : runs is not None, "are_all_valid" : runs is not None,
+            "best_sequential_runtime" : best_sequential_runtime, "runs" : runs}
+
+def test_summarize_run_info_takes_the_runtime_of_the_first_run():
+    result = summarize_run_info(run_info(runs=[{"runtime" : 0.5}, {"runtime" : 0.25}]), "out", "err")
+    assert (result["did_build"], result["did_run"], result["is_valid"]) == (True, True, True)
+    assert (result["optimized_runtime"], result["baseline_runtime"]) == (0.5, 2.0)
+    assert (result["stdout"], result["stderr"]) == ("out", "err")
+
+def test_summarize_run_info_falls_back_to_the_baseline_without_a_runtime():
+    result = summarize_run_info(run_info(did_build=False), "", "")
+    assert not result["did_build"] and not result["did_run"]
+    assert result["optimized_runtime"] == result["baseline_runtime"] == 2.0
+    assert summarize_run_info(run_info(did_build=False, best_sequential_runtime=None), "", "")["optimized_runtime"] == 0.0
+
+@pytest.mark.skipif(shutil.which("g++") is None, reason="needs g++")
+def test_in_process_runner_reports_build_errors_from_any_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runner = ParEvalInProcessRunner(drivers_root=DRIVERS_ROOT, scratch_dir=str(tmp_path))
+    assert os.path.exists(runner.test_driver_file("dense_la", "02_dense_la_gemm"))
+    result = runner.submit("dense_la", "02_dense_la_gemm", "this is not c++")
+    assert not result["did_build"] and not result["did_run"] and not result["is_valid"]
+    assert "error" in result["stderr"]
@@ -0,0 +1,156 @@
+from client.driver import SubmissionRunner
+from client.models import BenchmarkDescription, LLM4PP_Problem, LLM4PP_Submission, LLM4PP_SubmissionResponse
+from client.submission_cache import BaselineCache, CachedSubmissionRunner, SubmissionCache
+
+def make_submission(code : str, problem_id : str = "p0") -> LLM4PP_Submission:
+    problem = LLM4PP_Problem(problem_id=problem_id, category="cat", source_code="src", header="",
+                             target_benchmark=BenchmarkDescription())
+    return LLM4PP_Submission(problem=problem, submitted_code=code)
+
+def make_response(submission : LLM4PP_Submission, **kwargs) -> LLM4PP_SubmissionResponse:
+    fields = dict(compiled=True, correct=True, runtime=1.0, reference_runtime=2.0, did_run=True)
+    fields.update(kwargs)
+    return LLM4PP_SubmissionResponse(submission=submission, **fields)
+
+# returns the queued responses in order and counts the builds and runs.
+class ScriptedRunner(SubmissionRunner):
+    def __init__(self, responses, key_fields = None):
+        self.responses = list(responses)
+        self.key_fields = key_fields if key_fields is not None else {"problem_id" : "p0"}
+        self.builds = 0
+        self.runs = 0
+
+    def build(self, submission):
+        self.builds += 1
+        return submission
+
+    def run(self, built):
+        self.runs += 1
+        return self.responses.pop(0)(built)
+
+    def submit(self, submission):
+        return self.run(self.build(submission))
+
+    def cache_key_fields(self, submission):
+        return self.key_fields
+
+def test_key_ignores_line_endings_and_trailing_whitespace():
+    fields = {"problem_id" : "p0"}
+    a = make_submission("int f() {\n    return 1;\n}\n")
+    b = make_submission("int f() {\r\n    return 1;   \r\n}")
+    c = make_submission("int f() {\n    return 2;\n}\n")
+    d = make_submission("int f() {\n\treturn 1;\n}\n")
+    assert SubmissionCache.key(a, fields) == SubmissionCache.key(b, fields)
+    assert SubmissionCache.key(a, fields) != SubmissionCache.key(c, fields)
+    assert SubmissionCache.key(a, fields) != SubmissionCache.key(d, fields)
+
+def test_key_covers_runner_fields():
+    submission = make_submission("code")
+    base = {"problem_id" : "p0", "benchmark_mode" : "all", "harness" : "h1"}
+    keys = {SubmissionCache.key(submission, base),
+            SubmissionCache.key(submission, dict(base, benchmark_mode="skip-best")),
+            SubmissionCache.key(submission, dict(base, harness="h2"))}
+    assert len(keys) == 3
+
+def test_get_reattaches_submission(tmp_path):
+    cache = SubmissionCache(str(tmp_path / "cache.sqlite"))
+    stored = make_submission("x")
+    cache.put("k", make_response(stored, runtime=0.25))
+    other = make_submission("x   ")
+    response = cache.get("k", other)
+    assert response.runtime == 0.25
+    assert response.submission == other
+    assert cache.get("missing", other) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_evicts_least_recently_used(tmp_path):
+    submission = make_submission("x")
+    entry_size = len(make_response(submission).json(exclude={"submission"}))
+    cache = SubmissionCache(str(tmp_path / "cache.sqlite"), max_size_bytes=int(2.5 * entry_size))
+    cache.put("a", make_response(submission))
+    cache.put("b", make_response(submission))
+    cache.get("a", submission)
+    cache.put("c", make_response(submission))
+    assert len(cache) == 2
+    assert cache.get("b", submission) is None
+    assert cache.get("a", submission) is not None and cache.get("c", submission) is not None
+
+def test_cached_runner_reuses_completed_runs(tmp_path):
+    runner = ScriptedRunner([lambda s: make_response(s, runtime=0.5)])
+    cached = CachedSubmissionRunner(runner, SubmissionCache(str(tmp_path / "cache.sqlite")))
+    first = cached.submit(make_submission("code"))
+    second = cached.submit(make_submission("code  \r\n"))
+    assert (runner.builds, runner.runs) == (1, 1)
+    assert first.runtime == second.runtime == 0.5
+
+def test_cached_runner_does_not_store_failures(tmp_path):
+    runner = ScriptedRunner([lambda s: make_response(s, compiled=False, correct=False, did_run=False),
+                             lambda s: make_response(s, did_run=False),
+                             lambda s: make_response(s, runtime=0.5)])
+    cached = CachedSubmissionRunner(runner, SubmissionCache(str(tmp_path / "cache.sqlite")))
+    assert not cached.submit(make_submission("code")).compiled
+    assert not cached.submit(make_submission("code")).did_run
+    assert cached.submit(make_submission("code")).runtime == 0.5
+    assert cached.submit(make_submission("code")).runtime == 0.5
+    assert runner.runs == 3
+
+def test_harness_edits_change_the_key(tmp_path):
+    import os
+    from client.pareval_client import ParEvalSubmissionRunner
+    drivers_root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ParEval", "drivers")
+    runner = ParEvalSubmissionRunner(in_process=False, drivers_root=drivers_root)
+    submission = make_submission("code", problem_id="02_dense_la_gemm")
+    submission.problem.category = "dense_la"
+    assert runner.cache_key_fields(submission)["harness"] == runner.cache_key_fields(submission)["harness"]
+
+    runner.drivers_root = str(tmp_path)
+    benchmark_dir = tmp_path / "cpp" / "benchmarks" / "dense_la" / "02_dense_la_gemm"
+    benchmark_dir.mkdir(parents=True)
+    (tmp_path / "cpp" / "utilities.hpp").write_text("// v1")
+    (benchmark_dir / "cpu.cc").write_text("int main() {}")
+    before = runner.cache_key_fields(submission)
+    (tmp_path / "cpp" / "utilities.hpp").write_text("// v2")
+    after = runner.cache_key_fields(submission)
+    assert before["harness"] != after["harness"]
+    assert SubmissionCache.key(submission, before) != SubmissionCache.key(submission, after)
+
+def test_key_covers_machine_and_launch_configs():
+    import os
+    from client.pareval_client import ParEvalSubmissionRunner
+    from client.submission_cache import machine_fingerprint
+    drivers_root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ParEval", "drivers")
+    runner = ParEvalSubmissionRunner(in_process=False, drivers_root=drivers_root)
+    fields = runner.cache_key_fields(make_submission("code"))
+    assert fields["machine"] == machine_fingerprint()
+    assert fields["launch_configs"] == runner.launch_configs
+    other_machine = dict(fields, machine=dict(fields["machine"], cpu="other"))
+    other_launch = dict(fields, launch_configs={"params" : [{"num_threads" : 4}]})
+    key = SubmissionCache.key(make_submission("code"), fields)
+    assert key != SubmissionCache.key(make_submission("code"), other_machine)
+    assert key != SubmissionCache.key(make_submission("code"), other_launch)
+
+def test_baseline_is_remeasured_after_revalidate_every_uses(tmp_path):
+    baselines = BaselineCache(str(tmp_path / "baselines.sqlite"), revalidate_every=3)
+    assert baselines.get("p0", "(1<<20)") is None
+    baselines.record("p0", "(1<<20)", 0.5)
+    assert [baselines.get("p0", "(1<<20)") for _ in range(4)] == [0.5, 0.5, 0.5, None]
+    # a new measurement starts over
+    baselines.record("p0", "(1<<20)", 0.52)
+    assert baselines.get("p0", "(1<<20)") == 0.52
+
+def test_baselines_are_kept_per_problem_size_and_across_instances(tmp_path):
+    path = str(tmp_path / "baselines.sqlite")
+    BaselineCache(path).record("p0", "(1<<20)", 0.5)
+    baselines = BaselineCache(path)
+    assert baselines.get("p0", "(1<<20)") == 0.5
+    assert baselines.get("p0", "(1<<22)") is None
+    assert baselines.get("p1", "(1<<20)") is None
+
+def test_baseline_drift_is_logged(tmp_path, caplog):
+    baselines = BaselineCache(str(tmp_path / "baselines.sqlite"), drift_tolerance=0.1)
+    baselines.record("p0", "(1<<20)", 0.5)
+    baselines.record("p0", "(1<<20)", 0.52)
+    assert "drifted" not in caplog.text
+    baselines.record("p0", "(1<<20)", 0.8)
+    assert "p0 drifted from 0.52 to 0.8" in caplog.text
+    assert baselines.get("p0", "(1<<20)") == 0.8
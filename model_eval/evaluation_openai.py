@@ -1,7 +1,11 @@
-from client.models import LLM4PP_Problem, LLM4PP_Submission
+from client.models import LLM4PP_Problem
 from client.pareval_client import ParEvalDriver
-from fastcoder.chatapi import MessageHistory, ChatAPI
+from fastcoder.chatapi import AsyncChatAPI
+from fastcoder.budget import BudgetLedger
+from fastcoder.prompt_prefix import PromptPrefix
+import asyncio
 import json
+import logging
 
 optimizer_prompt ="""You are a coding expert that writes very fast code. You write parallel C and C++ code using OpenMP and always strive to make the code as fast as possible. The user will give you code and you will provide a modified version of the user's code that is as fast as possible.
 
@@ -26,31 +30,65 @@ You will respond with a JSON dictionary in the following format:
 ```
 """
 
-driver = ParEvalDriver()
-chatAPI = ChatAPI()
-
-for problem in driver:
-    problem : LLM4PP_Problem
-
-    messages = MessageHistory()
-    messages.add_message("system", optimizer_prompt)
-    messages.add_message("user", json.dumps({"solution.cpp": problem.source_code}))
-    response = chatAPI.get_response('gpt-4o-mini', messages, json_format=True)
-    optimized_code = json.loads(response)['updated_code']
-
-    submission = LLM4PP_Submission(problem=problem,
-                                   submitted_code=optimized_code)
+# problem-independent facts about how submissions are built and timed, shared by every prompt.
+harness_header = "The code is compiled into the ParEval benchmark harness with `g++ -std=c++20 -O3 -fopenmp`, checked " \
+    "against a sequential reference implementation and timed with 8 OpenMP threads. Keep the name and signature of the function."
+
+# show the prompt cache report and retries, but not every HTTP request.
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# candidates of a problem are compiled concurrently and then benchmarked one at a time.
+driver = ParEvalDriver(max_workers=4)
+# LLM round-trips dominate the run time, so request all problems concurrently.
+# calls that do not fit in the remaining budget are downgraded or rejected before they are made.
+budget = BudgetLedger(limit=2.0)
+chatAPI = AsyncChatAPI(max_concurrency=16, budget=budget)
+# every prompt starts with the same system prompt and header, so the provider can serve them from its prompt
+# cache once they reach its minimum length.
+prefix = PromptPrefix(optimizer_prompt, header=harness_header)
+# candidates sampled per problem, only the fastest correct one is recorded.
+NUM_CANDIDATES = 4
+
+async def optimize(problem : LLM4PP_Problem):
+    messages = prefix.build(json.dumps({"solution.cpp": problem.source_code}))
+    responses = await chatAPI.get_candidates('gpt-4o-mini', messages, n=NUM_CANDIDATES, json_format=True,
+                                             problem=problem.problem_id, temperature=0.8)
+    codes = []
+    for response in responses:
+        try:
+            codes.append(json.loads(response)['updated_code'])
+        except (ValueError, KeyError, TypeError):
+            # a truncated or malformed candidate, the others may still be usable
+            pass
+    if len(codes) == 0:
+        raise ValueError("no candidate contained updated_code")
+    return codes
+
+async def optimize_all(problems):
+    # the first request populates the prompt cache for the concurrent ones.
+    first = await asyncio.gather(*(optimize(problem) for problem in problems[:1]), return_exceptions=True)
+    rest = await asyncio.gather(*(optimize(problem) for problem in problems[1:]), return_exceptions=True)
+    return first + rest
+
+problems = list(driver)
+optimized_codes = asyncio.run(optimize_all(problems))
+
+for problem, candidates in zip(problems, optimized_codes):
+    if isinstance(candidates, Exception):
+        print(f"skipping problem {problem.problem_id} due to exception: {candidates}")
+        continue
 
     try:
-        response = driver.submit(submission)
+        response = driver.submit_best_of(problem, candidates)
     except Exception as e:
         print(f"skipping problem due to exception: {e}")
-        print("--- ParEval driver stdout ---")
-        print(response.stdout)
 
 driver.save_all_responses("./tmp-pareval-results.json")
 driver.evaluate()
 print(chatAPI.get_cost())
+prefix.report(chatAPI)
+budget.report()
 
 
 # Example output
@@ -1,6 +1,6 @@
 from client.models import LLM4PP_Problem, LLM4PP_Submission
 from client.pareval_client import ParEvalDriver
-from vllm import LLM, SamplingParams
+from argparse import ArgumentParser
 import json
 
 def generate_code_opt_prompt_code_alpaca(src_code : str, fast_code : str ="") -> str:
@@ -14,29 +14,80 @@ def generate_code_opt_prompt_code_alpaca(src_code : str, fast_code : str ="") ->
     prompt = prompt_template.format_map({"instruction" : instruction, "input" : src_code, "response": fast_code})
     return prompt
 
-driver = ParEvalDriver()
-
 MODEL_PATH = ""
-llm = LLM(model=MODEL_PATH)
-sampling_params = SamplingParams(temperature=0.2, top_p=0.95, max_tokens=4096)
+# small model for testing the workflow without a GPU. Needs a CPU build of vllm
+# (https://docs.vllm.ai/en/latest/getting_started/installation/cpu.html).
+TINY_MODEL_PATH = "facebook/opt-125m"
+
+def get_args():
+    parser = ArgumentParser(description="Generate optimized code for every ParEval problem with vllm.")
+    parser.add_argument("--model", type=str, default=MODEL_PATH, help="Model to generate with.")
+    parser.add_argument("--sequential", action="store_true", help="Generate one problem at a time instead of " +
+        "adding all problems to the engine at once.")
+    parser.add_argument("--tiny", action="store_true", help=f"Test configuration: {TINY_MODEL_PATH} with short outputs.")
+    parser.add_argument("--max-workers", type=int, default=4, help="Submissions compiled concurrently while " +
+        "generation continues. Benchmarks always run one at a time.")
+    return parser.parse_args()
+
+# adds every prompt to the engine at once, so continuous batching can run them together, and yields
+# (index, generated text) for each prompt as soon as it finishes.
+def generate_as_completed(llm : 'LLM', prompts, sampling_params : 'SamplingParams'):
+    engine = llm.llm_engine
+    for i, prompt in enumerate(prompts):
+        engine.add_request(str(i), prompt, sampling_params)
+    while engine.has_unfinished_requests():
+        for output in engine.step():
+            if output.finished:
+                yield int(output.request_id), output.outputs[0].text
+
+def main():
+    # imported here so that generate_as_completed can be used without vllm installed
+    from vllm import LLM, SamplingParams
+
+    args = get_args()
+    driver = ParEvalDriver(max_workers=args.max_workers)
+
+    if args.tiny:
+        llm = LLM(model=TINY_MODEL_PATH, max_model_len=2048)
+        sampling_params = SamplingParams(temperature=0.2, top_p=0.95, max_tokens=256)
+    else:
+        llm = LLM(model=args.model)
+        sampling_params = SamplingParams(temperature=0.2, top_p=0.95, max_tokens=4096)
+
+    if args.sequential:
+        for problem in driver:
+            problem : LLM4PP_Problem
 
-for problem in driver:
-    problem : LLM4PP_Problem
+            prompt = generate_code_opt_prompt_code_alpaca(problem.source_code)
+            output = llm.generate(prompt, sampling_params)
+            optimized_code = output[0].outputs[0].text
 
-    prompt = generate_code_opt_prompt_code_alpaca(problem.source_code)
-    output = llm.generate(prompt, sampling_params)
-    optimized_code = output[0].outputs[0].text
+            submission = LLM4PP_Submission(problem=problem,
+                                           submitted_code=optimized_code)
 
-    submission = LLM4PP_Submission(problem=problem,
-                                   submitted_code=optimized_code)
+            try:
+                response = driver.submit(submission)
+            except Exception as e:
+                print(f"skipping problem due to exception: {e}")
+    else:
+        # collect all problems first, then benchmark each candidate on the driver's worker pool
+        # while the remaining prompts are still generating.
+        problems = list(driver)
+        prompts = [generate_code_opt_prompt_code_alpaca(problem.source_code) for problem in problems]
+        futures = []
+        for i, optimized_code in generate_as_completed(llm, prompts, sampling_params):
+            submission = LLM4PP_Submission(problem=problems[i],
+                                           submitted_code=optimized_code)
+            futures.append((problems[i], driver.submit_async(submission)))
 
-    try:
-        response = driver.submit(submission)
-    except Exception as e:
-        print(f"skipping problem due to exception: {e}")
-        print("--- ParEval driver stdout ---")
-        print(response.stdout)
+        for problem, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"skipping problem {problem.problem_id} due to exception: {e}")
 
-driver.save_all_responses("./tmp-pareval-results.json")
-driver.evaluate()
+    driver.save_all_responses("./tmp-pareval-results.json")
+    driver.evaluate()
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import logging
+import threading
+
+from fastcoder.chatapi import PROMPT_COSTS, RESPONSE_COSTS, estimate_tokens
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# raised when a call cannot be made within the remaining budget, even after downgrading it.
+class BudgetExceeded(Exception):
+    pass
+
+# Tracks spending against a dollar limit and checks every call before it is made. The prompt is
+# counted locally (with tiktoken when it is installed) and the completion is bounded by max_tokens,
+# which is set to default_max_tokens for calls that do not set it, so the worst-case cost of a call
+# is known up front. If it does not fit in the remaining budget, the call is downgraded: first the
+# model is replaced by its entry in `downgrades` (a truncated answer is usually worthless), then
+# max_tokens is lowered down to min_completion_tokens, starting with the original model. Downgrades are logged and counted in report(). If it still does not fit,
+# BudgetExceeded is raised and nothing is spent. Once the call returns, the reservation is replaced by the actual cost.
+# In-flight reservations count as spent, so concurrent calls cannot overshoot the limit either.
+class BudgetLedger:
+    def __init__(self, limit : float = 2.0, default_max_tokens : int = 4096, min_completion_tokens : int = 512,
+                 downgrades : dict = None):
+        self.limit = limit
+        self.default_max_tokens = default_max_tokens
+        self.min_completion_tokens = min_completion_tokens
+        if downgrades is None:
+            downgrades = {"gpt-4o" : "gpt-4o-mini", "gpt-4o-2024-08-06" : "gpt-4o-mini"}
+        self.downgrades = downgrades
+        self.spent = 0.0
+        self.reserved = 0.0
+        self.spend_per_problem = dict()
+        self.rejected = 0
+        self.downgraded = 0
+        self.encodings = dict()
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        with self.lock:
+            return self.limit - self.spent - self.reserved
+
+    def encoding(self, model):
+        if tiktoken is None:
+            return None
+        if model not in self.encodings:
+            try:
+                self.encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self.encodings[model] = tiktoken.get_encoding("o200k_base")
+            except Exception:
+                # e.g. the encoding files cannot be downloaded
+                self.encodings[model] = None
+        return self.encodings[model]
+
+    # number of prompt tokens of the messages, including the per-message overhead of the chat format.
+    def count_prompt_tokens(self, model, messages):
+        encoding = self.encoding(model)
+        if encoding is None:
+            content_tokens = estimate_tokens(messages)
+        else:
+            content_tokens = sum(len(encoding.encode(m["content"])) for m in messages)
+        return content_tokens + 4 * len(messages) + 3
+
+    @staticmethod
+    def cost(model, prompt_tokens, completion_tokens, cached_prompt_tokens = 0):
+        # models without a known price are not charged.
+        prompt_cost = PROMPT_COSTS.get(model, 0)
+        return (prompt_tokens * prompt_cost - cached_prompt_tokens * prompt_cost / 2 + completion_tokens * RESPONSE_COSTS.get(model, 0)) / 1000
+
+    # checks a call against the remaining budget. Returns the model and sampling params to call with
+    # (possibly downgraded, with max_tokens set for priced models) and a reservation to pass to commit or release.
+    def reserve(self, model, messages, sampling_params, problem = None):
+        sampling_params = dict(sampling_params)
+        max_tokens = sampling_params.get("max_tokens") or self.default_max_tokens
+        # max_tokens bounds each of the n completions of a call.
+        n = sampling_params.get("n", 1)
+
+        candidates = [model]
+        while candidates[-1] in self.downgrades and self.downgrades[candidates[-1]] not in candidates:
+            candidates.append(self.downgrades[candidates[-1]])
+
+        # try every model with the full max_tokens before lowering max_tokens
+        attempts = [(candidate, max_tokens) for candidate in candidates] + \
+                   [(candidate, min(max_tokens, self.min_completion_tokens)) for candidate in candidates]
+
+        with self.lock:
+            remaining = self.limit - self.spent - self.reserved
+            for candidate, needed_tokens in attempts:
+                prompt_tokens = self.count_prompt_tokens(candidate, messages)
+                completion_price = n * RESPONSE_COSTS.get(candidate, 0) / 1000
+                prompt_cost = self.cost(candidate, prompt_tokens, 0)
+                if completion_price == 0:
+                    affordable_tokens = max_tokens
+                else:
+                    affordable_tokens = min(max_tokens, int((remaining - prompt_cost) / completion_price))
+                if affordable_tokens >= needed_tokens:
+                    if candidate != model or affordable_tokens < max_tokens:
+                        self.downgraded += 1
+                        logging.warning(f"Budget: downgrading call from {model} (max_tokens={max_tokens}) to {candidate} "
+                                        f"(max_tokens={affordable_tokens}), ${remaining:.4f} remaining")
+                    if completion_price > 0 or "max_tokens" in sampling_params:
+                        # the reservation is only a bound if the completion is. Free models (e.g. served
+                        # locally) keep the server's default limit.
+                        sampling_params["max_tokens"] = affordable_tokens
+                    worst_case = prompt_cost + affordable_tokens * completion_price
+                    self.reserved += worst_case
+                    return candidate, sampling_params, (candidate, worst_case, problem)
+
+            self.rejected += 1
+        raise BudgetExceeded(f"call to {model} needs more than the ${remaining:.4f} left of the ${self.limit:.2f} budget")
+
+    # replaces a reservation with the actual cost of the completion.
+    def commit(self, reservation, completion):
+        model, worst_case, problem = reservation
+        details = completion.usage.prompt_tokens_details
+        cached_tokens = (details.cached_tokens or 0) if details is not None else 0
+        actual = self.cost(model, completion.usage.prompt_tokens, completion.usage.completion_tokens, cached_tokens)
+        with self.lock:
+            self.reserved -= worst_case
+            self.spent += actual
+            self.spend_per_problem[problem] = self.spend_per_problem.get(problem, 0.0) + actual
+
+    # drops a reservation for a call that failed.
+    def release(self, reservation):
+        with self.lock:
+            self.reserved -= reservation[1]
+
+    # prints and returns the spend per problem. Calls made without a problem are listed under None.
+    def report(self):
+        with self.lock:
+            for problem, spent in sorted(self.spend_per_problem.items(), key=lambda x: str(x[0])):
+                print(f"{problem}: ${spent:.4f}")
+            print(f"total: ${self.spent:.4f} of ${self.limit:.2f} ({self.downgraded} calls downgraded, {self.rejected} rejected)")
+            return dict(self.spend_per_problem)
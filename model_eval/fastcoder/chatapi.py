@@ -1,16 +1,118 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+import openai
+import asyncio
 import copy
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
 import uuid
+from types import SimpleNamespace
+
+# dollars per 1000 tokens. Cached prompt tokens cost half the prompt price.
+PROMPT_COSTS = dict()
+RESPONSE_COSTS = dict()
+PROMPT_COSTS['gpt-4o'] = 0.005
+RESPONSE_COSTS['gpt-4o'] = 0.015
+PROMPT_COSTS["gpt-3.5-turbo"] = 0.0005
+RESPONSE_COSTS["gpt-3.5-turbo"] = 0.0015
+PROMPT_COSTS['gpt-4o-mini'] = 0.000150
+RESPONSE_COSTS['gpt-4o-mini'] = 0.000600
+PROMPT_COSTS['gpt-4o-2024-08-06'] = 0.00250
+RESPONSE_COSTS['gpt-4o-2024-08-06'] = 0.01000
+
+# dollars of the prompt and response tokens used per model, as (response cost, prompt cost).
+# Models without a known price are not charged.
+def usage_cost(prompt_tokens_used, response_tokens_used):
+    total_prompt = 0
+    total_response = 0
+    for x in prompt_tokens_used.keys():
+        if x not in PROMPT_COSTS:
+            logging.warning(f"{x} not in prompt_costs")
+        else:
+            total_prompt += (prompt_tokens_used[x] * PROMPT_COSTS[x]) / 1000
+
+    for x in response_tokens_used.keys():
+        if x not in RESPONSE_COSTS:
+            logging.warning(f"{x} not in response costs")
+        else:
+            total_response += (response_tokens_used[x] * RESPONSE_COSTS[x]) / 1000
+    return total_response, total_prompt
+
+# average characters per token used when no tokenizer is available.
+CHARS_PER_TOKEN = 4
+
+# rough token count of the content of a list of messages. This is the only local estimate, used for
+# rate limiting, streamed usage, budget reservations without tiktoken and the mock server.
+def estimate_tokens(messages):
+    return sum(len(m["content"]) for m in messages) // CHARS_PER_TOKEN + 1
+
+# A message that can be shared between many histories. Mutating it raises TypeError;
+# copy.copy / copy.deepcopy return a regular dict that can be modified.
+class FrozenMessage(dict):
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("messages are read-only, use MessageHistory.add_message to extend a history")
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return (FrozenMessage, (dict(self),))
+
+# Node of an immutable linked list of messages, linked from the newest message to the oldest.
+# Forked histories share all the nodes they have in common. The flattened tuple of messages
+# is cached on the nodes it is requested from.
+class MessageNode:
+    __slots__ = ("message", "prev", "length", "flat")
+
+    def __init__(self, message : FrozenMessage, prev : 'MessageNode' = None):
+        self.message = message
+        self.prev = prev
+        self.length = 1 if prev is None else prev.length + 1
+        self.flat = None
+
+    def flatten(self):
+        if self.flat is None:
+            # walk back to the closest node that was already flattened
+            pending = []
+            node = self
+            while node is not None and node.flat is None:
+                pending.append(node.message)
+                node = node.prev
+            prefix = node.flat if node is not None else ()
+            self.flat = prefix + tuple(reversed(pending))
+        return self.flat
 
 class MessageHistory:
     def __init__(self, parent : 'MessageHistory' = None):
-        self.message_history = []
         self.parent = None
         self.parent = parent
         self.children = []
         self.headless_children = []
+        # newest message. Shared with the parent until either adds a message, so forking is O(1).
+        self.tail = None
         if self.parent != None:
-            self.message_history = copy.deepcopy(self.parent.message_history)
+            self.tail = self.parent.tail
+
+    # the messages as a read-only tuple. Assigning a list of messages replaces the history.
+    @property
+    def message_history(self):
+        return self.get_messages()
+
+    @message_history.setter
+    def message_history(self, messages):
+        self.tail = None
+        for m in messages:
+            self.add_message(m["role"], m["content"])
 
     # returns a new MessageHistory with the current MessageHistory as the parent. 
     def fork(self):
@@ -19,18 +121,24 @@ class MessageHistory:
 
     def fork_headless(self):
         self.headless_children.append(MessageHistory())
-        return self.children[-1]
+        return self.headless_children[-1]
     
-    # returns a copy of the current message history. 
+    # returns a read-only view of the current message history, a tuple of FrozenMessage.
+    # use copy.deepcopy to get a modifiable copy.
     def get_messages(self):
-        return copy.deepcopy(self.message_history)
+        if self.tail is None:
+            return ()
+        return self.tail.flatten()
+
+    def __len__(self):
+        return 0 if self.tail is None else self.tail.length
 
     # add a message
     def add_message(self, role : str, content : str):
         #if role == "system":
         #    seed = str(uuid.uuid1())
         #    content = f"SEED<{seed}>\n{content}"
-        self.message_history.append({"role": role, "content": content})
+        self.tail = MessageNode(FrozenMessage(role=role, content=content), self.tail)
     
     # reverts to the parent history.
     def revert(self):
@@ -38,7 +146,7 @@ class MessageHistory:
         return self.parent
     def dump(self):
         ret = dict()
-        ret['message_history'] = self.message_history
+        ret['message_history'] = [dict(m) for m in self.get_messages()]
         ret['children'] = []
         ret['headless_children'] = []
         for x in self.children:
@@ -47,20 +155,185 @@ class MessageHistory:
             ret['headless_children'].append(x.dump())
         return ret
 
+# Opt-in on-disk cache of LLM responses, backed by sqlite. Used while iterating on compile and
+# benchmark settings so that re-running the same prompts does not pay for the same completions.
+# Entries are keyed on (model, messages, json_format, sampling params) plus the number of times
+# the same request was already made in this process, so repeated identical requests (e.g. when
+# sampling several candidates) still get distinct responses, and a re-run replays them in order.
+# Entries are evicted least-recently-used first once the stored size exceeds max_size_bytes.
+class ResponseCache:
+    def __init__(self, path : str = os.path.join(".llm4pp-cache", "responses.sqlite"), max_size_bytes : int = 256 * 1024 * 1024):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.hits = dict()
+        self.misses = dict()
+        self.occurrences = dict()
+        self.lock = threading.Lock()
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                                    "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                                    "size INTEGER NOT NULL, last_access REAL NOT NULL)")
+
+    def key(self, model, messages, json_format, sampling_params):
+        material = json.dumps({"model" : model, "messages" : messages, "json_format" : json_format,
+                               "sampling_params" : sampling_params}, sort_keys=True)
+        request = hashlib.sha256(material.encode("utf-8")).hexdigest()
+        with self.lock:
+            occurrence = self.occurrences.get(request, 0)
+            self.occurrences[request] = occurrence + 1
+        return f"{request}-{occurrence}"
+
+    # returns the cached response, or None on a miss.
+    def get(self, key, model):
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses[model] = self.misses.get(model, 0) + 1
+                return None
+            self.hits[model] = self.hits.get(model, 0) + 1
+            with self.connection:
+                self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key, response):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                                    (key, response, len(response), time.time()))
+            self.evict()
+
+    def evict(self):
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total_size <= self.max_size_bytes:
+                break
+            evicted.append((key,))
+            total_size -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM responses")
+
+    def get_stats(self):
+        return (self.hits, self.misses)
+
+# Finds the code in a response while it is being streamed, so the rest of the stream can be
+# cancelled. With json_format the code is the "updated_code" string, which is complete at its
+# closing quote; otherwise it is the first fenced code block, complete at its closing fence.
+# Each character is scanned once, so feeding a whole response costs O(len(response)).
+class CodeExtractor:
+    JSON_KEY = re.compile(r'"updated_code"\s*:\s*"')
+    OPENING_FENCE = re.compile(r'```[^\n`]*\n')
+
+    def __init__(self, json_format = False):
+        self.json_format = json_format
+        self.text = ""
+        self.code = None
+        # index the code starts at, once the key or opening fence has been seen
+        self.code_start = None
+        # index up to which the text has been scanned
+        self.scanned = 0
+        self.escaped = False
+
+    # adds a chunk of the response. Returns the code once it is complete, otherwise None.
+    def feed(self, chunk : str):
+        self.text += chunk
+        if self.code is None:
+            if self.json_format:
+                self.scan_json()
+            else:
+                self.scan_fence()
+        return self.code
+
+    def scan_json(self):
+        if self.code_start is None:
+            match = self.JSON_KEY.search(self.text)
+            if match is None:
+                return
+            self.code_start = match.end()
+            self.scanned = self.code_start
+        for i in range(self.scanned, len(self.text)):
+            c = self.text[i]
+            if self.escaped:
+                self.escaped = False
+            elif c == "\\":
+                self.escaped = True
+            elif c == '"':
+                self.code = json.loads(self.text[self.code_start - 1:i + 1])
+                return
+        self.scanned = len(self.text)
+
+    def scan_fence(self):
+        if self.code_start is None:
+            match = self.OPENING_FENCE.search(self.text)
+            if match is None:
+                return
+            self.code_start = match.end()
+            self.scanned = self.code_start
+        # the closing fence starts a line, and may start right at the code
+        end = self.text.find("```", max(self.code_start, self.scanned - 3))
+        while end != -1 and end != self.code_start and self.text[end - 1] != "\n":
+            end = self.text.find("```", end + 1)
+        if end != -1:
+            self.code = self.text[self.code_start:end]
+        else:
+            self.scanned = len(self.text)
+
+    # returns the code of a response that ended without the code being complete.
+    def finish(self):
+        if self.code is not None:
+            return self.code
+        if self.json_format:
+            # raises like json.loads(response)['updated_code'] on a malformed response
+            return json.loads(self.text)["updated_code"]
+        if self.code_start is not None:
+            # unterminated code block
+            return self.text[self.code_start:]
+        # no code block, assume the response is only code
+        return self.text
+
+# a completion-like object for the usage of a streamed response. Cancelled streams never receive
+# the final usage chunk, so it is estimated from the prompt and the number of content chunks
+# received, which are about one token each.
+def streamed_completion(usage, messages, content_chunks):
+    if usage is None:
+        prompt_tokens = estimate_tokens(messages)
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=content_chunks,
+                                total_tokens=prompt_tokens + content_chunks, prompt_tokens_details=None)
+    return SimpleNamespace(usage=usage)
+
 class ChatPIE:
-    def __init__(self):
+    # cache: optional ResponseCache. Cached responses are not counted in the token usage or cost.
+    # budget: BudgetLedger every call is checked against, defaults to a $2 limit. Calls that do not
+    # fit raise fastcoder.budget.BudgetExceeded.
+    def __init__(self, cache : ResponseCache = None, budget = None):
+        from fastcoder.budget import BudgetLedger
         self.client = OpenAI(api_key="0", base_url="http://queue-g6e2xlarge-dy-g6e2xlarge-1:8000/v1")
         self.prompt_tokens_used = dict()
         self.response_tokens_used = dict()
         self.counter = 0
         self.uuid = uuid.uuid1() 
+        self.cache = cache
+        self.budget = budget if budget is not None else BudgetLedger(limit=2.0)
         pass
 
-    def get_response(self, model, message_history : MessageHistory, json_format = False):
-        total_cost = self.get_cost()[2]
-        if total_cost > 2.0:
-            print("The total cost is too high, quitting")
-            quit()
+    # problem: optional id the cost of the call is attributed to in the budget report.
+    def get_response(self, model, message_history : MessageHistory, json_format = False, problem = None, **sampling_params):
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(model, message_history.get_messages(), json_format, sampling_params)
+            cached_response = self.cache.get(cache_key, model)
+            if cached_response is not None:
+                return cached_response
+
+        model, sampling_params, reservation = self.budget.reserve(model, message_history.get_messages(), sampling_params, problem)
         if model not in self.prompt_tokens_used:
             self.prompt_tokens_used[model] = 0
         if model not in self.response_tokens_used:
@@ -74,50 +347,38 @@ class ChatPIE:
         #        log.write(f"######{m['role']}######\n")
         #        log.write(f"{m['content']}\n")
 
-        if not json_format:
-            
-            self.counter += 1
-            #messages[0]['user_context'] = messages[0]['user']
-            #messages[0]['user'] = "You are a GPT that optimizes code. The user will provide you a program and you will produce a complete equivalent program that achieves 10/10 performance."
-            #print(messages)
-            completion = self.client.chat.completions.create(model=model,
-                                                             messages=message_history.get_messages())
-        else:
-            completion = self.client.chat.completions.create(model=model,
-                    messages=message_history.get_messages(), response_format={'type':'json_object'})
+        try:
+            if not json_format:
+                
+                self.counter += 1
+                #messages[0]['user_context'] = messages[0]['user']
+                #messages[0]['user'] = "You are a GPT that optimizes code. The user will provide you a program and you will produce a complete equivalent program that achieves 10/10 performance."
+                #print(messages)
+                completion = self.client.chat.completions.create(model=model,
+                                                                 messages=message_history.get_messages(), **sampling_params)
+            else:
+                completion = self.client.chat.completions.create(model=model,
+                        messages=message_history.get_messages(), response_format={'type':'json_object'}, **sampling_params)
+        except Exception:
+            self.budget.release(reservation)
+            raise
+        self.budget.commit(reservation, completion)
 
         self.response_tokens_used[model] += completion.usage.completion_tokens
         self.prompt_tokens_used[model] += completion.usage.prompt_tokens
+        if cache_key is not None:
+            self.cache.put(cache_key, completion.choices[0].message.content)
         return completion.choices[0].message.content
 
     def get_usage(self):
         return (self.response_tokens_used, self.prompt_tokens_used)
 
-    def get_cost(self):
-        prompt_costs = dict()
-        response_costs = dict()
-        prompt_costs['gpt-4o'] = 0.005
-        response_costs['gpt-4o'] = 0.015
-        prompt_costs["gpt-3.5-turbo"] = 0.0005
-        response_costs["gpt-3.5-turbo"] = 0.0015
-        prompt_costs['gpt-4o-mini'] = 0.000150
-        response_costs['gpt-4o-mini'] = 0.000600
-        prompt_costs['gpt-4o-2024-08-06'] = 0.00250
-        response_costs['gpt-4o-2024-08-06'] = 0.01000
-
-        total_prompt = 0
-        total_response = 0
-        for x in self.prompt_tokens_used.keys():
-            if x not in prompt_costs:
-                print(f"Warning {x} not in prompt_costs")
-            else:
-                total_prompt += (self.prompt_tokens_used[x] * prompt_costs[x]) / 1000
+    # returns the (hits, misses) per model of the response cache.
+    def get_cache_stats(self):
+        return self.cache.get_stats() if self.cache is not None else (dict(), dict())
 
-        for x in self.response_tokens_used.keys():
-            if x not in response_costs:
-                print(f"Warning {x} not in response costs")
-            else:
-                total_response += (self.response_tokens_used[x] * response_costs[x]) / 1000
+    def get_cost(self):
+        total_response, total_prompt = usage_cost(self.prompt_tokens_used, self.response_tokens_used)
         return (total_response, total_prompt, total_prompt+total_response)
         return (self.response_tokens_used, self.prompt_tokens_used)
 
@@ -125,28 +386,47 @@ class ChatPIE:
         
  
 class ChatAPI:
-    def __init__(self):
-        self.client = OpenAI()#api_key="0", base_url="http://queue-g6e2xlarge-dy-g6e2xlarge-1:8000/v1")
+    # cache: optional ResponseCache. Cached responses are not counted in the token usage or cost.
+    # budget: optional fastcoder.budget.BudgetLedger every call is checked against before it is made.
+    # client: optional OpenAI client to use instead of the default one.
+    def __init__(self, cache : ResponseCache = None, budget = None, client = None):
+        self.client = client if client is not None else OpenAI()#api_key="0", base_url="http://queue-g6e2xlarge-dy-g6e2xlarge-1:8000/v1")
         self.prompt_tokens_used = dict()
         self.response_tokens_used = dict()
         self.cached_prompt_tokens = dict()
         self.uuid = uuid.uuid1()
         self.counter = 0
+        self.cache = cache
+        self.budget = budget
         pass
 
-    def get_response(self, model, message_history : MessageHistory, json_format = False):
-        if model not in self.prompt_tokens_used:
-            self.prompt_tokens_used[model] = 0
-        if model not in self.response_tokens_used:
-            self.response_tokens_used[model] = 0
-        if model not in self.cached_prompt_tokens:
-            self.cached_prompt_tokens[model] = 0
-        if not json_format:
-            completion = self.client.chat.completions.create(model=model,
-                                                             messages=message_history.get_messages())
-        else:
-            completion = self.client.chat.completions.create(model=model,
-                    messages=message_history.get_messages(), response_format={'type':'json_object'})
+    # sampling_params (temperature, top_p, seed, ...) are passed to chat.completions.create.
+    # problem: optional id the cost of the call is attributed to in the budget report.
+    def get_response(self, model, message_history : MessageHistory, json_format = False, problem = None, **sampling_params):
+        return self.get_candidates(model, message_history, 1, json_format, problem, **sampling_params)[0]
+
+    # returns n sampled responses to the same prompt. They are requested in a single call with n=...,
+    # so the prompt is only sent and billed once. Pass temperature > 0 to get distinct candidates.
+    def get_candidates(self, model, message_history : MessageHistory, n = 1, json_format = False, problem = None, **sampling_params):
+        if n > 1:
+            sampling_params["n"] = n
+        cache_key, cached_response = self.cache_lookup(model, message_history, json_format, sampling_params)
+        if cached_response is not None:
+            return cached_response
+
+        model, sampling_params, reservation = self.budget_reserve(model, message_history, sampling_params, problem)
+        self.init_usage(model)
+        try:
+            if not json_format:
+                completion = self.client.chat.completions.create(model=model,
+                                                                 messages=message_history.get_messages(), **sampling_params)
+            else:
+                completion = self.client.chat.completions.create(model=model,
+                        messages=message_history.get_messages(), response_format={'type':'json_object'}, **sampling_params)
+        except Exception:
+            self.budget_release(reservation)
+            raise
+        self.budget_commit(reservation, completion)
 
         #with open(f'LOG_DIR/{self.uuid}-{self.counter}', 'w+') as log:
         #    for m in message_history.get_messages():
@@ -161,56 +441,290 @@ class ChatAPI:
         #    log.write(str(self.get_cost())+"\n")
         self.counter += 1
 
+        self.record_usage(model, completion)
+        self.cache_store(cache_key, completion)
+        return [x.message.content for x in completion.choices]
+
+    # streams the response and returns the code (see CodeExtractor) as soon as it is complete, cancelling
+    # the rest of the stream. Models tend to explain their changes after the code; those tokens are
+    # then neither waited for nor paid for. The code can be compiled while other requests are still streaming.
+    def get_code(self, model, message_history : MessageHistory, json_format = False, problem = None, **sampling_params):
+        # cached separately from get_response, since only the code is stored
+        cache_key, cached_response = self.cache_lookup(model, message_history, json_format, dict(sampling_params, extract="code"))
+        if cached_response is not None:
+            return cached_response[0]
+
+        model, sampling_params, reservation = self.budget_reserve(model, message_history, sampling_params, problem)
+        self.init_usage(model)
+        messages = message_history.get_messages()
+        kwargs = {"model" : model, "messages" : messages, "stream" : True,
+                  "stream_options" : {"include_usage" : True}, **sampling_params}
+        if json_format:
+            kwargs["response_format"] = {'type':'json_object'}
+
+        extractor = CodeExtractor(json_format)
+        usage = None
+        content_chunks = 0
+        try:
+            stream = self.client.chat.completions.create(**kwargs)
+            try:
+                for chunk in stream:
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                    if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                        content_chunks += 1
+                        if extractor.feed(chunk.choices[0].delta.content) is not None:
+                            break
+            finally:
+                stream.close()
+        except Exception:
+            self.budget_release(reservation)
+            raise
+        completion = streamed_completion(usage, messages, content_chunks)
+        self.budget_commit(reservation, completion)
+        self.counter += 1
+        self.record_usage(model, completion)
+
+        code = extractor.finish()
+        if cache_key is not None:
+            self.cache.put(cache_key, code)
+        return code
+
+    # returns (cache key, cached responses). Both are None when caching is disabled.
+    def cache_lookup(self, model, message_history : MessageHistory, json_format, sampling_params):
+        if self.cache is None:
+            return None, None
+        cache_key = self.cache.key(model, message_history.get_messages(), json_format, sampling_params)
+        cached_response = self.cache.get(cache_key, model)
+        if cached_response is None:
+            return cache_key, None
+        # calls with n > 1 store the list of responses as JSON.
+        return cache_key, json.loads(cached_response) if "n" in sampling_params else [cached_response]
+
+    def cache_store(self, cache_key, completion):
+        if cache_key is not None:
+            if len(completion.choices) > 1:
+                self.cache.put(cache_key, json.dumps([x.message.content for x in completion.choices]))
+            else:
+                self.cache.put(cache_key, completion.choices[0].message.content)
+
+    # returns the (possibly downgraded) model and sampling params to call with, and the budget reservation.
+    def budget_reserve(self, model, message_history : MessageHistory, sampling_params, problem):
+        if self.budget is None:
+            return model, sampling_params, None
+        return self.budget.reserve(model, message_history.get_messages(), sampling_params, problem)
+
+    def budget_commit(self, reservation, completion):
+        if reservation is not None:
+            self.budget.commit(reservation, completion)
+
+    def budget_release(self, reservation):
+        if reservation is not None:
+            self.budget.release(reservation)
 
+    def init_usage(self, model):
+        if model not in self.prompt_tokens_used:
+            self.prompt_tokens_used[model] = 0
+        if model not in self.response_tokens_used:
+            self.response_tokens_used[model] = 0
+        if model not in self.cached_prompt_tokens:
+            self.cached_prompt_tokens[model] = 0
+
+    def record_usage(self, model, completion):
         self.response_tokens_used[model] += completion.usage.completion_tokens
         self.prompt_tokens_used[model] += completion.usage.prompt_tokens
         #print(completion.usage.prompt_tokens_details)
-        self.cached_prompt_tokens[model] += completion.usage.prompt_tokens_details.cached_tokens
-        return completion.choices[0].message.content
+        if completion.usage.prompt_tokens_details is not None:
+            self.cached_prompt_tokens[model] += completion.usage.prompt_tokens_details.cached_tokens or 0
 
     def get_usage(self):
         return (self.response_tokens_used, self.prompt_tokens_used, self.cached_prompt_tokens)
 
-    def get_cost(self):
-        prompt_costs = dict()
-        response_costs = dict()
-        prompt_costs['gpt-4o'] = 0.005
-        response_costs['gpt-4o'] = 0.015
-        prompt_costs["gpt-3.5-turbo"] = 0.0005
-        response_costs["gpt-3.5-turbo"] = 0.0015
-        prompt_costs['gpt-4o-mini'] = 0.000150
-        response_costs['gpt-4o-mini'] = 0.000600
-        prompt_costs['gpt-4o-2024-08-06'] = 0.00250
-        response_costs['gpt-4o-2024-08-06'] = 0.01000
-
-        total_prompt = 0
-        total_response = 0
-        for x in self.prompt_tokens_used.keys():
-            if x not in prompt_costs:
-                print(f"Warning {x} not in prompt_costs")
-            else:
-                total_prompt += (self.prompt_tokens_used[x] * prompt_costs[x]) / 1000
+    # returns the (hits, misses) per model of the response cache.
+    def get_cache_stats(self):
+        return self.cache.get_stats() if self.cache is not None else (dict(), dict())
 
-        for x in self.response_tokens_used.keys():
-            if x not in response_costs:
-                print(f"Warning {x} not in response costs")
-            else:
-                total_response += (self.response_tokens_used[x] * response_costs[x]) / 1000
+    # returns, per model, the share of prompt tokens that hit the provider's prompt cache and the
+    # dollars saved by the cached-token discount.
+    def get_prompt_cache_stats(self):
+        stats = dict()
+        for x in self.prompt_tokens_used:
+            prompt_tokens = self.prompt_tokens_used[x]
+            cached_tokens = self.cached_prompt_tokens.get(x, 0)
+            stats[x] = {"prompt_tokens" : prompt_tokens,
+                        "cached_prompt_tokens" : cached_tokens,
+                        "hit_ratio" : cached_tokens / prompt_tokens if prompt_tokens > 0 else 0.0,
+                        "dollars_saved" : (cached_tokens * PROMPT_COSTS.get(x, 0)) / (2*1000)}
+        return stats
+
+    def get_cost(self):
+        total_response, total_prompt = usage_cost(self.prompt_tokens_used, self.response_tokens_used)
         discount = 0
         for x in self.cached_prompt_tokens:
-              discount += (self.cached_prompt_tokens[x]*prompt_costs[x])/(2*1000)
+              discount += (self.cached_prompt_tokens[x]*PROMPT_COSTS.get(x, 0))/(2*1000)
 
         return (total_response, total_prompt, total_prompt+total_response, total_prompt + total_response - discount)
         return (self.response_tokens_used, self.prompt_tokens_used)
 
 
-        
-        
+# Bucket that refills continuously at `per_minute` units per minute, up to `per_minute` units.
+# acquire() waits until the requested amount is available. The balance may go negative when
+# a request turns out to use more tokens than estimated, which delays later requests.
+class TokenBucket:
+    def __init__(self, per_minute : float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.available = per_minute
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
 
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.last_refill) * self.rate)
+        self.last_refill = now
 
-      
+    async def acquire(self, amount : float):
+        # never wait for more than a full bucket
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self.refill()
+            while self.available < amount:
+                await asyncio.sleep((amount - self.available) / self.rate)
+                self.refill()
+            self.available -= amount
 
-    
-    
-    
-    
+    # correct an earlier estimate once the real amount is known.
+    def adjust(self, amount : float):
+        self.refill()
+        self.available -= amount
+
+
+# asyncio version of ChatAPI. Many get_response calls can be awaited concurrently (e.g. with
+# asyncio.gather); at most max_concurrency are in flight at once, requests and tokens are
+# rate limited per minute, and rate limit / connection / server errors are retried with
+# jittered exponential backoff. Token and cost accounting is shared with ChatAPI.
+class AsyncChatAPI(ChatAPI):
+    # errors worth retrying, anything else is raised immediately.
+    RETRY_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+    def __init__(self, max_concurrency : int = 16, requests_per_minute : float = None, tokens_per_minute : float = None,
+                 max_retries : int = 6, backoff_base : float = 1.0, backoff_max : float = 60.0, cache : ResponseCache = None,
+                 budget = None, **client_kwargs):
+        # client_kwargs are passed to AsyncOpenAI, e.g. api_key and base_url.
+        # retries are done here so they share the rate limiter.
+        super().__init__(cache=cache, budget=budget, client=AsyncOpenAI(max_retries=0, **client_kwargs))
+        self.max_concurrency = max_concurrency
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retries = 0
+        # created lazily so the object can be constructed outside of a running event loop.
+        self.semaphore = None
+
+    async def get_response(self, model, message_history : MessageHistory, json_format = False, problem = None, **sampling_params):
+        return (await self.get_candidates(model, message_history, 1, json_format, problem, **sampling_params))[0]
+
+    async def get_candidates(self, model, message_history : MessageHistory, n = 1, json_format = False, problem = None, **sampling_params):
+        if n > 1:
+            sampling_params["n"] = n
+        cache_key, cached_response = self.cache_lookup(model, message_history, json_format, sampling_params)
+        if cached_response is not None:
+            return cached_response
+        model, sampling_params, reservation = self.budget_reserve(model, message_history, sampling_params, problem)
+        self.init_usage(model)
+
+        messages = message_history.get_messages()
+        kwargs = {"model" : model, "messages" : messages, **sampling_params}
+        if json_format:
+            kwargs["response_format"] = {'type':'json_object'}
+
+        completion = await self.request(lambda: self.client.chat.completions.create(**kwargs), messages, reservation)
+        self.record_usage(model, completion)
+        self.cache_store(cache_key, completion)
+        return [x.message.content for x in completion.choices]
+
+    # asyncio version of ChatAPI.get_code.
+    async def get_code(self, model, message_history : MessageHistory, json_format = False, problem = None, **sampling_params):
+        cache_key, cached_response = self.cache_lookup(model, message_history, json_format, dict(sampling_params, extract="code"))
+        if cached_response is not None:
+            return cached_response[0]
+        model, sampling_params, reservation = self.budget_reserve(model, message_history, sampling_params, problem)
+        self.init_usage(model)
+
+        messages = message_history.get_messages()
+        kwargs = {"model" : model, "messages" : messages, "stream" : True,
+                  "stream_options" : {"include_usage" : True}, **sampling_params}
+        if json_format:
+            kwargs["response_format"] = {'type':'json_object'}
+
+        extractor = None
+        async def stream_code():
+            # a retried request starts over
+            nonlocal extractor
+            extractor = CodeExtractor(json_format)
+            usage = None
+            content_chunks = 0
+            stream = await self.client.chat.completions.create(**kwargs)
+            try:
+                async for chunk in stream:
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                    if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                        content_chunks += 1
+                        if extractor.feed(chunk.choices[0].delta.content) is not None:
+                            break
+            finally:
+                await stream.close()
+            return streamed_completion(usage, messages, content_chunks)
+
+        completion = await self.request(stream_code, messages, reservation)
+        self.record_usage(model, completion)
+        code = extractor.finish()
+        if cache_key is not None:
+            self.cache.put(cache_key, code)
+        return code
+
+    # awaits make_request() within the concurrency and rate limits, retrying failed requests, and
+    # settles the budget reservation. make_request returns the completion (or a completion-like object).
+    async def request(self, make_request, messages, reservation):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        # reserve tokens for the prompt before the real count is known
+        estimated_tokens = estimate_tokens(messages)
+
+        attempt = 0
+        while True:
+            if self.request_bucket is not None:
+                await self.request_bucket.acquire(1)
+            if self.token_bucket is not None:
+                await self.token_bucket.acquire(estimated_tokens)
+            try:
+                async with self.semaphore:
+                    completion = await make_request()
+                break
+            except self.RETRY_ERRORS as e:
+                if attempt >= self.max_retries:
+                    self.budget_release(reservation)
+                    raise
+                # full jitter: sleep a random time up to the exponential backoff.
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+                logging.info(f"Retrying request after {type(e).__name__} in {delay:.2f}s")
+                attempt += 1
+                self.retries += 1
+                await asyncio.sleep(delay)
+            # a cancelled request does not spend its reservation either
+            except (Exception, asyncio.CancelledError):
+                self.budget_release(reservation)
+                raise
+
+        self.budget_commit(reservation, completion)
+        if self.token_bucket is not None:
+            self.token_bucket.adjust(completion.usage.total_tokens - estimated_tokens)
+        self.counter += 1
+        return completion
+
+    # returns the responses for all message histories, in order.
+    async def get_responses(self, model, message_histories, json_format = False, problem = None, **sampling_params):
+        return await asyncio.gather(*(self.get_response(model, m, json_format=json_format, problem=problem, **sampling_params) for m in message_histories))
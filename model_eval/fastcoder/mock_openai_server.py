@@ -0,0 +1,341 @@
+""" Local stand-in for the OpenAI chat completions API, used to load test and regression test ChatAPI,
+    AsyncChatAPI, ChatPIE and the evaluation scripts offline and reproducibly.
+
+    python -m fastcoder.mock_openai_server --port 8000 --latency-median 2.0 --rate-limit-rpm 60
+
+    and point the client at it, e.g. ChatAPI with OPENAI_BASE_URL=http://127.0.0.1:8000/v1 OPENAI_API_KEY=0,
+    or AsyncChatAPI(api_key="0", base_url="http://127.0.0.1:8000/v1"). It can also be started in-process:
+
+    server = MockOpenAIServer(latency_median=0.5).start()
+    ...
+    server.stop()
+"""
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import collections
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+
+from fastcoder.chatapi import CHARS_PER_TOKEN, estimate_tokens
+
+# OpenAI caches prompt prefixes of at least this many tokens, in increments of CACHE_BLOCK_TOKENS.
+MIN_CACHED_PREFIX_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+
+class MockOpenAIServer:
+    # latency_median / latency_sigma: request latency is drawn from a lognormal distribution with this median
+    #   (seconds) and shape. latency_per_token is added for every completion token.
+    # max_concurrency: requests processed at once, later requests wait for a free slot (throughput limit).
+    # rate_limit_rpm: requests per minute above which 429 errors are returned, with a Retry-After header.
+    # error_rate: fraction of requests that randomly fail with a 429 or 500 error.
+    # responses: list of canned responses. Entries are either a string, or a dict with "response" and
+    #   optionally "messages". Responses with messages are replayed for requests with the same messages,
+    #   the others are returned in order, cycling. Without responses, the server echoes the last user message.
+    # prompt_cache: report cached_tokens for prompt prefixes seen before, like OpenAI's prompt cache.
+    # seed: seed of the random latencies and errors.
+    def __init__(self, host : str = "127.0.0.1", port : int = 0, latency_median : float = 0.5, latency_sigma : float = 0.0,
+                 latency_per_token : float = 0.0, max_concurrency : int = 64, rate_limit_rpm : float = None,
+                 error_rate : float = 0.0, responses = None, prompt_cache : bool = True, seed : int = 0):
+        self.host = host
+        self.port = port
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.latency_per_token = latency_per_token
+        self.rate_limit_rpm = rate_limit_rpm
+        self.error_rate = error_rate
+        self.prompt_cache = prompt_cache
+        self.random = random.Random(seed)
+        self.slots = threading.Semaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.request_times = collections.deque()
+        self.cached_prefixes = set()
+
+        self.replay = dict()
+        self.canned = []
+        for x in responses or []:
+            if isinstance(x, str):
+                self.canned.append(x)
+            elif "messages" in x:
+                self.replay[self.messages_key(x["messages"])] = x["response"]
+            else:
+                self.canned.append(x["response"])
+        self.canned_index = 0
+
+        # counters, for checking client behavior in tests
+        self.requests = 0
+        self.completed = 0
+        self.rate_limited = 0
+        self.errors = 0
+        # streams the client closed before the end
+        self.cancelled = 0
+        self.streamed_tokens = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def serve_forever(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), self.handler_class())
+        self.httpd.daemon_threads = True
+        print(f"Serving OpenAI-compatible API on {self.base_url}")
+        self.httpd.serve_forever()
+
+    def handler_class(self):
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.rstrip("/") == "/v1/models":
+                    self.send_json(200, {"object" : "list", "data" : []})
+                else:
+                    self.send_json(404, error_body("not found", "invalid_request_error"))
+
+            def do_POST(self):
+                if self.path.rstrip("/") != "/v1/chat/completions":
+                    self.send_json(404, error_body("not found", "invalid_request_error"))
+                    return
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                status, response, headers = server.complete(body, self.send_event if body.get("stream") else None)
+                if response is not None:
+                    self.send_json(status, response, headers)
+
+            # sends one server-sent event, the first one after the response headers. The connection is
+            # closed at the end of the response, which ends the stream.
+            def send_event(self, data):
+                if not self.headers_sent:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Cache-Control", "no-cache")
+                    self.end_headers()
+                    self.headers_sent = True
+                self.wfile.write(f"data: {data if isinstance(data, str) else json.dumps(data)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+            headers_sent = False
+
+            def send_json(self, status, body, headers = {}):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+        return Handler
+
+    @staticmethod
+    def messages_key(messages):
+        material = json.dumps([{"role" : m["role"], "content" : m["content"]} for m in messages], sort_keys=True)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    # returns (status, body, headers) for a chat completion request. With send_event (stream=True requests)
+    # the completion is sent as a stream of chunks instead and the returned body is None.
+    def complete(self, body, send_event = None):
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            if self.rate_limit_rpm is not None:
+                while len(self.request_times) > 0 and now - self.request_times[0] > 60:
+                    self.request_times.popleft()
+                if len(self.request_times) >= self.rate_limit_rpm:
+                    self.rate_limited += 1
+                    retry_after = max(0.0, 60 - (now - self.request_times[0]))
+                    return 429, error_body("Rate limit reached for requests", "requests"), {"Retry-After" : f"{retry_after:.3f}"}
+                self.request_times.append(now)
+            injected_error = self.random.random() < self.error_rate
+            error_status = self.random.choice([429, 500])
+            latency = self.latency_median * math.exp(self.latency_sigma * self.random.gauss(0, 1))
+
+        if injected_error:
+            with self.lock:
+                self.errors += 1
+            time.sleep(latency)
+            if error_status == 429:
+                return 429, error_body("Rate limit reached for tokens", "tokens"), {"Retry-After" : "0.1"}
+            return 500, error_body("The server had an error while processing your request", "server_error"), {}
+
+        messages = body.get("messages", [])
+        prompt_tokens = estimate_tokens(messages)
+        # n choices are generated in parallel, so the latency follows the longest one.
+        choices = []
+        completion_tokens = 0
+        max_choice_tokens = 0
+        for index in range(body.get("n") or 1):
+            content = self.response_content(messages, body)
+            choice_tokens = estimate_tokens([{"content" : content}])
+            if body.get("max_tokens") is not None and choice_tokens > body["max_tokens"]:
+                choice_tokens = body["max_tokens"]
+                content = content[:choice_tokens * CHARS_PER_TOKEN]
+                finish_reason = "length"
+            else:
+                finish_reason = "stop"
+            choices.append({"index" : index, "finish_reason" : finish_reason,
+                            "message" : {"role" : "assistant", "content" : content}})
+            completion_tokens += choice_tokens
+            max_choice_tokens = max(max_choice_tokens, choice_tokens)
+        cached_tokens = self.cached_prompt_tokens(messages, prompt_tokens)
+
+        usage = {"prompt_tokens" : prompt_tokens,
+                 "completion_tokens" : completion_tokens,
+                 "total_tokens" : prompt_tokens + completion_tokens,
+                 "prompt_tokens_details" : {"cached_tokens" : cached_tokens}}
+
+        with self.slots:
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                if send_event is not None:
+                    self.stream(body, choices, usage, latency, send_event)
+                else:
+                    time.sleep(latency + max_choice_tokens * self.latency_per_token)
+                with self.lock:
+                    self.completed += 1
+            except (BrokenPipeError, ConnectionResetError):
+                with self.lock:
+                    self.cancelled += 1
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+
+        if send_event is not None:
+            return 200, None, {}
+        return 200, {
+            "id" : f"chatcmpl-mock-{self.requests}",
+            "object" : "chat.completion",
+            "created" : int(time.time()),
+            "model" : body.get("model", "mock"),
+            "choices" : choices,
+            "usage" : usage,
+        }, {}
+
+    # streams the choices one token (CHARS_PER_TOKEN characters) at a time, latency_per_token apart,
+    # after latency. Raises BrokenPipeError or ConnectionResetError if the client cancels the stream.
+    def stream(self, body, choices, usage, latency, send_event):
+        chunk = {"id" : f"chatcmpl-mock-{self.requests}", "object" : "chat.completion.chunk",
+                 "created" : int(time.time()), "model" : body.get("model", "mock")}
+        time.sleep(latency)
+        for choice in choices:
+            send_event(dict(chunk, choices=[{"index" : choice["index"], "finish_reason" : None,
+                                             "delta" : {"role" : "assistant", "content" : ""}}]))
+        longest = max(len(choice["message"]["content"]) for choice in choices)
+        for start in range(0, longest, CHARS_PER_TOKEN):
+            for choice in choices:
+                content = choice["message"]["content"][start:start + CHARS_PER_TOKEN]
+                if content != "":
+                    send_event(dict(chunk, choices=[{"index" : choice["index"], "finish_reason" : None,
+                                                     "delta" : {"content" : content}}]))
+                    with self.lock:
+                        self.streamed_tokens += 1
+            time.sleep(self.latency_per_token)
+        for choice in choices:
+            send_event(dict(chunk, choices=[{"index" : choice["index"], "finish_reason" : choice["finish_reason"], "delta" : {}}]))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            send_event(dict(chunk, choices=[], usage=usage))
+        send_event("[DONE]")
+
+    def response_content(self, messages, body):
+        key = self.messages_key(messages)
+        if key in self.replay:
+            return self.replay[key]
+        with self.lock:
+            if len(self.canned) > 0:
+                content = self.canned[self.canned_index % len(self.canned)]
+                self.canned_index += 1
+                return content
+        # echo the last user message
+        last_user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        if (body.get("response_format") or {}).get("type") == "json_object":
+            try:
+                source = next(iter(json.loads(last_user).values()))
+            except (ValueError, AttributeError, StopIteration):
+                source = last_user
+            return json.dumps({"updated_code" : source})
+        return last_user
+
+    # number of leading prompt tokens that match a prefix of an earlier prompt, in CACHE_BLOCK_TOKENS
+    # increments and only once the prefix reaches MIN_CACHED_PREFIX_TOKENS. Every prefix of this prompt is
+    # remembered for later requests.
+    def cached_prompt_tokens(self, messages, prompt_tokens):
+        if not self.prompt_cache or prompt_tokens < MIN_CACHED_PREFIX_TOKENS:
+            return 0
+        text = "".join(f"<{m['role']}>{m['content']}" for m in messages)
+        block_chars = CACHE_BLOCK_TOKENS * CHARS_PER_TOKEN
+        cached = 0
+        digest = hashlib.sha256()
+        with self.lock:
+            for end in range(block_chars, len(text) + 1, block_chars):
+                digest.update(text[end - block_chars:end].encode("utf-8"))
+                prefix = digest.copy().hexdigest()
+                tokens = end // CHARS_PER_TOKEN
+                if prefix in self.cached_prefixes:
+                    cached = tokens
+                else:
+                    self.cached_prefixes.add(prefix)
+        return cached if cached >= MIN_CACHED_PREFIX_TOKENS else 0
+
+def error_body(message, type):
+    return {"error" : {"message" : message, "type" : type, "param" : None, "code" : None}}
+
+def load_responses(fpath):
+    # a JSON list, or JSONL with one response per line
+    with open(fpath, "r") as fp:
+        text = fp.read()
+    try:
+        return json.loads(text)
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line.strip() != ""]
+
+def get_args():
+    parser = ArgumentParser(description="Local OpenAI-compatible /v1/chat/completions server for offline load testing.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument("--latency-median", type=float, default=0.5, help="Median request latency in seconds.")
+    parser.add_argument("--latency-sigma", type=float, default=0.0, help="Shape of the lognormal latency distribution. 0 is a fixed latency.")
+    parser.add_argument("--latency-per-token", type=float, default=0.0, help="Additional latency in seconds per completion token.")
+    parser.add_argument("--max-concurrency", type=int, default=64, help="Requests processed at once, the others wait.")
+    parser.add_argument("--rate-limit-rpm", type=float, help="Return 429 errors above this many requests per minute.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail with a random 429 or 500 error.")
+    parser.add_argument("--responses", type=str, help="JSON or JSONL file of canned responses, either strings or " +
+        "{\"response\": ..., \"messages\": [...]} to replay a response for specific messages.")
+    parser.add_argument("--no-prompt-cache", action="store_true", help="Never report cached prompt tokens.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the random latencies and errors.")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    server = MockOpenAIServer(host=args.host, port=args.port, latency_median=args.latency_median, latency_sigma=args.latency_sigma,
+                              latency_per_token=args.latency_per_token, max_concurrency=args.max_concurrency,
+                              rate_limit_rpm=args.rate_limit_rpm, error_rate=args.error_rate,
+                              responses=load_responses(args.responses) if args.responses else None,
+                              prompt_cache=not args.no_prompt_cache, seed=args.seed)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
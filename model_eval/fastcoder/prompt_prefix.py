@@ -0,0 +1,54 @@
+import logging
+
+from fastcoder.chatapi import MessageHistory, ChatAPI, estimate_tokens
+
+# OpenAI only caches prompts of at least this many tokens, in increments of 128 tokens after that.
+MIN_CACHED_PREFIX_TOKENS = 1024
+
+# Builds message histories that all start with the same stable prefix so that the provider's
+# prompt cache can serve it at the cached-token price. The prefix is everything that does not
+# depend on the problem: the system prompt, the few-shot examples and a problem-independent
+# header. Volatile content (the problem's source code, feedback from earlier attempts, ...)
+# always goes last. The prefix must be byte-for-byte identical between calls to hit the cache,
+# so do not put timestamps, seeds or problem ids in it. Prefixes shorter than
+# MIN_CACHED_PREFIX_TOKENS are never served from the cache; `cacheable` tells whether this one is.
+#
+# Usage:
+#   prefix = PromptPrefix(system_prompt, examples=[(example_input, example_output)], header="...")
+#   messages = prefix.build(json.dumps({"source_code" : problem.source_code}))
+#   response = chatAPI.get_response(model, messages)
+#   ...
+#   prefix.report(chatAPI)
+class PromptPrefix:
+    def __init__(self, system_prompt : str, examples = (), header : str = ""):
+        # examples: list of (user, assistant) message pairs shown before the problem.
+        # header: problem-independent text put in front of the volatile content of the last user message.
+        self.header = header
+        self.root = MessageHistory()
+        self.root.add_message("system", system_prompt)
+        for user, assistant in examples:
+            self.root.add_message("user", user)
+            self.root.add_message("assistant", assistant)
+
+        self.prefix_tokens = estimate_tokens(self.root.get_messages()) + estimate_tokens([{"content" : header}])
+        self.cacheable = self.prefix_tokens >= MIN_CACHED_PREFIX_TOKENS
+
+    # returns a new MessageHistory with the shared prefix followed by the volatile content.
+    # The history forks the shared prefix, so building many of them is cheap.
+    def build(self, volatile_content : str, role : str = "user"):
+        messages = self.root.fork()
+        if self.header != "" and role == "user":
+            messages.add_message(role, f"{self.header}\n\n{volatile_content}")
+        else:
+            messages.add_message(role, volatile_content)
+        return messages
+
+    # logs and returns the prompt cache hit ratio and the dollars saved by cached tokens of a run.
+    def report(self, chat_api : ChatAPI):
+        logging.info(f"shared prompt prefix: ~{self.prefix_tokens} tokens, "
+                     f"{'cacheable' if self.cacheable else f'not cached (below {MIN_CACHED_PREFIX_TOKENS} tokens)'}")
+        stats = chat_api.get_prompt_cache_stats()
+        for model, x in stats.items():
+            logging.info(f"{model}: {x['cached_prompt_tokens']}/{x['prompt_tokens']} prompt tokens cached "
+                         f"({100 * x['hit_ratio']:.1f}%), ${x['dollars_saved']:.4f} saved")
+        return stats
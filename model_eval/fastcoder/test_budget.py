@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+
+import pytest
+
+from fastcoder.budget import BudgetExceeded, BudgetLedger
+from fastcoder.chatapi import RESPONSE_COSTS
+
+MESSAGES = [{"role" : "system", "content" : "You optimize code."}, {"role" : "user", "content" : "int f() { return 1; }"}]
+
+def completion(prompt_tokens, completion_tokens):
+    return SimpleNamespace(usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                                 prompt_tokens_details=None))
+
+# dollars needed for a call to `model` with `completion_tokens` completion tokens.
+def worst_case(ledger, model, completion_tokens):
+    return ledger.cost(model, ledger.count_prompt_tokens(model, MESSAGES), completion_tokens)
+
+def test_max_tokens_bounds_the_reservation_when_the_call_fits():
+    ledger = BudgetLedger(limit=2.0)
+    model, sampling_params, reservation = ledger.reserve("gpt-4o", MESSAGES, {"temperature" : 0.2})
+    assert model == "gpt-4o"
+    assert sampling_params == {"temperature" : 0.2, "max_tokens" : ledger.default_max_tokens}
+    assert reservation[1] == pytest.approx(worst_case(ledger, "gpt-4o", ledger.default_max_tokens))
+    assert ledger.downgraded == 0
+
+def test_callers_max_tokens_is_kept_when_the_call_fits():
+    ledger = BudgetLedger(limit=2.0)
+    _, sampling_params, _ = ledger.reserve("gpt-4o", MESSAGES, {"max_tokens" : 100})
+    assert sampling_params == {"max_tokens" : 100}
+
+def test_model_is_downgraded_before_max_tokens_is_lowered():
+    ledger = BudgetLedger(limit=1.0)
+    # too little left for gpt-4o with default_max_tokens, plenty for gpt-4o-mini
+    ledger.spent = ledger.limit - worst_case(ledger, "gpt-4o", ledger.default_max_tokens) / 2
+    model, sampling_params, _ = ledger.reserve("gpt-4o", MESSAGES, {})
+    assert model == "gpt-4o-mini"
+    assert sampling_params["max_tokens"] == ledger.default_max_tokens
+    assert ledger.downgraded == 1
+
+def test_max_tokens_is_bounded_when_only_a_shorter_completion_fits():
+    ledger = BudgetLedger(limit=1.0, downgrades={})
+    ledger.spent = ledger.limit - worst_case(ledger, "gpt-4o", 1000)
+    model, sampling_params, reservation = ledger.reserve("gpt-4o", MESSAGES, {})
+    assert model == "gpt-4o"
+    assert ledger.min_completion_tokens <= sampling_params["max_tokens"] < ledger.default_max_tokens
+    assert reservation[1] <= worst_case(ledger, "gpt-4o", 1000) + 1e-12
+    assert ledger.downgraded == 1
+
+def test_call_that_does_not_fit_is_rejected_without_spending():
+    ledger = BudgetLedger(limit=1.0)
+    ledger.spent = ledger.limit - worst_case(ledger, "gpt-4o-mini", ledger.min_completion_tokens) / 2
+    with pytest.raises(BudgetExceeded):
+        ledger.reserve("gpt-4o", MESSAGES, {})
+    assert ledger.rejected == 1
+    assert ledger.reserved == 0
+
+def test_n_completions_are_all_reserved():
+    ledger = BudgetLedger(limit=2.0)
+    _, _, single = ledger.reserve("gpt-4o", MESSAGES, {"max_tokens" : 1000})
+    _, _, four = ledger.reserve("gpt-4o", MESSAGES, {"max_tokens" : 1000, "n" : 4})
+    completion_cost = 1000 * RESPONSE_COSTS["gpt-4o"] / 1000
+    assert four[1] - single[1] == pytest.approx(3 * completion_cost)
+
+def test_free_models_are_not_bounded():
+    ledger = BudgetLedger(limit=0.0)
+    model, sampling_params, reservation = ledger.reserve("local-model", MESSAGES, {})
+    assert model == "local-model" and sampling_params == {}
+    assert reservation[1] == 0
+
+def test_commit_replaces_the_reservation_with_the_actual_cost():
+    ledger = BudgetLedger(limit=2.0)
+    _, _, reservation = ledger.reserve("gpt-4o-mini", MESSAGES, {}, problem="p1")
+    assert ledger.remaining() < 2.0
+    ledger.commit(reservation, completion(100, 50))
+    assert ledger.reserved == pytest.approx(0)
+    assert ledger.spent == pytest.approx(BudgetLedger.cost("gpt-4o-mini", 100, 50))
+    assert ledger.spend_per_problem == {"p1" : pytest.approx(ledger.spent)}
+
+def test_release_drops_the_reservation():
+    ledger = BudgetLedger(limit=2.0)
+    _, _, reservation = ledger.reserve("gpt-4o", MESSAGES, {})
+    ledger.release(reservation)
+    assert ledger.remaining() == pytest.approx(2.0)
+
+def test_ledgers_do_not_share_downgrades():
+    first = BudgetLedger()
+    first.downgrades["gpt-4o-mini"] = "gpt-3.5-turbo"
+    assert "gpt-4o-mini" not in BudgetLedger().downgrades
+
+def test_chat_pie_stops_at_two_dollars_by_default():
+    from fastcoder.chatapi import ChatPIE
+    assert ChatPIE().budget.limit == 2.0
@@ -0,0 +1,249 @@
+import asyncio
+import copy
+import json
+import time
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+from fastcoder.budget import BudgetLedger
+from fastcoder.chatapi import AsyncChatAPI, ChatAPI, CodeExtractor, MessageHistory, ResponseCache, TokenBucket
+
+def completion(content, prompt_tokens = 10, completion_tokens = 5):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                           usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                                 total_tokens=prompt_tokens + completion_tokens, prompt_tokens_details=None))
+
+# chat.completions.create that raises the given errors in turn before answering.
+class FlakyCompletions:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+        return completion("ok")
+
+# a retried error that does not need an http request to construct.
+class ConnectionLost(openai.APIConnectionError):
+    def __init__(self):
+        Exception.__init__(self, "Connection error.")
+
+def flaky_api(errors, **kwargs):
+    api = AsyncChatAPI(api_key="0", backoff_base=0.001, **kwargs)
+    completions = FlakyCompletions(errors)
+    api.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    return api, completions
+
+def messages():
+    history = MessageHistory()
+    history.add_message("user", "hello")
+    return history
+
+def test_forked_histories_share_the_parent_prefix():
+    parent = messages()
+    child = parent.fork()
+    child.add_message("assistant", "hi")
+    parent.add_message("user", "again")
+    assert [m["content"] for m in parent.get_messages()] == ["hello", "again"]
+    assert [m["content"] for m in child.get_messages()] == ["hello", "hi"]
+    assert parent.get_messages()[0] is child.get_messages()[0]
+    assert child.revert() is parent and len(child) == 2
+
+def test_messages_are_read_only_but_copy_to_plain_dicts():
+    history = messages()
+    message = history.get_messages()[0]
+    with pytest.raises(TypeError):
+        message["content"] = "changed"
+    with pytest.raises(TypeError):
+        message.update(role="system")
+    writable = copy.deepcopy(list(history.get_messages()))
+    writable[0]["content"] = "changed"
+    assert history.get_messages()[0]["content"] == "hello"
+    assert json.loads(json.dumps(history.get_messages())) == [{"role" : "user", "content" : "hello"}]
+
+def test_assigning_message_history_rebuilds_it():
+    history = messages()
+    history.message_history = [{"role" : "system", "content" : "s"}, {"role" : "user", "content" : "u"}]
+    assert [m["role"] for m in history.message_history] == ["system", "user"]
+
+def test_fork_headless_returns_an_empty_child():
+    parent = messages()
+    parent.fork()
+    headless = parent.fork_headless()
+    assert len(headless) == 0 and headless is parent.headless_children[-1]
+    headless.add_message("user", "x")
+    assert parent.dump()["headless_children"] == [{"message_history" : [{"role" : "user", "content" : "x"}],
+                                                   "children" : [], "headless_children" : []}]
+
+def test_token_bucket_starts_full():
+    async def main():
+        bucket = TokenBucket(per_minute=600)
+        start = time.monotonic()
+        await bucket.acquire(600)
+        return time.monotonic() - start
+    assert asyncio.run(main()) < 0.05
+
+def test_token_bucket_waits_for_refill():
+    async def main():
+        bucket = TokenBucket(per_minute=600)
+        await bucket.acquire(600)
+        start = time.monotonic()
+        # 10 units per second
+        await bucket.acquire(1)
+        return time.monotonic() - start
+    assert 0.08 <= asyncio.run(main()) < 0.5
+
+def test_token_bucket_caps_requests_at_capacity():
+    async def main():
+        bucket = TokenBucket(per_minute=600)
+        start = time.monotonic()
+        await bucket.acquire(10000)
+        return time.monotonic() - start, bucket.available
+    elapsed, available = asyncio.run(main())
+    assert elapsed < 0.05
+    assert available <= 0.1
+
+def test_token_bucket_adjust_delays_later_requests():
+    async def main():
+        bucket = TokenBucket(per_minute=600)
+        await bucket.acquire(600)
+        # the request used 2 more units than estimated
+        bucket.adjust(2)
+        start = time.monotonic()
+        await bucket.acquire(1)
+        return time.monotonic() - start
+    assert asyncio.run(main()) >= 0.25
+
+def test_async_api_shares_chat_api_state():
+    api = AsyncChatAPI(api_key="0", budget=BudgetLedger(limit=1.0))
+    assert isinstance(api.client, openai.AsyncOpenAI)
+    assert api.budget.limit == 1.0 and api.cache is None
+    assert api.get_cost() == (0, 0, 0, 0)
+    assert ChatAPI(client=api.client).client is api.client
+
+def test_retries_transient_errors():
+    api, completions = flaky_api([ConnectionLost(), ConnectionLost()], budget=BudgetLedger(limit=1.0))
+    assert asyncio.run(api.get_response("gpt-4o-mini", messages())) == "ok"
+    assert completions.calls == 3
+    assert api.retries == 2
+    assert api.get_usage()[0] == {"gpt-4o-mini" : 5}
+    assert api.budget.reserved == pytest.approx(0)
+    assert api.budget.spent > 0
+
+def test_gives_up_after_max_retries_and_releases_the_budget():
+    api, completions = flaky_api([ConnectionLost()] * 3, max_retries=2, budget=BudgetLedger(limit=1.0))
+    with pytest.raises(openai.APIConnectionError):
+        asyncio.run(api.get_response("gpt-4o-mini", messages()))
+    assert completions.calls == 3
+    assert api.budget.reserved == pytest.approx(0) and api.budget.spent == 0
+
+def test_other_errors_are_not_retried():
+    api, completions = flaky_api([ValueError("bad request")])
+    with pytest.raises(ValueError):
+        asyncio.run(api.get_response("gpt-4o-mini", messages()))
+    assert completions.calls == 1 and api.retries == 0
+
+def test_cancelled_requests_release_the_budget():
+    async def main():
+        api, completions = flaky_api([], budget=BudgetLedger(limit=1.0))
+        started = asyncio.Event()
+        async def hang(**kwargs):
+            started.set()
+            await asyncio.sleep(10)
+        completions.create = hang
+        task = asyncio.create_task(api.get_response("gpt-4o-mini", messages()))
+        await started.wait()
+        assert api.budget.reserved > 0
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return api.budget
+    budget = asyncio.run(main())
+    assert budget.reserved == pytest.approx(0) and budget.spent == 0
+
+# chat.completions.create that numbers its responses.
+class CountingCompletions:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        return completion(f"response {self.calls}")
+
+def cached_api(path):
+    api = AsyncChatAPI(api_key="0", cache=ResponseCache(str(path)))
+    completions = CountingCompletions()
+    api.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    return api, completions
+
+def test_response_cache_replays_repeated_samples_in_order(tmp_path):
+    async def sample(api, n):
+        return [await api.get_response("gpt-4o-mini", messages(), temperature=0.8) for _ in range(n)]
+    first, first_completions = cached_api(tmp_path / "responses.sqlite")
+    assert asyncio.run(sample(first, 2)) == ["response 1", "response 2"]
+
+    # a re-run replays both samples, then asks for a new one
+    second, second_completions = cached_api(tmp_path / "responses.sqlite")
+    assert asyncio.run(sample(second, 3)) == ["response 1", "response 2", "response 1"]
+    assert second_completions.calls == 1
+    assert second.get_cache_stats() == ({"gpt-4o-mini" : 2}, {"gpt-4o-mini" : 1})
+    # hits are not paid for
+    assert second.get_usage()[0] == {"gpt-4o-mini" : 5}
+
+def test_response_cache_key_covers_the_request():
+    cache = ResponseCache(":memory:")
+    base = ("gpt-4o-mini", [{"role" : "user", "content" : "hi"}], False, {"temperature" : 0.2})
+    keys = {cache.key(*base),
+            cache.key("gpt-4o", *base[1:]),
+            cache.key(base[0], [{"role" : "user", "content" : "hello"}], *base[2:]),
+            cache.key(*base[:2], True, base[3]),
+            cache.key(*base[:3], {"temperature" : 0.8})}
+    assert len(keys) == 5
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"), max_size_bytes=20)
+    cache.put("a", "x" * 10)
+    cache.put("b", "y" * 10)
+    time.sleep(0.01)
+    assert cache.get("a", "m") is not None
+    time.sleep(0.01)
+    cache.put("c", "z" * 10)
+    assert cache.get("b", "m") is None
+    assert cache.get("a", "m") is not None and cache.get("c", "m") is not None
+
+# feeds the response in chunks of `size` characters, returns the code and how many characters were fed.
+def extract(text, json_format = False, size = 3):
+    extractor = CodeExtractor(json_format)
+    for start in range(0, len(text), size):
+        if extractor.feed(text[start:start + size]) is not None:
+            return extractor.code, start + size
+    return extractor.finish(), len(text)
+
+def test_code_extractor_stops_at_closing_fence():
+    text = "Here you go:\n```cpp\nint f() {\n  return 1; // ``` not a fence\n}\n```\nThis is faster because..."
+    code, fed = extract(text)
+    assert code == "int f() {\n  return 1; // ``` not a fence\n}\n"
+    assert fed < len(text) - len("This is faster because")
+
+def test_code_extractor_handles_fence_split_across_chunks():
+    text = "```\nint x;\n```"
+    for size in range(1, len(text) + 1):
+        assert extract(text, size=size)[0] == "int x;\n"
+
+def test_code_extractor_json_stops_at_closing_quote():
+    code = 'int f() {\n  printf("\\"quoted\\"\\n");\n}'
+    text = json.dumps({"updated_code" : code, "explanation" : "long text " * 20})
+    for size in [1, 2, 7]:
+        extracted, fed = extract(text, json_format=True, size=size)
+        assert extracted == code
+        assert fed < len(text) - 100
+
+def test_code_extractor_finish_without_complete_code():
+    assert extract("```cpp\nint f() {\n  return 1;")[0] == "int f() {\n  return 1;"
+    assert extract("int f() { return 1; }")[0] == "int f() { return 1; }"
+    with pytest.raises(ValueError):
+        extract('{"updated_code" : "int f(', json_format=True)
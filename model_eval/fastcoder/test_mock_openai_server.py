@@ -0,0 +1,80 @@
+import asyncio
+
+import openai
+import pytest
+
+from fastcoder.chatapi import AsyncChatAPI, MessageHistory
+from fastcoder.mock_openai_server import MIN_CACHED_PREFIX_TOKENS, MockOpenAIServer
+
+@pytest.fixture
+def start_server():
+    servers = []
+    def start(**kwargs):
+        server = MockOpenAIServer(**dict({"latency_median" : 0.0}, **kwargs)).start()
+        servers.append(server)
+        return server, openai.OpenAI(base_url=server.base_url, api_key="0", max_retries=0)
+    yield start
+    for server in servers:
+        server.stop()
+
+def user(content):
+    return [{"role" : "user", "content" : content}]
+
+def test_echoes_the_last_user_message(start_server):
+    server, client = start_server()
+    completion = client.chat.completions.create(model="gpt-4o-mini", messages=user("int f() { return 1; }"))
+    assert completion.choices[0].message.content == "int f() { return 1; }"
+    assert completion.choices[0].finish_reason == "stop"
+    assert completion.usage.completion_tokens > 0 and completion.usage.prompt_tokens > 0
+    assert (server.requests, server.completed) == (1, 1)
+
+def test_n_choices_are_cut_at_max_tokens(start_server):
+    _, client = start_server()
+    completion = client.chat.completions.create(model="gpt-4o-mini", messages=user("hello world"), n=2, max_tokens=1)
+    assert [c.message.content for c in completion.choices] == ["hell", "hell"]
+    assert [c.finish_reason for c in completion.choices] == ["length", "length"]
+    assert completion.usage.completion_tokens == 2
+
+def test_streams_tokens_and_usage(start_server):
+    server, client = start_server()
+    stream = client.chat.completions.create(model="gpt-4o-mini", messages=user("abcdefghij"), stream=True,
+                                            stream_options={"include_usage" : True})
+    chunks = list(stream)
+    assert "".join(c.choices[0].delta.content or "" for c in chunks if len(c.choices) > 0) == "abcdefghij"
+    assert chunks[-1].usage.completion_tokens == 3
+    assert server.streamed_tokens == 3
+
+def test_replays_and_cycles_canned_responses(start_server):
+    _, client = start_server(responses=[{"messages" : user("a"), "response" : "replayed"}, "first", "second"])
+    contents = [client.chat.completions.create(model="m", messages=user(x)).choices[0].message.content
+                for x in ["b", "a", "c", "d"]]
+    assert contents == ["first", "replayed", "second", "first"]
+
+def test_rate_limit_returns_429(start_server):
+    server, client = start_server(rate_limit_rpm=2)
+    for _ in range(2):
+        client.chat.completions.create(model="m", messages=user("x"))
+    with pytest.raises(openai.RateLimitError):
+        client.chat.completions.create(model="m", messages=user("x"))
+    assert server.rate_limited == 1
+
+def test_repeated_long_prefixes_report_cached_tokens(start_server):
+    _, client = start_server()
+    prefix = [{"role" : "system", "content" : "x" * (8 * MIN_CACHED_PREFIX_TOKENS)}]
+    first = client.chat.completions.create(model="m", messages=prefix + user("one"))
+    second = client.chat.completions.create(model="m", messages=prefix + user("two"))
+    assert first.usage.prompt_tokens_details.cached_tokens == 0
+    assert second.usage.prompt_tokens_details.cached_tokens >= MIN_CACHED_PREFIX_TOKENS
+
+def test_async_chat_api_against_the_server(start_server):
+    server, _ = start_server(max_concurrency=2, latency_median=0.05)
+    api = AsyncChatAPI(api_key="0", base_url=server.base_url, max_concurrency=4)
+    async def main():
+        histories = []
+        for i in range(6):
+            history = MessageHistory()
+            history.add_message("user", f"int f{i}();")
+            histories.append(history)
+        return await asyncio.gather(*(api.get_response("gpt-4o-mini", h) for h in histories))
+    assert asyncio.run(main()) == [f"int f{i}();" for i in range(6)]
+    assert server.max_in_flight <= 2 and server.completed == 6
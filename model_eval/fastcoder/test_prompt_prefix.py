@@ -0,0 +1,28 @@
+import logging
+from types import SimpleNamespace
+
+from fastcoder.prompt_prefix import MIN_CACHED_PREFIX_TOKENS, PromptPrefix
+
+def test_build_puts_volatile_content_after_the_shared_prefix():
+    prefix = PromptPrefix("system", examples=[("example in", "example out")], header="header")
+    first = prefix.build("problem 1").get_messages()
+    second = prefix.build("problem 2").get_messages()
+    assert first[:-1] == second[:-1]
+    assert [m["role"] for m in first] == ["system", "user", "assistant", "user"]
+    assert first[-1]["content"] == "header\n\nproblem 1"
+
+def test_header_is_only_added_to_user_content():
+    prefix = PromptPrefix("system", header="header")
+    assert prefix.build("feedback", role="assistant").get_messages()[-1]["content"] == "feedback"
+
+def test_cacheable_depends_on_prefix_length():
+    assert not PromptPrefix("short system prompt").cacheable
+    assert PromptPrefix("x" * 4 * MIN_CACHED_PREFIX_TOKENS).cacheable
+
+def test_report_logs_cache_stats(caplog):
+    stats = {"gpt-4o-mini" : {"prompt_tokens" : 2000, "cached_prompt_tokens" : 1024, "hit_ratio" : 0.512, "dollars_saved" : 0.0001}}
+    chat_api = SimpleNamespace(get_prompt_cache_stats=lambda: stats)
+    with caplog.at_level(logging.INFO):
+        assert PromptPrefix("short").report(chat_api) == stats
+    assert "not cached" in caplog.text
+    assert "1024/2000 prompt tokens cached (51.2%)" in caplog.text
@@ -0,0 +1,33 @@
+from types import SimpleNamespace
+
+from evaluation_vllm import generate_as_completed
+
+# an engine that finishes one request per step, in the given order.
+class ScriptedEngine:
+    def __init__(self, finish_order):
+        self.finish_order = list(finish_order)
+        self.requests = {}
+        self.steps = 0
+
+    def add_request(self, request_id, prompt, sampling_params):
+        assert self.steps == 0, "requests added after the engine started"
+        self.requests[request_id] = prompt
+
+    def has_unfinished_requests(self):
+        return len(self.finish_order) > 0
+
+    def step(self):
+        self.steps += 1
+        request_id = str(self.finish_order.pop(0))
+        running = [SimpleNamespace(request_id=r, finished=False, outputs=[]) for r in self.requests if r != request_id]
+        finished = SimpleNamespace(request_id=request_id, finished=True,
+                                   outputs=[SimpleNamespace(text=self.requests[request_id].upper())])
+        return running + [finished]
+
+def test_prompts_are_added_at_once_and_yielded_as_they_finish():
+    engine = ScriptedEngine([2, 0, 1])
+    results = generate_as_completed(SimpleNamespace(llm_engine=engine), ["a", "b", "c"], sampling_params=None)
+    first = next(results)
+    # every prompt is in the engine before the first one is handed out
+    assert first == (2, "C") and len(engine.requests) == 3 and engine.steps == 1
+    assert list(results) == [(0, "A"), (1, "B")]